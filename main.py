@@ -1,48 +1,1503 @@
 import platform  # Importing platform module to check system information
 import subprocess  # Importing subprocess module to execute shell commands
-import requests  # Importing requests module to make HTTP requests
 import json  # Importing json module for JSON handling
 import os  # Importing os module for operating system functionalities
 import sys  # Importing sys module for system-specific parameters and functions
+import time  # Importing time module for timing measurements
+import functools  # Importing functools module for caching helpers
+import statistics  # Importing statistics module for benchmark summaries
+import tempfile  # Importing tempfile module for scratch directories
+import hashlib  # Importing hashlib module for checksums
+import random  # Importing random module for retry jitter
+import struct  # Importing struct module for binary headers
+import zlib  # Importing zlib module for inflating zip members
+import fnmatch  # Importing fnmatch module for member name patterns
+import contextlib  # Importing contextlib module for context managers
+import stat  # Importing stat module for file modes
+import bisect  # Importing bisect module for sorted whitelists
+import re  # Importing re module for parsing command output
+import threading  # Importing threading module for per-thread state
+import collections  # Importing collections module for counters and windows
+import io  # Importing io module for in-memory output
+import selectors  # Importing selectors module for socket readiness
+import shutil  # Importing shutil module for file copies
+import signal  # Importing signal module for shutdown handlers
+# requests is imported lazily inside the network code paths, so commands that
+# only edit ZBProxy.json do not pay for its import time. asyncio, http.server,
+# socket and the other modules only some commands use are imported the same way.
 
 _name = "OProxy"
 _version = "1.1.4"
 _by = "GreshAnt" 
 
         
+class HttpClient:
+    """Class to share one pooled requests.Session, with timeouts and retries, across OProxy."""
+
+    _shared = None
+
+    def __init__(self, connect_timeout: float = 5, read_timeout: float = 30, retries: int = 4,
+                 backoff: float = 0.5, max_backoff: float = 60) -> None:
+        """Initialize HttpClient object."""
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def shared(cls, **settings):
+        """Return the process-wide client, created with settings on first use."""
+        if cls._shared is None:
+            cls._shared = cls(**settings)
+        return cls._shared
+
+    @functools.cached_property
+    def session(self):
+        """The pooled session, keeping connections alive between calls."""
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @staticmethod
+    def should_retry(response):
+        """Check for a 5xx, or for a primary or secondary rate limit response."""
+        if response.status_code >= 500 or response.status_code == 429:
+            return True
+        if response.status_code == 403:
+            return ('Retry-After' in response.headers
+                    or response.headers.get('X-RateLimit-Remaining') == '0'
+                    or 'rate limit' in response.text.lower())
+        return False
+
+    def retry_delay(self, response, attempt: int):
+        """Seconds to wait before the next attempt, honoring Retry-After and X-RateLimit-Reset."""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                if retry_after.isdigit():
+                    return min(int(retry_after), self.max_backoff)
+                import email.utils
+                return min(max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), self.max_backoff)
+            if response.headers.get('X-RateLimit-Remaining') == '0' and response.headers.get('X-RateLimit-Reset', '').isdigit():
+                return min(max(int(response.headers['X-RateLimit-Reset']) - time.time(), 0), self.max_backoff)
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1)
+
+    def request(self, method: str, url: str, **kwargs):
+        """Send a request through the pool, retrying connection errors, 5xx and rate limits."""
+        import requests
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_delay(None, attempt)
+                print(f"{method} {url} failed: {e}")
+            else:
+                if attempt == self.retries or not self.should_retry(response):
+                    return response
+                delay = self.retry_delay(response, attempt)
+                print(f"{method} {url} returned {response.status_code}")
+                response.close()
+            print(f"Retrying in {delay:.1f}s ({attempt + 1}/{self.retries})...")
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs):
+        """Send a GET request through the pool."""
+        return self.request('GET', url, **kwargs)
+
+STATE_DIR = '.oproxy'  # OProxy's own state, next to ZBProxy.json
+
+
+class MetadataCache:
+    """Class to cache GitHub API metadata on disk, revalidated with ETags once the TTL expires."""
+
+    _shared = None
+
+    def __init__(self, file_path: str = os.path.join(STATE_DIR, 'metadata.json'), ttl: float = 60) -> None:
+        """Initialize MetadataCache object."""
+        self.cache_file = HandleJsonFile(file_path)
+        self.ttl = ttl
+        self.entries = None
+
+    @classmethod
+    def shared(cls, **settings):
+        """Return the process-wide cache, created with settings on first use."""
+        if cls._shared is None:
+            cls._shared = cls(**settings)
+        return cls._shared
+
+    def load(self):
+        """Load the cached entries, keyed by URL."""
+        if self.entries is None:
+            self.entries = (self.cache_file.read_json() if self.cache_file.file_exists() else None) or {}
+        return self.entries
+
+    def save(self):
+        """Write the cached entries back to disk."""
+        os.makedirs(os.path.dirname(self.cache_file.file_path) or '.', exist_ok=True)
+        self.cache_file.write_json(self.entries)
+
+    def get_json(self, http_client, url: str, headers: dict = None):
+        """Return the JSON at url, from cache within the TTL, otherwise revalidated with If-None-Match."""
+        entries = self.load()
+        entry = entries.get(url)
+        now = time.time()
+        if entry and now - entry['fetched_at'] < self.ttl:
+            print(f"Using cached {url}")
+            return entry['data']
+
+        headers = dict(headers or {})
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        response = http_client.get(url, headers=headers)
+        if response.status_code == 304 and entry:
+            print(f"{url} not modified")  # A 304 does not count against the rate limit
+            entry['fetched_at'] = now
+        else:
+            response.raise_for_status()
+            entry = {'etag': response.headers.get('ETag'), 'fetched_at': now, 'data': response.json()}
+            entries[url] = entry
+        self.save()
+        return entry['data']
+
+
+class ZipMemberExtractor:
+    """Class to extract one member of a zip archive while it streams in, without storing the archive.
+
+    Follows the local file headers in order, the way zip streams are written, so data descriptors
+    (sizes written after the data) are supported for deflated members.
+    """
+
+    def __init__(self, pattern: str, target_path: str) -> None:
+        """Initialize ZipMemberExtractor object, the first member whose name matches pattern goes to target_path."""
+        self.pattern = pattern
+        self.target_path = target_path
+        self.buffer = bytearray()
+        self.state = 'header'
+        self.entry = None
+        self.output = None
+        self.temp_path = None
+        self.member = None
+        self.done = False
+
+    def feed(self, data: bytes):
+        """Feed the next bytes of the archive, returns True once the member is extracted."""
+        import zipfile
+        self.buffer += data
+        while not self.done:
+            if self.state == 'header':
+                if len(self.buffer) < 4:
+                    return False
+                if self.buffer[:4] != zipfile.stringFileHeader:
+                    raise zipfile.BadZipFile(f'No member matching {self.pattern} in the archive')
+                if len(self.buffer) < zipfile.sizeFileHeader:
+                    return False
+                header = struct.unpack(zipfile.structFileHeader, self.buffer[:zipfile.sizeFileHeader])
+                flags, method, crc, compress_size = header[3], header[4], header[7], header[8]
+                name_length, extra_length = header[10], header[11]
+                header_size = zipfile.sizeFileHeader + name_length + extra_length
+                if len(self.buffer) < header_size:
+                    return False
+                name = self.buffer[zipfile.sizeFileHeader:zipfile.sizeFileHeader + name_length].decode('utf-8', 'replace')
+                extra = bytes(self.buffer[zipfile.sizeFileHeader + name_length:header_size])
+                del self.buffer[:header_size]
+                if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    raise zipfile.BadZipFile(f'Unsupported compression method {method} for {name}')
+                has_descriptor = bool(flags & 0x08)
+                if has_descriptor and method == zipfile.ZIP_STORED:
+                    raise zipfile.BadZipFile(f'Cannot stream stored member {name} with a data descriptor')
+                self.entry = {
+                    'name': name,
+                    'method': method,
+                    'crc': crc,
+                    'remaining': compress_size,
+                    'has_descriptor': has_descriptor,
+                    'zip64': self.has_zip64_extra(extra),
+                    'inflater': zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None,
+                    'crc_actual': 0,
+                    'match': fnmatch.fnmatch(os.path.basename(name), self.pattern),
+                }
+                if self.entry['match']:
+                    print(f"Extracting {name} to {self.target_path}")
+                    fd, self.temp_path = tempfile.mkstemp(prefix='.zbproxy-', dir=os.path.dirname(os.path.abspath(self.target_path)))
+                    self.output = os.fdopen(fd, 'wb')
+                self.state = 'data'
+            elif self.state == 'data':
+                if not self.buffer:
+                    return False
+                entry = self.entry
+                if entry['inflater'] is not None:
+                    chunk = entry['inflater'].decompress(bytes(self.buffer))
+                    self.buffer = bytearray(entry['inflater'].unused_data)
+                    finished = entry['inflater'].eof
+                else:
+                    size = min(entry['remaining'], len(self.buffer))
+                    chunk = bytes(self.buffer[:size])
+                    del self.buffer[:size]
+                    entry['remaining'] -= size
+                    finished = entry['remaining'] == 0
+                if entry['match']:
+                    self.output.write(chunk)
+                    entry['crc_actual'] = zlib.crc32(chunk, entry['crc_actual'])
+                if finished:
+                    self.state = 'descriptor' if entry['has_descriptor'] else 'end'
+            elif self.state == 'descriptor':
+                signed = self.buffer[:4] == b'PK\x07\x08'
+                size = (4 if signed else 0) + (20 if self.entry['zip64'] else 12)
+                if len(self.buffer) < size:
+                    return False
+                self.entry['crc'] = struct.unpack('<L', self.buffer[4 if signed else 0:(4 if signed else 0) + 4])[0]
+                del self.buffer[:size]
+                self.state = 'end'
+            elif self.state == 'end':
+                if self.entry['match']:
+                    self.finish()
+                self.state = 'header'
+        return self.done
+
+    @staticmethod
+    def has_zip64_extra(extra: bytes):
+        """Check the extra field for a zip64 record, which widens the data descriptor sizes."""
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, size = struct.unpack('<HH', extra[offset:offset + 4])
+            if header_id == 0x0001:
+                return True
+            offset += 4 + size
+        return False
+
+    def finish(self):
+        """Verify the extracted member and move it into place with the exec bit set."""
+        import zipfile
+        if self.entry['crc_actual'] != self.entry['crc']:
+            self.abort()
+            raise zipfile.BadZipFile(f"CRC mismatch for {self.entry['name']}")
+        self.output.flush()
+        os.fchmod(self.output.fileno(), 0o755)
+        os.fsync(self.output.fileno())
+        self.output.close()
+        os.replace(self.temp_path, self.target_path)
+        self.member = self.entry['name']
+        self.done = True
+
+    def abort(self):
+        """Remove a partially extracted member."""
+        if self.output is not None and not self.output.closed:
+            self.output.close()
+        if self.temp_path and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class ChangeJournal:
+    """Class to queue config changes, so a burst of commands is applied with one write and one restart."""
+
+    # Commands that only change ZBProxy.json and can be queued
+    DEFERRABLE = (("transit", "target"), ("transit", "whitelist"), ("proxy", "transit"), ("proxy", "hostname"))
+
+    def __init__(self, file_path: str = os.path.join(STATE_DIR, 'journal.json')) -> None:
+        """Initialize ChangeJournal object."""
+        self.journal_file = HandleJsonFile(file_path)
+
+    @classmethod
+    def deferrable(cls, args: list):
+        """Check that a command line only changes ZBProxy.json."""
+        return (tuple(args[1:3]) in cls.DEFERRABLE and args[3:4] != ["export"]
+                and not (args[3:4] == ["import"] and args[5:6] == ["-"]))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Open a transaction on the journal, creating it when needed."""
+        os.makedirs(os.path.dirname(self.journal_file.file_path) or '.', exist_ok=True)
+        with self.journal_file.transaction() as journal:
+            if journal is None:
+                journal = {"changes": [], "saved": 0}
+                self.journal_file.write_json(journal)
+            yield journal
+
+    def queue(self, args: list):
+        """Queue a command line to be applied later."""
+        with self.transaction() as journal:
+            journal["changes"].append({"args": args, "queued_at": time.time()})
+            count = len(journal["changes"])
+        print(f"Queued: {' '.join(args[1:])} ({count} pending)")
+        return count
+
+    def pending(self):
+        """Return the queued changes."""
+        journal = self.journal_file.read_json() if self.journal_file.file_exists() else None
+        return (journal or {}).get("changes", [])
+
+    def idle_seconds(self):
+        """Seconds since the journal last changed."""
+        try:
+            return time.time() - os.stat(self.journal_file.file_path).st_mtime
+        except FileNotFoundError:
+            return float('inf')
+
+    def apply(self, replay):
+        """Hand the queued changes to replay(changes), which returns a batch summary, and clear them."""
+        with self.transaction() as journal:
+            changes = journal["changes"]
+            if not changes:
+                print("No queued changes")
+                return None
+            summary = replay(changes)
+            journal["changes"] = []
+            journal["saved"] += summary.get("saved", 0)
+            summary["changes"] = len(changes)
+            summary["saved_total"] = journal["saved"]
+        return summary
+
+    def discard(self):
+        """Drop the queued changes."""
+        with self.transaction() as journal:
+            count = len(journal["changes"])
+            journal["changes"] = []
+        return count
+
+
 class NetworkControl:
     """Class to handle network-related operations like downloading files."""
     
-    def download_file(self, url: str, file_name: str):
-        """Download a file from a URL and save it locally."""
+    CHUNK_SIZE = 64 * 1024  # Bytes held in memory at a time while streaming a download
+
+    def __init__(self, http_client: HttpClient = None) -> None:
+        """Initialize NetworkControl object."""
+        self.http_client = http_client or HttpClient.shared()
+
+    def download_file(self, url: str, file_name: str, sha256: str = None):
+        """Stream a file from a URL to disk, resuming from a .part file and verifying its SHA-256.
+
+        A .part file is only resumed with the ETag or Last-Modified it was started under, sent as If-Range, so a file
+        that changed on the server is fetched again instead of spliced; without a validator or a sha256 it is discarded.
+        """
+        import requests
         print(f"Starting download from {url}...")
+        part_name = f"{file_name}.part"
+        validator_name = f"{part_name}.validator"
         try:
-            response = requests.get(url)
-            response.raise_for_status()  # Raise an exception for bad status codes
-            with open(file_name, 'wb') as file:
-                file.write(response.content)
+            validator = None
+            if os.path.exists(validator_name):
+                with open(validator_name) as file:
+                    validator = file.read().strip() or None
+            if os.path.exists(part_name) and validator is None and not sha256:
+                print(f"Discarding partial download of {file_name}: nothing to check it against")
+                os.remove(part_name)
+            # Hash what a previous attempt already fetched, then ask only for the rest
+            digest = hashlib.sha256()
+            offset = 0
+            if os.path.exists(part_name):
+                with open(part_name, 'rb') as part:
+                    for chunk in iter(lambda: part.read(self.CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        offset += len(chunk)
+                print(f"Resuming {file_name} from {offset} bytes")
+            headers = {}
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+                if validator:
+                    headers['If-Range'] = validator  # The server sends the whole file instead if it changed
+
+            with self.http_client.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 416:
+                    # Nothing left to fetch unless the .part file is bigger than the remote file
+                    if response.headers.get('Content-Range', '').rsplit('/', 1)[-1] != str(offset):
+                        os.remove(part_name)
+                        print(f"Discarding invalid partial download of {file_name}")
+                        return self.download_file(url, file_name, sha256)
+                else:
+                    response.raise_for_status()
+                    if offset and response.status_code == 206 and not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                        os.remove(part_name)
+                        print(f"Discarding partial download of {file_name}: the server sent {response.headers.get('Content-Range')}")
+                        return self.download_file(url, file_name, sha256)
+                    if offset and response.status_code != 206:
+                        print("Server sent the whole file (changed or no resume support), restarting download")
+                        digest = hashlib.sha256()
+                        offset = 0
+                    if not offset:
+                        # Kept next to the .part file, a later attempt resumes only if the server still has this version
+                        etag = response.headers.get('ETag', '')
+                        validator = (etag if etag and not etag.startswith('W/') else None) or response.headers.get('Last-Modified')
+                        if validator:
+                            with open(validator_name, 'w') as file:
+                                file.write(validator)
+                        elif os.path.exists(validator_name):
+                            os.remove(validator_name)
+                    total = offset + int(response.headers.get('Content-Length', 0))
+                    received = offset
+                    started = last_report = time.monotonic()
+                    with open(part_name, 'ab' if offset else 'wb') as part:
+                        for chunk in response.iter_content(self.CHUNK_SIZE):
+                            part.write(chunk)
+                            digest.update(chunk)
+                            received += len(chunk)
+                            if time.monotonic() - last_report >= 1:
+                                last_report = time.monotonic()
+                                rate = (received - offset) / (last_report - started) / 1024 / 1024
+                                print(f"{file_name}: {received / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f} MiB at {rate:.1f} MiB/s")
+                        part.flush()
+                        os.fsync(part.fileno())
+                    elapsed = max(time.monotonic() - started, 1e-6)
+                    print(f"{file_name}: {received - offset} bytes in {elapsed:.2f}s ({(received - offset) / elapsed / 1024 / 1024:.1f} MiB/s)")
+
+            if os.path.exists(validator_name):
+                os.remove(validator_name)
+            if sha256 and digest.hexdigest() != sha256.lower():
+                os.remove(part_name)
+                print(f"Checksum mismatch for {file_name}: expected {sha256}, got {digest.hexdigest()}")
+                return f"Failed to download {file_name}: checksum mismatch"
+            os.replace(part_name, file_name)  # Atomic, the target is either old or complete
             print(f"{file_name} downloaded successfully")
             return f"{file_name} downloaded successfully"
         except requests.RequestException as e:
             print(f"Failed to download {file_name}: {e}")
             return f"Failed to download {file_name}: {e}"
 
+    def download_zip_member(self, url: str, pattern: str, file_name: str):
+        """Stream a zip from a URL and extract only the member matching pattern to file_name, executable."""
+        import requests
+        import zipfile
+        print(f"Starting download from {url}...")
+        extractor = ZipMemberExtractor(pattern, file_name)
+        try:
+            received = 0
+            started = time.monotonic()
+            with self.http_client.get(url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    received += len(chunk)
+                    if extractor.feed(chunk):
+                        break  # The rest of the archive is not needed
+            if not extractor.done:
+                raise zipfile.BadZipFile(f'Archive ended before a member matching {pattern}')
+            elapsed = max(time.monotonic() - started, 1e-6)
+            print(f"{extractor.member} extracted to {file_name} from {received} bytes in {elapsed:.2f}s")
+            return f"{file_name} downloaded successfully"
+        except (requests.RequestException, zipfile.BadZipFile, zlib.error) as e:
+            extractor.abort()
+            print(f"Failed to download {file_name}: {e}")
+            return f"Failed to download {file_name}: {e}"
+
+class HttpEndpoint:
+    """Class to serve HTTP routes from a background thread, for the metrics endpoint and the build mirror."""
+
+    def __init__(self, routes: dict, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Initialize HttpEndpoint object, routes map a path (or a prefix ending in "/") to a function returning (status, headers, body)."""
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def handler_class(self):
+        """Build the request handler answering from routes."""
+        import http.server
+        routes = self.routes
+
+        class RouteHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                import socket
+                super().setup()
+                # Headers and body are written separately, don't let Nagle hold the body back
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_route(self):
+                path = self.path.split('?')[0]
+                # A route ending in "/" also serves every path below it
+                route = routes.get(path) or next((route for prefix, route in routes.items()
+                                                  if prefix.endswith('/') and path.startswith(prefix)), None)
+                status, headers, body = route(self) if route else (404, {}, b'Not Found')
+                if isinstance(body, bytes):
+                    headers.setdefault('Content-Length', str(len(body)))
+                    body = [body]
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+                try:
+                    for chunk in body:
+                        self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            do_GET = do_HEAD = do_POST = handle_route
+
+        return RouteHandler
+
+    def start(self):
+        """Start serving and return the base URL."""
+        import http.server
+        self.httpd = http.server.ThreadingHTTPServer((self.host, self.port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return f'http://{self.host}:{self.port}'
+
+    def stop(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @staticmethod
+    def json_response(data, status: int = 200, headers: dict = None):
+        """Build a JSON (status, headers, body) route result."""
+        return status, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(data).encode()
+
+    @staticmethod
+    def byte_range_response(request, size: int, read_at, etag: str = None):
+        """Answer a GET for `size` bytes from read_at(offset, length), honoring Range, and If-Range against etag."""
+        start, status, headers = 0, 200, {'ETag': etag} if etag else {}
+        range_header = request.headers.get('Range', '')
+        if_range = request.headers.get('If-Range')
+        if range_header.startswith('bytes=') and (if_range is None or if_range == etag):
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= size:
+                return 416, {'Content-Range': f'bytes */{size}'}, b''
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{size - 1}/{size}'
+        headers['Content-Length'] = str(size - start)
+        headers['Accept-Ranges'] = 'bytes'
+
+        def body():
+            offset = start
+            while offset < size:
+                chunk = read_at(offset, min(NetworkControl.CHUNK_SIZE, size - offset))
+                offset += len(chunk)
+                yield chunk
+        return status, headers, body()
+
+class MinecraftProtocol:
+    """Class with the Minecraft handshake and Server List Ping packets, used to check services."""
+
+    PROTOCOL_VERSION = 765
+
+    @staticmethod
+    def pack_varint(value: int):
+        """Encode an int as a Minecraft VarInt."""
+        value &= 0xFFFFFFFF
+        data = bytearray()
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                data.append(byte | 0x80)
+            else:
+                data.append(byte)
+                return bytes(data)
+
+    @staticmethod
+    def unpack_varint(data: bytes, offset: int = 0):
+        """Decode a VarInt at offset, returns (value, next offset)."""
+        value = 0
+        for shift in range(0, 35, 7):
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return (value - (1 << 32) if value & (1 << 31) else value), offset
+        raise ValueError('VarInt is too big')
+
+    @classmethod
+    def pack_string(cls, value: str):
+        """Encode a length-prefixed UTF-8 string."""
+        encoded = value.encode('utf-8')
+        return cls.pack_varint(len(encoded)) + encoded
+
+    @classmethod
+    def unpack_string(cls, data: bytes, offset: int = 0):
+        """Decode a length-prefixed UTF-8 string at offset, returns (value, next offset)."""
+        length, offset = cls.unpack_varint(data, offset)
+        return data[offset:offset + length].decode('utf-8'), offset + length
+
+    @classmethod
+    def packet(cls, packet_id: int, payload: bytes = b''):
+        """Frame a packet with its length and id."""
+        body = cls.pack_varint(packet_id) + payload
+        return cls.pack_varint(len(body)) + body
+
+    @classmethod
+    def handshake(cls, host: str, port: int, next_state: int = 1):
+        """Build a handshake packet, next_state 1 is status and 2 is login."""
+        return cls.packet(0x00, cls.pack_varint(cls.PROTOCOL_VERSION) + cls.pack_string(host)
+                          + struct.pack('>H', port) + cls.pack_varint(next_state))
+
+    @classmethod
+    def read_packet(cls, sock):
+        """Read one packet from a blocking socket, returns (packet id, payload)."""
+        length = 0
+        for shift in range(0, 35, 7):
+            byte = sock.recv(1)
+            if not byte:
+                raise ConnectionError('Connection closed by the server')
+            length |= (byte[0] & 0x7F) << shift
+            if not byte[0] & 0x80:
+                break
+        data = bytearray()
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError('Connection closed by the server')
+            data += chunk
+        packet_id, offset = cls.unpack_varint(bytes(data))
+        return packet_id, bytes(data[offset:])
+
+    @classmethod
+    def status_ping(cls, host: str, port: int, timeout: float = 5):
+        """Run a Server List Ping, returns the status and the connect/status/ping times in ms."""
+        import socket
+        started = time.perf_counter()
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            connected = time.perf_counter()
+            sock.sendall(cls.handshake(host, port) + cls.packet(0x00))
+            packet_id, payload = cls.read_packet(sock)
+            if packet_id != 0x00:
+                raise ValueError(f'Unexpected status packet {packet_id}')
+            status = json.loads(cls.unpack_string(payload)[0])
+            answered = time.perf_counter()
+            sock.sendall(cls.packet(0x01, struct.pack('>q', int(answered))))
+            packet_id, payload = cls.read_packet(sock)
+            if packet_id != 0x01:
+                raise ValueError(f'Unexpected pong packet {packet_id}')
+            ponged = time.perf_counter()
+        return {
+            'status': status,
+            'connect_ms': (connected - started) * 1000,
+            'status_ms': (answered - connected) * 1000,
+            'ping_ms': (ponged - answered) * 1000,
+        }
+
+    @classmethod
+    async def read_packet_async(cls, reader):
+        """Read one packet from an asyncio stream, returns (packet id, payload)."""
+        import asyncio
+        try:
+            length = 0
+            for shift in range(0, 35, 7):
+                byte = (await reader.readexactly(1))[0]
+                length |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    break
+            data = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Connection closed by the server')
+        packet_id, offset = cls.unpack_varint(data)
+        return packet_id, data[offset:]
+
+    @classmethod
+    async def status_ping_async(cls, host: str, port: int, timeout: float = 5, status: bool = True):
+        """status_ping for asyncio; connect_ms is kept when the server does not speak the status protocol.
+
+        With status False only the TCP connect is timed.
+        """
+        import asyncio
+        result = {'status': None, 'connect_ms': None, 'status_ms': None, 'ping_ms': None, 'error': None}
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            result['error'] = f'connect: {type(e).__name__} {e}'.strip()
+            return result
+        connected = time.perf_counter()
+        result['connect_ms'] = (connected - started) * 1000
+        try:
+            if not status:
+                return result
+            writer.write(cls.handshake(host, port) + cls.packet(0x00))
+            packet_id, payload = await asyncio.wait_for(cls.read_packet_async(reader), timeout)
+            if packet_id != 0x00:
+                raise ValueError(f'Unexpected status packet {packet_id}')
+            result['status'] = json.loads(cls.unpack_string(payload)[0])
+            answered = time.perf_counter()
+            result['status_ms'] = (answered - connected) * 1000
+            writer.write(cls.packet(0x01, struct.pack('>q', int(answered))))
+            packet_id, payload = await asyncio.wait_for(cls.read_packet_async(reader), timeout)
+            if packet_id != 0x01:
+                raise ValueError(f'Unexpected pong packet {packet_id}')
+            result['ping_ms'] = (time.perf_counter() - answered) * 1000
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError) as e:
+            result['error'] = f'status: {type(e).__name__} {e}'.strip()
+        finally:
+            writer.close()
+        return result
+
+
+class LatencyProbe:
+    """Class to measure connect and Server List Ping round trips to every upstream and transit server."""
+
+    DEFAULT_PORT = 25565
+    TCP_ONLY_AFTER = 2  # Status pings in a row that connect but go unanswered, by a target that never answered one
+
+    def __init__(self, count: int = 10, interval: float = 0.2, timeout: float = 3, concurrency: int = 64) -> None:
+        """Initialize LatencyProbe object, count pings per target spaced by interval seconds."""
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    @classmethod
+    def parse_address(cls, address: str, default_port: int = DEFAULT_PORT):
+        """Split host[:port] (or [ipv6]:port) into (host, port)."""
+        if address.startswith('['):
+            host, _, rest = address[1:].partition(']')
+            return host, int(rest[1:]) if rest.startswith(':') else default_port
+        if address.count(':') == 1:
+            host, port = address.split(':')
+            return host, int(port)
+        return address, default_port
+
+    @classmethod
+    def targets(cls, config: dict):
+        """List (label, host, port) for every service upstream and every TransitServerIP entry."""
+        targets = []
+        for service in config.get('Services', []):
+            targets.append((f"service {service['Name']}", service['TargetAddress'], int(service['TargetPort'])))
+        for entry in config.get('Lists', {}).get('TransitServerIP', []):
+            targets.append((f"transit {entry}", *cls.parse_address(entry)))
+        return targets
+
+    @staticmethod
+    def percentile(samples, p: float):
+        """Nearest-rank percentile, None without samples."""
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[max(0, int(-(-len(ordered) * p // 100)) - 1)]
+
+    @classmethod
+    def describe(cls, samples):
+        """p50/p95/p99 and jitter (mean change between consecutive samples) in ms."""
+        jitter = statistics.mean(abs(b - a) for a, b in zip(samples, samples[1:])) if len(samples) > 1 else None
+        return {
+            'p50_ms': cls.rounded(cls.percentile(samples, 50)),
+            'p95_ms': cls.rounded(cls.percentile(samples, 95)),
+            'p99_ms': cls.rounded(cls.percentile(samples, 99)),
+            'jitter_ms': cls.rounded(jitter),
+        }
+
+    @staticmethod
+    def rounded(value):
+        return None if value is None else round(value, 2)
+
+    async def probe_target(self, semaphore, label: str, host: str, port: int):
+        """Ping one target count times and summarize it.
+
+        A target that answers a status ping is measured by status pings to the end, a failed one counts as lost. One that
+        connects but leaves TCP_ONLY_AFTER status pings in a row unanswered, and never answered one, is not a Minecraft
+        server: its TCP connect is timed alone from then on, and its loss is that of the connects.
+        """
+        import asyncio
+        pings = []
+        status = True
+        unanswered = 0  # Status pings in a row that connected and got no answer
+        for i in range(self.count):
+            if i:
+                await asyncio.sleep(self.interval)
+            async with semaphore:
+                ping = await MinecraftProtocol.status_ping_async(host, port, self.timeout, status)
+            pings.append(ping)
+            if status:
+                unanswered = unanswered + 1 if ping['connect_ms'] is not None and ping['ping_ms'] is None else 0
+                if unanswered >= self.TCP_ONLY_AFTER and not any(ping['ping_ms'] is not None for ping in pings):
+                    status = False  # Not a Minecraft server, stop waiting on it to answer
+        connect = [ping['connect_ms'] for ping in pings if ping['connect_ms'] is not None]
+        rtt = [ping['ping_ms'] for ping in pings if ping['ping_ms'] is not None]
+        errors = [ping['error'] for ping in pings if ping['error']]
+        # Each attempt failed or not in the mode measured: the status ping when it ever answered, else the connect
+        failures = sum(ping['ping_ms'] is None if rtt else ping['connect_ms'] is None for ping in pings)
+        return {
+            'target': label,
+            'address': f'{host}:{port}',
+            'minecraft': bool(rtt),
+            'ping': self.describe(rtt),
+            'connect': self.describe(connect),
+            'loss': round(failures / self.count, 3),
+            'errors': sorted(set(errors)),
+        }
+
+    async def probe_all(self, targets):
+        """Probe the targets concurrently, at most concurrency connections at once."""
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*(self.probe_target(semaphore, *target) for target in targets))
+
+    @staticmethod
+    def rank_key(result):
+        """Lowest Minecraft ping first, then TCP-only targets, unreachable ones last."""
+        ping, connect = result['ping']['p50_ms'], result['connect']['p50_ms']
+        if ping is not None:
+            return (0, result['loss'], ping)
+        if connect is not None:
+            return (1, result['loss'], connect)
+        return (2, 0, 0)
+
+    def run(self, targets):
+        """Probe every target concurrently and return the results, best first."""
+        import asyncio
+        return sorted(asyncio.run(self.probe_all(targets)), key=self.rank_key)
+
+    @staticmethod
+    def table(results):
+        """Format the ranked results as a table."""
+        def cell(value):
+            return '-' if value is None else f'{value:.1f}'
+        lines = [f"{'#':>2}  {'target':<28}{'address':<24}{'p50':>8}{'p95':>8}{'p99':>8}{'jitter':>8}{'connect':>9}{'loss':>7}"]
+        for rank, result in enumerate(results, 1):
+            stats = result['ping'] if result['minecraft'] else result['connect']
+            lines.append(f"{rank:>2}  {result['target'][:27]:<28}{result['address'][:23]:<24}{cell(stats['p50_ms']):>8}"
+                         f"{cell(stats['p95_ms']):>8}{cell(stats['p99_ms']):>8}{cell(stats['jitter_ms']):>8}"
+                         f"{cell(result['connect']['p50_ms']):>9}{result['loss'] * 100:>6.0f}%"
+                         + ('' if result['minecraft'] else '  (tcp only)' if result['connect']['p50_ms'] is not None else '  (down)'))
+        return '\n'.join(lines)
+
+
+class HealthWatchdog:
+    """Class to status ping every Listen port and upstream of ZBProxy.json from one event loop, and act on sustained failures.
+
+    Each target keeps a sliding window of its last checks. A target failing degrade_after of them is degraded, a listener
+    failing restart_after of them gets its unit restarted; an upstream, which ZBProxy cannot fix, only raises the alert hook.
+    """
+
+    STATUS_FILE = os.path.join(STATE_DIR, 'health.json')
+    DEFAULTS = {  # "watchdog" in config.json
+        "interval": 10,  # Seconds between checks of a target
+        "timeout": 3,  # Seconds a whole status ping may take
+        "window": 10,  # Checks remembered per target
+        "degrade_after": 3,  # Failures in the window before a target is degraded and alerted on
+        "restart_after": 5,  # Failures in the window before it is restarted
+        "recover_after": 2,  # Successes in a row before a target is healthy again
+        "cooldown": 300,  # Seconds between restarts of the same unit
+        "concurrency": 64,  # Pings in flight at once
+        "alert": None,  # Shell command run on every state change, with OPROXY_TARGET, _KIND, _SERVICES, _STATE and _REASON set
+    }
+    STATUS_EVERY = 60  # Seconds between status file writes while no state changes
+
+    def __init__(self, config_path: str = 'ZBProxy.json', system_control: 'SystemControl' = None, settings: dict = None,
+                 status_path: str = STATUS_FILE) -> None:
+        """Initialize HealthWatchdog object, settings override DEFAULTS."""
+        self.config_path = config_path
+        self.system_control = system_control or SystemControl()
+        self.settings = {**self.DEFAULTS, **(settings or {})}
+        self.status_path = status_path
+        self.shards = ZBProxyShards(config_path, self.system_control)
+        self.targets = {}  # Key -> target, see load_targets
+        self.config_key = None
+        self.restarted = {}  # Unit -> monotonic time of its last restart
+        self.actions = []  # (time, unit, action, reason), newest last
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.changed = True  # A state changed since the status file was written
+        self.tasks = {}
+        self.background = set()
+        self.semaphore = None  # Set up by serve()
+        self.stopped = None
+
+    def unit_of(self, service: str):
+        """The systemd unit serving a service."""
+        shard = self.shards.state().get("assignment", {}).get(service)
+        return 'ZBProxy' if shard is None else f'{ZBProxyShards.UNIT}{shard}'
+
+    def load_targets(self):
+        """Re-read ZBProxy.json when it changed: one target per Listen port and per distinct upstream, keeping their history."""
+        try:
+            st = os.stat(self.config_path)
+            with open(self.config_path) as file:
+                config = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read {self.config_path}, keeping the current targets: {e}")
+            return
+        if (st.st_ino, st.st_mtime_ns) == self.config_key:
+            return
+        self.config_key = (st.st_ino, st.st_mtime_ns)
+        wanted = {}
+        for service in config.get('Services', []):
+            listen = wanted.setdefault(f"listen {service['Listen']}", {"kind": "listen", "host": '127.0.0.1', "port": int(service['Listen']),
+                                                                      "services": [], "unit": self.unit_of(service['Name'])})
+            listen["services"].append(service['Name'])
+            upstream = wanted.setdefault(f"upstream {service['TargetAddress']}:{service['TargetPort']}",
+                                         {"kind": "upstream", "host": service['TargetAddress'], "port": int(service['TargetPort']),
+                                          "services": [], "unit": None})
+            upstream["services"].append(service['Name'])
+        for key in [key for key in self.targets if key not in wanted]:
+            del self.targets[key]
+            if key in self.tasks:
+                self.tasks.pop(key).cancel()
+        for key, target in wanted.items():
+            if key in self.targets:
+                self.targets[key].update(services=target["services"], unit=target["unit"])
+            else:
+                self.targets[key] = {**target, "window": collections.deque(maxlen=int(self.settings["window"])), "state": "healthy",
+                                     "successes": 0, "last_ms": None, "last_error": None, "checked": None}
+        print(f"Watching {sum(target['kind'] == 'listen' for target in self.targets.values())} listeners and "
+              f"{sum(target['kind'] == 'upstream' for target in self.targets.values())} upstreams")
+        self.changed = True
+
+    async def check(self, key: str):
+        """Status ping one target, at most concurrency at once, and record the result."""
+        import asyncio
+        target = self.targets[key]
+        timeout = float(self.settings["timeout"])
+        async with self.semaphore:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            started = time.perf_counter()
+            try:
+                # Bounds the whole ping, a wedged server that accepts and never answers included
+                error = (await asyncio.wait_for(MinecraftProtocol.status_ping_async(target["host"], target["port"], timeout), timeout))['error']
+            except asyncio.TimeoutError:
+                error = f'no answer within {timeout}s'
+            finally:
+                self.in_flight -= 1
+        target["last_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        target["last_error"] = error
+        target["checked"] = time.time()
+        await self.record(key, target, error is None)
+
+    async def record(self, key: str, target: dict, ok: bool):
+        """Slide the window and move the target between healthy, degraded and down, acting on the way."""
+        target["window"].append(ok)
+        target["successes"] = target["successes"] + 1 if ok else 0
+        failures = target["window"].count(False)
+        if ok:
+            if target["state"] != 'healthy' and target["successes"] >= int(self.settings["recover_after"]):
+                target["window"].clear()  # Old failures must not count against it again
+                self.transition(key, target, 'healthy', f"{target['successes']} checks in a row answered")
+            return
+        reason = f"{failures} of the last {len(target['window'])} checks failed: {target['last_error']}"
+        if failures >= int(self.settings["restart_after"]) and (target["state"] != 'down' or target["kind"] == 'listen'):
+            if target["state"] != 'down':
+                self.transition(key, target, 'down', reason)
+            if target["kind"] == 'listen':
+                await self.restart(target["unit"], reason)
+        elif failures >= int(self.settings["degrade_after"]) and target["state"] == 'healthy':
+            self.transition(key, target, 'degraded', reason)
+
+    async def restart(self, unit: str, reason: str):
+        """Restart a unit unless it was restarted within the cooldown."""
+        since = time.monotonic() - self.restarted.get(unit, float('-inf'))
+        if since < float(self.settings["cooldown"]):
+            return
+        self.restarted[unit] = time.monotonic()
+        await self.act(unit, 'restart', reason)
+        # Every listener of the unit starts over, the restart dropped what they had seen
+        for target in self.targets.values():
+            if target["unit"] == unit:
+                target["window"].clear()
+
+    async def act(self, unit: str, action: str, reason: str):
+        """Run a systemctl action on a unit, off the event loop so the other checks keep their schedule."""
+        import asyncio
+        print(f"Watchdog: {action} {unit}, {reason}")
+        self.actions = self.actions[-99:] + [(time.time(), unit, action, reason)]
+        await asyncio.get_running_loop().run_in_executor(None, self.system_control.run_command, f'sudo systemctl {action} {unit}')
+
+    def transition(self, key: str, target: dict, state: str, reason: str):
+        """Record a state change and raise the alert hook."""
+        import asyncio
+        print(f"Watchdog: {key} ({', '.join(target['services'])}) {target['state']} -> {state}, {reason}")
+        target["state"] = state
+        self.changed = True
+        if self.settings["alert"]:
+            task = asyncio.get_running_loop().create_task(self.alert(key, target, reason))
+            self.background.add(task)
+            task.add_done_callback(self.background.discard)
+
+    async def alert(self, key: str, target: dict, reason: str):
+        """Run the alert command for a state change."""
+        import asyncio
+        env = {**os.environ, "OPROXY_TARGET": key, "OPROXY_KIND": target["kind"], "OPROXY_SERVICES": ','.join(target["services"]),
+               "OPROXY_STATE": target["state"], "OPROXY_REASON": reason}
+        process = await asyncio.create_subprocess_shell(self.settings["alert"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.wait_for(process.wait(), 30)
+        except asyncio.TimeoutError:
+            process.kill()
+            print(f"Watchdog: alert command for {key} timed out")
+
+    async def watch(self, key: str, delay: float):
+        """Check one target every interval, starting after delay so the targets are spread over the interval."""
+        import asyncio
+        await asyncio.sleep(delay)
+        while key in self.targets:
+            started = time.monotonic()
+            await self.check(key)
+            await asyncio.sleep(max(0.0, float(self.settings["interval"]) - (time.monotonic() - started)))
+
+    def status(self):
+        """Every target's state and recent history, and the latest actions."""
+        return {
+            "updated": time.time(),
+            "peak_in_flight": self.peak_in_flight,
+            "targets": {key: {"kind": target["kind"], "services": target["services"], "state": target["state"],
+                              "failures": target["window"].count(False), "checks": len(target["window"]),
+                              "last_ms": target["last_ms"], "last_error": target["last_error"], "checked": target["checked"]}
+                        for key, target in sorted(self.targets.items())},
+            "actions": [{"time": at, "unit": unit, "action": action, "reason": reason} for at, unit, action, reason in self.actions[-20:]],
+        }
+
+    def write_status(self):
+        with contextlib.redirect_stdout(io.StringIO()):  # Not a log line every write
+            HandleJsonFile(self.status_path).write_json(self.status())
+        self.changed = False
+
+    async def serve(self):
+        """Watch the targets until stopped is set, picking up changes to ZBProxy.json."""
+        import asyncio
+        self.semaphore = asyncio.Semaphore(int(self.settings["concurrency"]))
+        self.stopped = asyncio.Event()
+        os.makedirs(os.path.dirname(self.status_path) or '.', exist_ok=True)
+        written = 0
+        try:
+            while not self.stopped.is_set():
+                self.load_targets()
+                interval = float(self.settings["interval"])
+                new = [key for key in self.targets if key not in self.tasks]
+                for index, key in enumerate(new):
+                    self.tasks[key] = asyncio.get_running_loop().create_task(self.watch(key, interval * index / len(new)))
+                if self.changed or time.monotonic() - written >= self.STATUS_EVERY:
+                    self.write_status()
+                    written = time.monotonic()
+                try:
+                    await asyncio.wait_for(self.stopped.wait(), min(interval, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self.tasks.values():
+                task.cancel()
+            await asyncio.gather(*self.tasks.values(), *self.background, return_exceptions=True)
+            self.tasks.clear()
+            self.write_status()
+
+    def run(self):
+        """Watch until SIGTERM or Ctrl-C."""
+        import asyncio
+
+        async def main():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: self.stopped.set())
+            await self.serve()
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+        print("Watchdog stopped")
+
+
+class UpstreamSelector:
+    """Class to keep a proxy service's TargetAddress on the fastest upstream of a pool, without flapping between them.
+
+    The pool is the "<service>Upstreams" list of ZBProxy.json, and the active target always counts as a candidate. Every round
+    status pings each candidate once, a candidate scores the median of its window plus a penalty for its losses. A challenger
+    takes over after beating the active upstream by margin and margin_ms for hold rounds in a row, and not within dwell seconds
+    of the last switch; an active upstream failing down_after pings in a row is replaced at once.
+    """
+
+    STATUS_FILE = os.path.join(STATE_DIR, 'failover.json')
+    LIST_SUFFIX = 'Upstreams'
+    DEFAULTS = {  # "failover" in config.json
+        "service": "MinecraftProxy",  # The service kept on the best upstream
+        "interval": 5,  # Seconds between rounds
+        "timeout": 2,  # Seconds a status ping may take
+        "window": 8,  # Pings remembered per candidate
+        "margin": 0.2,  # A challenger must be this fraction faster than the active upstream...
+        "margin_ms": 5,  # ...and at least this many ms faster
+        "hold": 3,  # Rounds in a row a challenger must stay ahead before it takes over
+        "dwell": 60,  # Seconds after a switch before the next one, unless the active upstream is down
+        "down_after": 3,  # Failed pings in a row that make a candidate down
+        "loss_penalty_ms": 1000,  # Added to a score per 100% loss in the window
+    }
+
+    def __init__(self, proxy_server: 'ProxyServer', settings: dict = None, status_path: str = STATUS_FILE) -> None:
+        """Initialize UpstreamSelector object, settings override DEFAULTS."""
+        self.proxy_server = proxy_server
+        self.settings = {**self.DEFAULTS, **(settings or {})}
+        self.status_path = status_path
+        self.candidates = {}  # "host:port" -> {"window": deque of ping ms, None for a failure, "failures": failures in a row}
+        self.active = None
+        self.challenger = None
+        self.streak = 0  # Rounds in a row the challenger has been ahead
+        self.switched = float('-inf')  # Monotonic time of the last switch
+        self.switches = []  # Newest last
+        self.rounds = 0
+        self.stopped = None  # Set up by serve()
+
+    @classmethod
+    def list_name(cls, service: str):
+        return f'{service}{cls.LIST_SUFFIX}'
+
+    @staticmethod
+    def address(host: str, port):
+        """host:port, with brackets around an IPv6 host."""
+        return f'[{host}]:{port}' if ':' in host else f'{host}:{port}'
+
+    def pool(self):
+        """The active target of the service and every candidate, from ZBProxy.json; (None, []) without the service."""
+        config = self.proxy_server.zbproxy_config.read_json() or {}
+        service = next((service for service in config.get('Services', []) if service['Name'] == self.settings["service"]), None)
+        if service is None:
+            return None, []
+        active = self.address(service['TargetAddress'], service['TargetPort'])
+        entries = config.get('Lists', {}).get(self.list_name(self.settings["service"]), [])
+        return active, list(dict.fromkeys([active, *(self.address(*LatencyProbe.parse_address(entry)) for entry in entries)]))
+
+    def score(self, key: str):
+        """Median ping of the window plus the loss penalty in ms, None for a candidate that is down or not measured yet."""
+        candidate = self.candidates[key]
+        pings = [ms for ms in candidate["window"] if ms is not None]
+        if not pings or candidate["failures"] >= int(self.settings["down_after"]):
+            return None
+        loss = 1 - len(pings) / len(candidate["window"])
+        return statistics.median(pings) + float(self.settings["loss_penalty_ms"]) * loss
+
+    async def measure(self, key: str):
+        """Status ping one candidate and slide its window."""
+        import asyncio
+        candidate = self.candidates.setdefault(key, {"window": collections.deque(maxlen=int(self.settings["window"])), "failures": 0})
+        host, port = LatencyProbe.parse_address(key)
+        timeout = float(self.settings["timeout"])
+        try:
+            ping = await asyncio.wait_for(MinecraftProtocol.status_ping_async(host, port, timeout), timeout)
+        except asyncio.TimeoutError:
+            ping = {"ping_ms": None}
+        candidate["window"].append(ping["ping_ms"])
+        candidate["failures"] = 0 if ping["ping_ms"] is not None else candidate["failures"] + 1
+
+    def decide(self):
+        """The candidate to switch to and why, or (None, None) to stay."""
+        scores = {key: self.score(key) for key in self.candidates}
+        alive = {key: score for key, score in scores.items() if score is not None}
+        if not alive:
+            self.challenger, self.streak = None, 0
+            return None, None
+        best = min(alive, key=alive.get)
+        current = scores.get(self.active)
+        if self.candidates[self.active]["failures"] >= int(self.settings["down_after"]):
+            self.challenger, self.streak = None, 0
+            return best, f"{self.active} is down, {best} answers in {alive[best]:.1f} ms"
+        ahead = (current is not None and best != self.active and alive[best] <= current * (1 - float(self.settings["margin"]))
+                 and current - alive[best] >= float(self.settings["margin_ms"]))
+        if not ahead:
+            self.challenger, self.streak = None, 0
+            return None, None
+        self.streak = self.streak + 1 if best == self.challenger else 1
+        self.challenger = best
+        if self.streak < int(self.settings["hold"]) or time.monotonic() - self.switched < float(self.settings["dwell"]):
+            return None, None
+        return best, f"{best} at {alive[best]:.1f} ms beat {self.active} at {current:.1f} ms for {self.streak} rounds"
+
+    async def step(self):
+        """Measure every candidate once, then switch the service's target if one should take over."""
+        import asyncio
+        self.active, keys = self.pool()
+        if self.active is None:
+            print(f"Failover: no service {self.settings['service']} in {self.proxy_server.zbproxy_config.file_path}")
+            return None
+        for key in [key for key in self.candidates if key not in keys]:
+            del self.candidates[key]
+        await asyncio.gather(*(self.measure(key) for key in keys))
+        self.rounds += 1
+        target, reason = self.decide()
+        if target is None:
+            return None
+        print(f"Failover: {self.active} -> {target}, {reason}")
+        host, port = LatencyProbe.parse_address(target)
+        # One write of ZBProxy.json and one activation, off the event loop
+        action = await asyncio.get_running_loop().run_in_executor(None, self.proxy_server.switch_upstream, self.settings["service"], host, port)
+        self.switches = self.switches[-99:] + [{"time": time.time(), "from": self.active, "to": target, "reason": reason, "action": action}]
+        self.switched = time.monotonic()
+        self.active, self.challenger, self.streak = target, None, 0
+        return target
+
+    def status(self):
+        """The active upstream, every candidate's score and the latest switches."""
+        return {
+            "updated": time.time(),
+            "service": self.settings["service"],
+            "active": self.active,
+            "challenger": self.challenger,
+            "streak": self.streak,
+            "candidates": {key: {"score_ms": LatencyProbe.rounded(self.score(key)), "failures": candidate["failures"],
+                                 "loss": round(list(candidate["window"]).count(None) / len(candidate["window"]), 3) if candidate["window"] else None,
+                                 "last_ms": LatencyProbe.rounded(candidate["window"][-1]) if candidate["window"] else None}
+                           for key, candidate in sorted(self.candidates.items())},
+            "switches": self.switches[-20:],
+        }
+
+    def write_status(self):
+        with contextlib.redirect_stdout(io.StringIO()):  # Not a log line every round
+            HandleJsonFile(self.status_path).write_json(self.status())
+
+    async def serve(self):
+        """Run a round every interval until stopped is set."""
+        import asyncio
+        self.stopped = asyncio.Event()
+        os.makedirs(os.path.dirname(self.status_path) or '.', exist_ok=True)
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            await self.step()
+            self.write_status()
+            try:
+                await asyncio.wait_for(self.stopped.wait(), max(0.0, float(self.settings["interval"]) - (time.monotonic() - started)))
+            except asyncio.TimeoutError:
+                pass
+
+    def run(self):
+        """Select upstreams until SIGTERM or Ctrl-C."""
+        import asyncio
+
+        async def main():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: self.stopped.set())
+            await self.serve()
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+        print("Failover stopped")
+
+
+class LoadGenerator:
+    """Class to simulate many Minecraft clients against one Listen port: status ping, login start and payload echo."""
+
+    def __init__(self, host: str, port: int, clients: int = 1000, concurrency: int = 200,
+                 payload_bytes: int = 0, timeout: float = 10, names: list = None) -> None:
+        """Initialize LoadGenerator object, names are the players logging in (Player{i} by default)."""
+        self.host = host
+        self.port = port
+        self.clients = clients
+        self.concurrency = concurrency
+        self.payload_bytes = payload_bytes
+        self.timeout = timeout
+        self.names = names or [f"Player{i}" for i in range(clients)]
+        self.status_ms = []
+        self.login_ms = []
+        self.payload_ms = []
+        self.connections = 0
+        self.transferred = 0
+        self.errors = {}
+
+    def error(self, stage: str, e: Exception):
+        """Count an error by stage and type."""
+        key = f"{stage}: {type(e).__name__}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    async def login(self, name: str):
+        """Log in as name and echo the payload, recording timings."""
+        import asyncio
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.error("login connect", e)
+            return
+        try:
+            uuid = hashlib.md5(f"OfflinePlayer:{name}".encode()).digest()
+            writer.write(MinecraftProtocol.handshake(self.host, self.port, 2)
+                         + MinecraftProtocol.packet(0x00, MinecraftProtocol.pack_string(name) + uuid))
+            packet_id, payload = await asyncio.wait_for(MinecraftProtocol.read_packet_async(reader), self.timeout)
+            if packet_id != 0x02:
+                raise PermissionError(MinecraftProtocol.unpack_string(payload)[0] if packet_id == 0x00 else packet_id)
+            logged_in = time.perf_counter()
+            self.login_ms.append((logged_in - started) * 1000)
+            self.connections += 1
+            if self.payload_bytes:
+                data = random.Random(name).randbytes(min(self.payload_bytes, 65536))
+
+                async def send():
+                    for offset in range(0, self.payload_bytes, len(data)):
+                        writer.write(data[:self.payload_bytes - offset])
+                        await writer.drain()
+
+                # Read while writing, a full socket buffer on either side would stall the echo
+                echoed = (await asyncio.wait_for(asyncio.gather(send(), reader.readexactly(self.payload_bytes)), self.timeout))[1]
+                if echoed[:len(data)] != data[:len(echoed)]:
+                    raise ValueError("payload came back corrupted")
+                self.payload_ms.append((time.perf_counter() - logged_in) * 1000)
+                self.transferred += 2 * self.payload_bytes
+        except (OSError, ValueError, IndexError, PermissionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self.error("login", e)
+        finally:
+            writer.close()
+
+    async def client(self, semaphore, index: int):
+        """One simulated player: a status ping like the server list does, then a login."""
+        async with semaphore:
+            ping = await MinecraftProtocol.status_ping_async(self.host, self.port, self.timeout)
+            if ping['error']:
+                stage, _, reason = ping['error'].partition(': ')
+                key = f"{stage}: {reason.split(' ')[0]}"
+                self.errors[key] = self.errors.get(key, 0) + 1
+            else:
+                self.status_ms.append(ping['connect_ms'] + ping['status_ms'])
+                self.connections += 1
+            await self.login(self.names[index % len(self.names)])
+
+    async def run_all(self):
+        """Start every client, the semaphore keeps concurrency of them connected."""
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self.client(semaphore, i) for i in range(self.clients)))
+
+    def run(self):
+        """Run every client, at most concurrency at once, and summarize."""
+        import asyncio
+        started = time.perf_counter()
+        asyncio.run(self.run_all())
+        elapsed = time.perf_counter() - started
+        attempts = 2 * self.clients
+        return {
+            "clients": self.clients,
+            "concurrency": self.concurrency,
+            "seconds": round(elapsed, 3),
+            "connections_per_second": round(self.connections / elapsed, 1),
+            "handshake_status": LatencyProbe.describe(self.status_ms),
+            "login": LatencyProbe.describe(self.login_ms),
+            "payload": LatencyProbe.describe(self.payload_ms),
+            "bytes_per_second": round(self.transferred / elapsed),
+            "error_rate": round(sum(self.errors.values()) / attempts, 4),
+            "errors": self.errors,
+        }
+
+
+class MinecraftEchoServer:
+    """Class to stand in for the Minecraft server behind ZBProxy in the load benchmark: status, login, then a raw echo."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, description: str = 'OProxy stand-in') -> None:
+        """Initialize MinecraftEchoServer object."""
+        self.host = host
+        self.port = port
+        self.description = description
+        self.names = None  # Player names let in, None lets everyone in
+        self.server = None
+
+    def read_packet(self, sock):
+        return MinecraftProtocol.read_packet(sock)
+
+    def handle(self, sock):
+        """Answer handshake, status, ping and login start packets on one connection."""
+        state = 0
+        try:
+            while True:
+                packet_id, payload = self.read_packet(sock)
+                if state == 0 and packet_id == 0x00:
+                    offset = MinecraftProtocol.unpack_varint(payload)[1]
+                    offset = MinecraftProtocol.unpack_string(payload, offset)[1] + 2
+                    state = MinecraftProtocol.unpack_varint(payload, offset)[0]
+                elif state == 1 and packet_id == 0x00:
+                    status = {
+                        "version": {"name": "OProxy stand-in", "protocol": MinecraftProtocol.PROTOCOL_VERSION},
+                        "players": {"max": 114514, "online": 0},
+                        "description": {"text": self.description},
+                    }
+                    sock.sendall(MinecraftProtocol.packet(0x00, MinecraftProtocol.pack_string(json.dumps(status))))
+                elif state == 1 and packet_id == 0x01:
+                    sock.sendall(MinecraftProtocol.packet(0x01, payload))
+                    return
+                elif state == 2 and packet_id == 0x00:
+                    name = MinecraftProtocol.unpack_string(payload)[0]
+                    if self.names is not None and name not in self.names:
+                        # Login start: refuse politely, like a whitelisted server would
+                        reason = json.dumps({"text": "You are not whitelisted on this server"})
+                        sock.sendall(MinecraftProtocol.packet(0x00, MinecraftProtocol.pack_string(reason)))
+                        return
+                    uuid = hashlib.md5(f"OfflinePlayer:{name}".encode()).digest()
+                    sock.sendall(MinecraftProtocol.packet(0x02, uuid + MinecraftProtocol.pack_string(name)
+                                                          + MinecraftProtocol.pack_varint(0)))
+                    while data := sock.recv(65536):  # Play state stands in as a raw echo
+                        sock.sendall(data)
+                    return
+                else:
+                    return
+        except (ConnectionError, OSError, ValueError, IndexError):
+            pass
+
+    def start(self):
+        """Start serving in a background thread and return the port."""
+        import socketserver
+        owner = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                owner.handle(self.request)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+            request_queue_size = 1024  # Load tests connect in bursts, the default backlog of 5 drops them
+
+        self.server = Server((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @classmethod
+    def serve_config(cls, config_path: str = 'ZBProxy.json'):
+        """Serve every Listen port of a ZBProxy.json until killed."""
+        with open(config_path) as file:
+            services = json.load(file)['Services']
+        for service in services:
+            cls(host='0.0.0.0', port=service['Listen'], description=service['Name']).start()
+        print(f"Stand-in upstream serving {len(services)} ports")
+        while True:
+            time.sleep(3600)
+
+
+@functools.cache
+def check_environment():
+    """Check for root and Ubuntu Linux, once per process."""
+    # Running check
+    if os.geteuid() != 0:
+        print("This script must be run as root!")
+        sys.exit(1)
+    else:
+        print("Running as root.")
+    # Checking if the system is Ubuntu Linux
+    if not (('linux' in platform.system().lower()) and ('ubuntu' in platform.version().lower())):
+        print("This script is only for Ubuntu Linux")
+        exit()
+    print("System is Ubuntu Linux")
+    return True
+
+
+def self_command():
+    """Return the command line that starts this program, for the processes it spawns of itself."""
+    if "__compiled__" in globals():  # Nuitka build, the binary is the program
+        return [sys.argv[0]]
+    return [sys.executable, os.path.abspath(__file__)]
+
 class SystemControl:
     """Class to handle system-related operations like running commands and managing packages."""
     
     def __init__(self) -> None:
         """Initialize SystemControl object."""
-        # Running check
-        if os.geteuid() != 0:
-            print("This script must be run as root!")
-            sys.exit(1)
-        else:
-            print("Running as root.")
-        # Checking if the system is Ubuntu Linux
-        if not (('linux' in platform.system().lower()) and ('ubuntu' in platform.version().lower())):
-            print("This script is only for Ubuntu Linux")
-            exit()
-        print("System is Ubuntu Linux")
+        check_environment()
 
     def run_command(self, command: str):
         """Run a shell command and capture its output."""
@@ -55,10 +1510,40 @@ class SystemControl:
             print(f"Command '{command}' failed with return code {e.returncode}: {e.stderr}")
             return e.stderr, e.returncode
 
-    def install_package(self, package_name: str):
-        """Install a package using apt."""
-        print(f"Installing package: {package_name}")
-        stdout, returncode = self.run_command(f"sudo apt install --yes {package_name}")
+    DPKG_STATUS = '/var/lib/dpkg/status'
+    # Installed package names, shared by every SystemControl and keyed by the status file mtime
+    _package_index = None
+    _package_index_mtime = None
+
+    @classmethod
+    def installed_packages(cls):
+        """Return the set of installed packages, re-read only when dpkg's status file changes."""
+        try:
+            mtime = os.stat(cls.DPKG_STATUS).st_mtime_ns
+        except OSError:
+            return set()
+        if cls._package_index is None or cls._package_index_mtime != mtime:
+            index = set()
+            package = None
+            with open(cls.DPKG_STATUS, 'r', errors='replace') as file:
+                for line in file:
+                    if line.startswith('Package: '):
+                        package = line[len('Package: '):].strip()
+                    elif line.startswith('Status: ') and package and line.split()[-1] == 'installed':
+                        index.add(package)
+            cls._package_index = index
+            cls._package_index_mtime = mtime
+        return cls._package_index
+
+    def install_package(self, *package_names: str):
+        """Install the missing packages using apt, in a single transaction."""
+        installed = self.installed_packages()
+        missing = [name for name in package_names if name not in installed]
+        if not missing:
+            print(f"Package already installed: {' '.join(package_names)}")
+            return ''
+        print(f"Installing package: {' '.join(missing)}")
+        stdout, returncode = self.run_command(f"sudo apt install --yes {' '.join(missing)}")
         return stdout
 
     def uninstall_package(self, package_name: str):
@@ -79,6 +1564,759 @@ class SystemControl:
         stdout, returncode = self.run_command("sudo apt upgrade --yes")
         return stdout
 
+class FirewallReconciler:
+    """Class to keep ufw's rules in step with the Listen ports of ZBProxy.json, applied as one batch.
+
+    Rules OProxy adds carry a comment, only those are ever removed.
+    """
+
+    COMMENT = 'OProxy'
+    RULE = re.compile(r"^ufw allow (\d+)/tcp(?: comment '(.*)')?$")
+
+    def __init__(self, system_control: SystemControl, zbproxy_config) -> None:
+        """Initialize FirewallReconciler object."""
+        self.system_control = system_control
+        self.zbproxy_config = zbproxy_config
+
+    def current_rules(self):
+        """Return the allowed TCP ports and their comments, from one ufw call.
+
+        `ufw show added` lists the rules even while ufw is inactive, unlike `ufw status`.
+        """
+        stdout, returncode = self.system_control.run_command('ufw show added')
+        rules = {}
+        for line in stdout.splitlines():
+            match = self.RULE.match(line.strip())
+            if match:
+                rules[int(match.group(1))] = match.group(2) or ''
+        return rules
+
+    def desired_ports(self):
+        """Return the Listen ports of every configured service."""
+        config = self.zbproxy_config.read_json() or {}
+        return {int(service["Listen"]) for service in config.get("Services", [])}
+
+    def plan(self):
+        """Return the ports to open and to close."""
+        rules = self.current_rules()
+        desired = self.desired_ports()
+        to_open = sorted(desired - set(rules))
+        to_close = sorted(port for port, comment in rules.items() if comment == self.COMMENT and port not in desired)
+        return to_open, to_close
+
+    def reconcile(self, dry_run: bool = False):
+        """Apply the plan with a single shell call, or only print it with dry_run.
+
+        The call stops at the first command ufw refuses, and the result then has "applied" False and the "error".
+        """
+        to_open, to_close = self.plan()
+        commands = [f"ufw allow {port}/tcp comment '{self.COMMENT}'" for port in to_open]
+        commands += [f"ufw delete allow {port}/tcp" for port in to_close]
+        if not commands:
+            print("Firewall rules are up to date")
+        for command in commands:
+            print(f"{'Would run' if dry_run else 'Plan'}: {command}")
+        if commands and not dry_run:
+            output, returncode = self.system_control.run_command(' && '.join(commands))
+            if returncode != 0:
+                print("Firewall sync failed, the rules after the failed command were not applied")
+                return {"open": to_open, "close": to_close, "applied": False, "error": output.strip() or f"ufw exited with {returncode}"}
+        return {"open": to_open, "close": to_close, "applied": bool(commands) and not dry_run}
+
+class NetworkTuning:
+    """Class to manage OProxy's sysctl profile for proxy/transit hosts, as one drop-in that records what it replaced.
+
+    The values before the first apply are kept as "# prior:" comments in the drop-in itself, so revert needs no other state.
+    Everything is read and written below root, which only differs from / for tests.
+    """
+
+    DROP_IN = 'etc/sysctl.d/90-oproxy.conf'
+    PRIOR = re.compile(r'^# prior: (\S+) = (.*)$')
+    # Keys that only exist once their module is loaded, "-" has sysctl skip them instead of failing
+    OPTIONAL = ('net.netfilter.nf_conntrack_max',)
+
+    def __init__(self, root: str = '/', system_control: 'SystemControl' = None) -> None:
+        """Initialize NetworkTuning object."""
+        self.root = root
+        self.system_control = system_control  # Only needed to load tcp_bbr
+        self.drop_in = os.path.join(root, self.DROP_IN)
+
+    def proc_path(self, key: str):
+        return os.path.join(self.root, 'proc/sys', key.replace('.', '/'))
+
+    def read(self, key: str):
+        """Live value of a sysctl, None if the kernel does not have it."""
+        try:
+            with open(self.proc_path(key)) as file:
+                return ' '.join(file.read().split())  # The kernel separates multi-value keys with tabs
+        except OSError:
+            return None
+
+    def write(self, key: str, value: str):
+        """Set a sysctl live, returns False if the kernel refused it."""
+        try:
+            with open(self.proc_path(key), 'w') as file:
+                file.write(value)
+            return True
+        except OSError as e:
+            print(f"Could not set {key} = {value}: {e}")
+            return False
+
+    def memory_bytes(self):
+        try:
+            with open(os.path.join(self.root, 'proc/meminfo')) as file:
+                return int(next(line for line in file if line.startswith('MemTotal:')).split()[1]) * 1024
+        except (OSError, StopIteration, ValueError):
+            return 1 << 30
+
+    def profile(self, load_modules: bool = False):
+        """The sysctls to set, buffers and conntrack sized to the host's memory."""
+        memory = self.memory_bytes()
+        buffer_max = 1 << max(22, min(26, (memory // 128).bit_length() - 1))  # 4 MiB to 64 MiB
+        settings = {
+            "net.core.default_qdisc": "fq",
+            "net.ipv4.tcp_congestion_control": "bbr",
+            "net.ipv4.tcp_fastopen": "3",  # Client and server
+            "net.core.somaxconn": "65535",
+            "net.ipv4.tcp_max_syn_backlog": "65535",
+            "net.core.netdev_max_backlog": "16384",
+            "net.core.rmem_max": str(buffer_max),
+            "net.core.wmem_max": str(buffer_max),
+            "net.ipv4.tcp_rmem": f"4096 131072 {buffer_max}",
+            "net.ipv4.tcp_wmem": f"4096 65536 {buffer_max}",
+            "net.ipv4.ip_local_port_range": "10240 65535",
+            "net.netfilter.nf_conntrack_max": str(max(65536, min(2097152, memory // 4096))),
+        }
+        available = self.read('net.ipv4.tcp_available_congestion_control')
+        if available is not None and 'bbr' not in available.split() and load_modules and self.root == '/':
+            (self.system_control or SystemControl()).run_command('sudo modprobe tcp_bbr')
+            available = self.read('net.ipv4.tcp_available_congestion_control')
+        if available is not None and 'bbr' not in available.split():
+            print("BBR is not available on this kernel, keeping the current congestion control")
+            del settings["net.ipv4.tcp_congestion_control"]
+        return settings
+
+    def priors(self):
+        """The values the drop-in replaced, from its comments."""
+        if not os.path.exists(self.drop_in):
+            return {}
+        with open(self.drop_in) as file:
+            return {match[1]: match[2] for line in file if (match := self.PRIOR.match(line.rstrip('\n')))}
+
+    def apply(self):
+        """Write the drop-in and set its values live, recording the values found before the first apply."""
+        settings = self.profile(load_modules=True)
+        priors = self.priors()
+        for key in settings:
+            current = self.read(key)
+            if key not in priors and current is not None:
+                priors[key] = current
+        lines = ["# Managed by OProxy, `OProxy tune revert` restores the prior values and removes this file"]
+        lines += [f"# prior: {key} = {value}" for key, value in priors.items()]
+        lines += [f"{'-' if key in self.OPTIONAL else ''}{key} = {value}" for key, value in settings.items()]
+        os.makedirs(os.path.dirname(self.drop_in), exist_ok=True)
+        HandleFile(self.drop_in).write_file('\n'.join(lines) + '\n')
+        applied = {}
+        for key, value in settings.items():
+            if self.read(key) is None:
+                print(f"{key} is not available, left to the drop-in")
+                continue
+            applied[key] = self.write(key, value)
+        print(f"Applied {sum(applied.values())} of {len(settings)} settings, persisted in {self.drop_in}")
+        return applied
+
+    def revert(self):
+        """Set the recorded prior values back and remove the drop-in."""
+        if not os.path.exists(self.drop_in):
+            print("No OProxy tuning applied")
+            return {}
+        restored = {key: self.write(key, value) for key, value in self.priors().items() if self.read(key) is not None}
+        os.remove(self.drop_in)
+        print(f"Restored {sum(restored.values())} settings, removed {self.drop_in}")
+        return restored
+
+    def show(self):
+        """Each setting of the profile: its live value, the profile's and the prior one."""
+        priors = self.priors()
+        return [{"key": key, "current": self.read(key), "profile": value, "prior": priors.get(key),
+                 "applied": self.read(key) == value}
+                for key, value in self.profile().items()]
+
+
+class ZBProxyLog:
+    """Class to parse the lines ZBProxy logs to syslog/journald into events."""
+
+    IDENTIFIER = 'zbproxy'  # SyslogIdentifier of the unit setup writes
+    SYSLOG_FILES = ('/var/log/syslog', '/var/log/messages')
+    SYSLOG_LINE = re.compile(r'^(?P<time>\d{4}-\d\d-\d\dT\S+|\w{3} [ \d]\d \d\d:\d\d:\d\d) \S+ '
+                             r'(?P<tag>[^\s\[:]+)(?:\[\d+\])?: (?P<message>.*)$')
+    SERVICE = re.compile(r'\bService (?P<service>[^\s:\]]+)')
+    ADDRESS = re.compile(r'(?P<address>\[[0-9a-fA-F:.]+\]:\d+|\b\d{1,3}(?:\.\d{1,3}){3}:\d+)')
+    # ZBProxy's wording of each event, first match wins; adjust here if a release rewords them.
+    # The lowercase keywords are checked first, so most patterns never run on a line.
+    EVENTS = [
+        ('rejected', ('reject',), re.compile(r'(?i)\breject\w*\b.*?:\s*(?P<player>\w{1,16})\s*$')),
+        ('login', ('logged in',), re.compile(r'(?i)\blogged in\b:?\s*(?P<player>\w{1,16})')),
+        ('error', ('error', 'failed', 'panic'), re.compile(r'(?i)\b(?:error|failed|panic)\b')),
+        ('disconnect', ('disconnected', 'connection closed'), re.compile(r'(?i)\b(?:disconnected|connection closed)\b')),
+        ('connection', ('connection',), re.compile(r'(?i)\bnew\b.*\bconnection\b')),
+    ]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse_time(text: str):
+        """Turn an RFC 3339 or traditional (yearless) syslog timestamp into epoch seconds."""
+        import datetime
+        if text[:4].isdigit():
+            return datetime.datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp()
+        now = datetime.datetime.now()
+        stamp = datetime.datetime.strptime(f"{now.year} {text}", "%Y %b %d %H:%M:%S")
+        if stamp > now + datetime.timedelta(days=1):  # December lines read in January
+            stamp = stamp.replace(year=now.year - 1)
+        return stamp.timestamp()
+
+    @classmethod
+    def parse_message(cls, message: str, timestamp: float):
+        """Classify one ZBProxy message, None when it is no event."""
+        lowered = message.lower()
+        for event, keywords, pattern in cls.EVENTS:
+            if not any(keyword in lowered for keyword in keywords):
+                continue
+            match = pattern.search(message)
+            if match:
+                service = cls.SERVICE.search(message)
+                address = cls.ADDRESS.search(message)
+                return {
+                    'time': timestamp,
+                    'event': event,
+                    'service': service['service'] if service else '',
+                    'player': match.groupdict().get('player') or '',
+                    'address': address['address'] if address else '',
+                }
+        return None
+
+    @classmethod
+    def parse_syslog(cls, line: str, identifier: str = IDENTIFIER):
+        """Parse a syslog file line, None unless it is a ZBProxy event."""
+        match = cls.SYSLOG_LINE.match(line)
+        if not match or match['tag'] != identifier:
+            return None
+        return cls.parse_message(match['message'], cls.parse_time(match['time']))
+
+    @classmethod
+    def parse_journal(cls, line: str):
+        """Parse a `journalctl -o json` line, returns (event or None, cursor)."""
+        entry = json.loads(line)
+        message = entry.get('MESSAGE', '')
+        if isinstance(message, list):  # journald sends non-UTF-8 messages as byte arrays
+            message = bytes(message).decode('utf-8', 'replace')
+        return cls.parse_message(message, int(entry['__REALTIME_TIMESTAMP']) / 1e6), entry.get('__CURSOR')
+
+
+class LogFollower:
+    """Class to read the lines added to a log file since the last call, across rotation, without rescanning."""
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path: str, state: dict = None, marker: bytes = None) -> None:
+        """Initialize LogFollower object, reading from the end of the file unless state says otherwise."""
+        self.path = path
+        self.state = state if state is not None else {}  # inode and offset reached, for callers to persist
+        self.marker = marker  # Lines without it are skipped before they are decoded
+        if not self.state:
+            try:
+                st = os.stat(path)
+                self.state.update(inode=st.st_ino, offset=st.st_size)
+            except FileNotFoundError:
+                self.state.update(inode=None, offset=0)
+
+    def read_from(self, path: str, offset: int):
+        """Yield the complete lines of path after offset, tracking the offset in state."""
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            tail = b''
+            while chunk := file.read(self.CHUNK_SIZE):
+                lines = (tail + chunk).split(b'\n')
+                tail = lines.pop()  # Not finished yet, read again next time
+                for line in lines:
+                    offset += len(line) + 1
+                    if self.marker is None or self.marker in line:
+                        self.state['offset'] = offset
+                        yield line.decode('utf-8', 'replace')
+                self.state['offset'] = offset
+
+    def read(self):
+        """Yield the lines added since the last read."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self.state.get('inode') not in (None, st.st_ino):
+            # Rotated: finish the old file under its new name, then start the new one from the top
+            rotated = f'{self.path}.1'
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(rotated).st_ino == self.state['inode']:
+                    yield from self.read_from(rotated, self.state['offset'])
+            self.state.update(inode=st.st_ino, offset=0)
+        elif st.st_size < self.state.get('offset', 0):  # Truncated in place
+            self.state['offset'] = 0
+        self.state['inode'] = st.st_ino
+        yield from self.read_from(self.path, self.state['offset'])
+
+
+class ZBProxyMetrics:
+    """Class to count ZBProxy log events per service and group, with session duration histograms."""
+
+    BUCKETS = (1, 5, 30, 60, 300, 900, 1800, 3600, 7200, 14400)
+    MAX_OPEN_SESSIONS = 100000  # Logins waiting for their disconnect; the oldest are dropped past this
+    MAX_SERVICES = 256  # Services not in ZBProxy.json beyond this are counted as "other"
+
+    def __init__(self, config: dict = None) -> None:
+        """Initialize ZBProxyMetrics object, config (ZBProxy.json) names the services and their whitelist groups."""
+        self.lock = threading.Lock()
+        self.groups = {}
+        for service in (config or {}).get('Services', []):
+            name_access = service.get('Minecraft', {}).get('NameAccess', {})
+            self.groups[service['Name']] = ','.join(name_access.get('ListTags', [])) if name_access.get('Mode') else ''
+        self.counters = collections.Counter()  # (metric, service, group) -> count
+        self.histograms = {}  # service -> [bucket counts..., +Inf count, sum, count]
+        self.sessions = collections.OrderedDict()  # (service, address) -> login time
+        self.lines = 0
+        self.dropped_sessions = 0
+
+    def service_label(self, service: str):
+        """Keep label cardinality bounded."""
+        if service in self.groups or len(self.groups) < self.MAX_SERVICES:
+            self.groups.setdefault(service, '')
+            return service
+        return 'other'
+
+    def observe(self, event: dict):
+        """Count one event."""
+        with self.lock:
+            service = self.service_label(event['service'])
+            group = self.groups.get(service, '')
+            self.counters[(event['event'], service, group)] += 1
+            key = (service, event['address'])
+            if event['event'] == 'login':
+                self.sessions[key] = event['time']
+                self.sessions.move_to_end(key)
+                if len(self.sessions) > self.MAX_OPEN_SESSIONS:
+                    self.sessions.popitem(last=False)
+                    self.dropped_sessions += 1
+            elif event['event'] == 'disconnect' and key in self.sessions:
+                duration = max(event['time'] - self.sessions.pop(key), 0)
+                # One count per bucket, one past the last bucket, then the sum and the count
+                histogram = self.histograms.setdefault(service, [0] * (len(self.BUCKETS) + 3))
+                histogram[bisect.bisect_left(self.BUCKETS, duration)] += 1
+                histogram[-2] += duration
+                histogram[-1] += 1
+
+    EVENT_METRICS = {
+        'connection': ('oproxy_zbproxy_connections_total', 'Inbound connections'),
+        'login': ('oproxy_zbproxy_logins_total', 'Players logged in'),
+        'disconnect': ('oproxy_zbproxy_disconnects_total', 'Connections closed'),
+        'rejected': ('oproxy_zbproxy_rejected_total', 'Logins rejected by access control'),
+        'error': ('oproxy_zbproxy_errors_total', 'Errors logged'),
+    }
+
+    def render(self):
+        """Render the Prometheus text exposition format."""
+        def labels(**values):
+            escaped = {key: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for key, value in values.items()}
+            return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+        out = []
+        with self.lock:
+            for event, (metric, help_text) in self.EVENT_METRICS.items():
+                out += [f'# HELP {metric} {help_text}.', f'# TYPE {metric} counter']
+                for (counted, service, group), value in sorted(self.counters.items()):
+                    if counted == event:
+                        out.append(f'{metric}{labels(service=service, group=group)} {value}')
+            metric = 'oproxy_zbproxy_session_duration_seconds'
+            out += [f'# HELP {metric} Time from login to disconnect.', f'# TYPE {metric} histogram']
+            for service, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), histogram):
+                    cumulative += count
+                    out.append(f'{metric}_bucket{labels(service=service, le=str(bound))} {cumulative}')
+                out.append(f'{metric}_sum{labels(service=service)} {histogram[-2]:g}')
+                out.append(f'{metric}_count{labels(service=service)} {histogram[-1]}')
+            out += ['# HELP oproxy_zbproxy_open_sessions Logins still waiting for their disconnect.',
+                    '# TYPE oproxy_zbproxy_open_sessions gauge', f'oproxy_zbproxy_open_sessions {len(self.sessions)}',
+                    '# HELP oproxy_exporter_lines_total ZBProxy log lines read.',
+                    '# TYPE oproxy_exporter_lines_total counter', f'oproxy_exporter_lines_total {self.lines}',
+                    '# HELP oproxy_exporter_dropped_sessions_total Open sessions dropped to bound memory.',
+                    '# TYPE oproxy_exporter_dropped_sessions_total counter',
+                    f'oproxy_exporter_dropped_sessions_total {self.dropped_sessions}']
+        return '\n'.join(out) + '\n'
+
+
+class MetricsExporter:
+    """Class to follow ZBProxy's log stream and serve the counts on /metrics."""
+
+    def __init__(self, metrics: ZBProxyMetrics, source: str = None, identifier: str = ZBProxyLog.IDENTIFIER,
+                 poll_interval: float = 1, from_start: bool = False) -> None:
+        """Initialize MetricsExporter object, source is a syslog file or "journald" (default: the first syslog file found)."""
+        self.metrics = metrics
+        self.source = source or next((path for path in ZBProxyLog.SYSLOG_FILES if os.path.exists(path)), 'journald')
+        self.identifier = identifier
+        self.poll_interval = poll_interval
+        state = {"inode": None, "offset": 0} if from_start else None
+        self.follower = None if self.source == 'journald' else LogFollower(self.source, state, f' {identifier}'.encode())
+        self.from_start = from_start
+        self.cursor = None
+
+    def poll(self):
+        """Count the lines the syslog file gained since the last poll."""
+        for line in self.follower.read():
+            event = ZBProxyLog.parse_syslog(line, self.identifier)
+            self.metrics.lines += 1
+            if event:
+                self.metrics.observe(event)
+
+    def follow_journal(self):
+        """Count journald entries as they arrive, resuming from the last cursor if journalctl restarts."""
+        while True:
+            command = ['journalctl', '--follow', '--output=json', f'--identifier={self.identifier}']
+            command += [f'--after-cursor={self.cursor}'] if self.cursor else ([] if self.from_start else ['--lines=0'])
+            with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+                for line in process.stdout:
+                    event, self.cursor = ZBProxyLog.parse_journal(line)
+                    self.metrics.lines += 1
+                    if event:
+                        self.metrics.observe(event)
+            time.sleep(self.poll_interval)
+
+    def start_endpoint(self, host: str = '127.0.0.1', port: int = 9464):
+        """Serve /metrics from a background thread, returns the base URL."""
+        def metrics(request):
+            return 200, {'Content-Type': 'text/plain; version=0.0.4'}, self.metrics.render().encode()
+
+        return HttpEndpoint({'/metrics': metrics}, host, port).start()
+
+    def serve(self, host: str = '127.0.0.1', port: int = 9464):
+        """Serve /metrics and follow the log until killed."""
+        base_url = self.start_endpoint(host, port)
+        print(f"Following {self.source}, serving {base_url}/metrics")
+        if self.follower is None:
+            self.follow_journal()
+        while True:
+            self.poll()
+            time.sleep(self.poll_interval)
+
+
+class LogIndex:
+    """Class to keep an incremental on-disk index of ZBProxy's logins and rejections, by player, source IP and service."""
+
+    DIRECTORY = os.path.join(STATE_DIR, 'logs')
+    SOURCES = '/var/log/syslog*'
+    RECORD = struct.Struct('<IIBHII')  # time, duration, event, service, player, ip
+    PAIR = struct.Struct('<II')  # key, record number; posting segments are sorted runs of these
+    EVENTS = {'login': 1, 'rejected': 2}
+    OPEN = 0xFFFFFFFF  # Duration of a session whose disconnect has not been seen
+    FINGERPRINT_BYTES = 256  # Identifies a log file across rename and compression by logrotate
+    FLUSH_RECORDS = 65536
+    MAX_POSTINGS = 1 << 20  # Pairs held in memory before they are written out as a segment
+    MAX_SEGMENTS = 8  # Compacted into one past this
+    MAX_OPEN_SESSIONS = 100000
+    RETENTION_DAYS = 90  # Of the per-day rejection counts
+
+    def __init__(self, directory: str = DIRECTORY, identifier: str = ZBProxyLog.IDENTIFIER) -> None:
+        """Initialize LogIndex object."""
+        self.directory = directory
+        self.identifier = identifier
+        self.marker = f' {identifier}'.encode()
+        self.state_file = HandleJsonFile(os.path.join(directory, 'state.json'))
+        self.strings_file = HandleJsonFile(os.path.join(directory, 'strings.json'))
+        self.aggregates_file = HandleJsonFile(os.path.join(directory, 'aggregates.json'))
+        self.events_path = os.path.join(directory, 'events.bin')
+
+    def load(self, index_file: 'HandleJsonFile', default: dict):
+        """Read one of the index's JSON files."""
+        return (index_file.read_json() if index_file.file_exists() else None) or default
+
+    def segment_path(self, dimension: str, number: int):
+        return os.path.join(self.directory, f'{dimension}-{number}.idx')
+
+    @staticmethod
+    def sources(pattern: str):
+        """Log files matching pattern, oldest rotation first."""
+        import glob
+
+        def age(path):
+            suffix = path.rsplit('/', 1)[-1].split('.')
+            return -int(suffix[1]) if len(suffix) > 1 and suffix[1].isdigit() else 0
+        return sorted((path for path in glob.glob(pattern) if os.path.isfile(path)), key=age)
+
+    def fingerprint(self, path: str):
+        """Hash of the first bytes, the same whatever logrotate renamed or compressed the file to."""
+        import gzip
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as file:
+            head = file.read(self.FINGERPRINT_BYTES)
+        return hashlib.sha1(head).hexdigest() if len(head) == self.FINGERPRINT_BYTES else None
+
+    @contextlib.contextmanager
+    def contents(self, path: str):
+        """Map a log file, or decompress a rotated one, for scanning."""
+        import mmap
+        if path.endswith('.gz'):
+            import gzip
+            with gzip.open(path, 'rb') as file:
+                yield file.read()
+            return
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    def scan(self, data, start: int, end: int):
+        """Yield the lines of data[start:end] holding the marker, jumping from one marker to the next."""
+        position = start
+        while (hit := data.find(self.marker, position, end)) >= 0:
+            line_start = data.rfind(b'\n', position, hit) + 1 or position
+            line_end = data.find(b'\n', hit, end)
+            if line_end < 0:
+                return
+            yield data[line_start:line_end]
+            position = line_end + 1
+
+    def write_segment(self, state: dict, dimension: str, pairs: list):
+        """Write the pairs collected for a dimension as a new sorted segment."""
+        if not pairs:
+            return
+        pairs.sort()
+        number = state["segments"][dimension]
+        with open(self.segment_path(dimension, number), 'wb') as file:
+            file.write(b''.join(self.PAIR.pack(*pair) for pair in pairs))
+        state["segments"][dimension] = number + 1
+        pairs.clear()
+
+    def compact(self, state: dict, dimension: str):
+        """Merge a dimension's segments into one once there are too many."""
+        count = state["segments"][dimension]
+        if count <= self.MAX_SEGMENTS:
+            return
+        pairs = []
+        for number in range(count):
+            with open(self.segment_path(dimension, number), 'rb') as file:
+                pairs.extend(self.PAIR.iter_unpack(file.read()))
+        state["segments"][dimension] = 0
+        self.write_segment(state, dimension, pairs)
+        for number in range(1, count):
+            os.remove(self.segment_path(dimension, number))
+
+    def index(self, pattern: str = SOURCES):
+        """Index what the log files gained since the last run."""
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        with self.state_file.transaction() as state:  # Also keeps two runs from indexing the same lines
+            state = state or {"files": {}, "open": {}, "segments": {"player": 0, "ip": 0}, "events": 0}
+            strings = self.load(self.strings_file, {"service": [], "player": [], "ip": []})
+            aggregates = self.load(self.aggregates_file, {"rejected": {}, "last_login": {}})
+            ids = {dimension: {value: i for i, value in enumerate(values)} for dimension, values in strings.items()}
+
+            def intern(dimension, value):
+                if value not in ids[dimension]:
+                    ids[dimension][value] = len(strings[dimension])
+                    strings[dimension].append(value)
+                return ids[dimension][value]
+
+            open_sessions = collections.OrderedDict((key, tuple(value)) for key, value in state["open"].items())
+            fd = os.open(self.events_path, os.O_RDWR | os.O_CREAT, 0o644)
+            with open(fd, 'r+b') as events:
+                if state.get("events") is not None:  # Not in an index from before it was recorded
+                    # Records past it were appended by a run that died before saving its state, which indexes their lines again
+                    events.truncate(state["events"] * self.RECORD.size)
+                record_count = events.seek(0, os.SEEK_END) // self.RECORD.size
+                pending = []  # New records, with their durations still changing
+                durations = {}  # Record number -> duration, for records already on disk
+                postings = {"player": [], "ip": []}
+                summary = {"files": 0, "bytes": 0, "events": 0}
+
+                def flush():
+                    events.seek(0, os.SEEK_END)
+                    events.write(b''.join(self.RECORD.pack(*record) for record in pending))
+                    pending.clear()
+
+                for path in self.sources(pattern):
+                    fingerprint = self.fingerprint(path)
+                    if fingerprint is None or (path.endswith('.gz') and fingerprint in state["files"]):
+                        continue  # Too short to identify yet, or compressed after it was indexed in full
+                    offset = state["files"].get(fingerprint, 0)
+                    with self.contents(path) as data:
+                        end = data.rfind(b'\n', offset) + 1
+                        if end <= offset:
+                            continue
+                        summary["files"] += 1
+                        summary["bytes"] += end - offset
+                        for line in self.scan(data, offset, end):
+                            event = ZBProxyLog.parse_syslog(line.decode('utf-8', 'replace'), self.identifier)
+                            if event is None:
+                                continue
+                            session = f"{event['service']}|{event['address']}"
+                            if event['event'] == 'disconnect' and session in open_sessions:
+                                number, login_time = open_sessions.pop(session)
+                                duration = max(int(event['time'] - login_time), 0)
+                                if number >= record_count:
+                                    pending[number - record_count][1] = duration
+                                else:
+                                    durations[number] = duration
+                                continue
+                            if event['event'] not in self.EVENTS or not event['player']:
+                                continue
+                            ip = event['address'].rsplit(':', 1)[0].strip('[]')
+                            number = record_count + len(pending)
+                            record = [int(event['time']), self.OPEN if event['event'] == 'login' else 0,
+                                      self.EVENTS[event['event']], intern("service", event['service']),
+                                      intern("player", event['player']), intern("ip", ip)]
+                            pending.append(record)
+                            postings["player"].append((record[4], number))
+                            postings["ip"].append((record[5], number))
+                            summary["events"] += 1
+                            if event['event'] == 'login':
+                                open_sessions[session] = (number, event['time'])
+                                if len(open_sessions) > self.MAX_OPEN_SESSIONS:
+                                    open_sessions.popitem(last=False)
+                                last_login = aggregates["last_login"].setdefault(event['service'], {})
+                                last_login[event['player']] = max(last_login.get(event['player'], 0), int(event['time']))
+                            else:
+                                day = time.strftime('%Y-%m-%d', time.gmtime(event['time']))
+                                counts = aggregates["rejected"].setdefault(day, {}).setdefault(event['service'], {})
+                                counts[event['player']] = counts.get(event['player'], 0) + 1
+                            if len(pending) >= self.FLUSH_RECORDS:
+                                flush()
+                                record_count = events.tell() // self.RECORD.size
+                            for dimension, pairs in postings.items():
+                                if len(pairs) >= self.MAX_POSTINGS:
+                                    self.write_segment(state, dimension, pairs)
+                    state["files"][fingerprint] = end
+                flush()
+                for number, duration in durations.items():  # Sessions that ended after their login was written
+                    events.seek(number * self.RECORD.size + 4)
+                    events.write(struct.pack('<I', duration))
+                state["events"] = events.seek(0, os.SEEK_END) // self.RECORD.size
+            for dimension, pairs in postings.items():
+                self.write_segment(state, dimension, pairs)
+                self.compact(state, dimension)
+            cutoff = time.strftime('%Y-%m-%d', time.gmtime(time.time() - self.RETENTION_DAYS * 86400))
+            aggregates["rejected"] = {day: counts for day, counts in aggregates["rejected"].items() if day >= cutoff}
+            state["open"] = {key: list(value) for key, value in open_sessions.items()}
+            self.strings_file.write_json(strings)
+            self.aggregates_file.write_json(aggregates)
+            self.state_file.write_json(state)  # Written when the transaction ends
+        summary["seconds"] = round(time.perf_counter() - started, 3)
+        return summary
+
+    def service_load(self, days: float = 7):
+        """Logins per service in the last days."""
+        if not os.path.exists(self.events_path):
+            return {}
+        strings = self.load(self.strings_file, {"service": []})
+        cutoff = time.time() - days * 86400
+        counts = collections.Counter()
+        with open(self.events_path, 'rb') as file:
+            for started, _, event, service, _, _ in self.RECORD.iter_unpack(file.read()):
+                if event == self.EVENTS['login'] and started >= cutoff:
+                    counts[service] += 1
+        return {strings["service"][service]: count for service, count in counts.items()}
+
+    def lookup(self, dimension: str, key: int):
+        """Record numbers of a key, binary searched in every segment of the dimension."""
+        import mmap
+        state = self.load(self.state_file, {"segments": {dimension: 0}})
+        numbers = []
+        for segment in range(state["segments"][dimension]):
+            with open(self.segment_path(dimension, segment), 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    low, high = 0, len(data) // self.PAIR.size
+                    while low < high:
+                        middle = (low + high) // 2
+                        if self.PAIR.unpack_from(data, middle * self.PAIR.size)[0] < key:
+                            low = middle + 1
+                        else:
+                            high = middle
+                    for position in range(low * self.PAIR.size, len(data), self.PAIR.size):
+                        found, number = self.PAIR.unpack_from(data, position)
+                        if found != key:
+                            break
+                        numbers.append(number)
+        return numbers
+
+    def sessions(self, player: str = None, ip: str = None, service: str = None, days: float = 7):
+        """Sessions of a player and/or source IP, newest first."""
+        import mmap
+        strings = self.load(self.strings_file, {"service": [], "player": [], "ip": []})
+        candidates = None
+        for dimension, value in (("player", player), ("ip", ip)):
+            if value is None:
+                continue
+            if value not in strings[dimension]:
+                return []
+            numbers = set(self.lookup(dimension, strings[dimension].index(value)))
+            candidates = numbers if candidates is None else candidates & numbers
+        if not candidates or not os.path.exists(self.events_path):
+            return []
+        cutoff = time.time() - days * 86400
+        found = []
+        with open(self.events_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for number in sorted(candidates):
+                started, duration, event, service_id, player_id, ip_id = self.RECORD.unpack_from(data, number * self.RECORD.size)
+                if event != self.EVENTS['login'] or started < cutoff:
+                    continue
+                if service is not None and strings["service"][service_id] != service:
+                    continue
+                found.append({
+                    "start": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+                    "service": strings["service"][service_id],
+                    "player": strings["player"][player_id],
+                    "ip": strings["ip"][ip_id],
+                    "duration_seconds": None if duration == self.OPEN else duration,
+                })
+        return found[::-1]
+
+    @staticmethod
+    def groups(config: dict):
+        """Map each service to its whitelist groups (NameAccess ListTags), in ZBProxy.json."""
+        groups = {}
+        for service in (config or {}).get('Services', []):
+            name_access = service.get('Minecraft', {}).get('NameAccess', {})
+            groups[service['Name']] = name_access.get('ListTags', []) if name_access.get('Mode') == 'allow' else []
+        return groups
+
+    def top_rejected(self, config: dict = None, days: float = 7, top: int = 10):
+        """Most rejected names per whitelist group (or per service without one)."""
+        aggregates = self.load(self.aggregates_file, {"rejected": {}})
+        groups = self.groups(config)
+        cutoff = time.strftime('%Y-%m-%d', time.gmtime(time.time() - days * 86400))
+        totals = collections.defaultdict(collections.Counter)
+        for day, services in aggregates["rejected"].items():
+            if day < cutoff:
+                continue
+            for service, counts in services.items():
+                for group in groups.get(service) or [service]:
+                    totals[group].update(counts)
+        return {group: counter.most_common(top) for group, counter in sorted(totals.items())}
+
+    def stale(self, config: dict, days: float = 30):
+        """Whitelisted names with no login in days, per group; last_login is None if never seen."""
+        aggregates = self.load(self.aggregates_file, {"last_login": {}})
+        cutoff = time.time() - days * 86400
+        stale = {}
+        for group, names in (config or {}).get('Lists', {}).items():
+            services = [service for service, tags in self.groups(config).items() if group in tags]
+            if not services:
+                continue  # Not a whitelist, TransitServerIP for one
+            for name in names:
+                last = max((aggregates["last_login"].get(service, {}).get(name, 0) for service in services), default=0)
+                if last < cutoff:
+                    stale.setdefault(group, []).append({
+                        "name": name,
+                        "last_login": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)) if last else None,
+                    })
+        return stale
+
+
 class ExecuteFile:
     """Class to handle file execution permissions."""
     
@@ -116,10 +2354,27 @@ class HandleFile:
         return content
 
     def write_file(self, content):
-        """Write content to a file."""
+        """Write content to a file atomically: temp file, fsync, then rename over the old one."""
         print(f"Writing to file: {self.file_path}")
-        with open(self.file_path, 'w') as file:
-            file.write(content)
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(self.file_path)}.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(content)
+                file.flush()
+                # mkstemp creates 0600, keep the mode readers of the old file relied on
+                os.fchmod(file.fileno(), stat.S_IMODE(os.stat(self.file_path).st_mode) if self.file_exists() else 0o644)
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)  # Make the rename itself durable
+        finally:
+            os.close(directory_fd)
         print(f"Wrote content to {self.file_path}")
 
     def create_file(self, content=""):
@@ -183,85 +2438,610 @@ WantedBy=multi-user.target
 class HandleJsonFile(HandleFile):
     """Class to handle JSON file operations, extending HandleFile."""
     
+    # Absolute path -> (stat key, data); None until a long-running process (the agent) turns it on
+    _cache = None
+
+    @classmethod
+    def enable_cache(cls):
+        """Keep parsed files in memory, revalidated with a stat() on every read."""
+        cls._cache = {}
+
+    def stat_key(self):
+        """Identify the file's current content; every write replaces the inode."""
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def remember(self, data):
+        """Cache data just written to the file."""
+        if self._cache is not None:
+            self._cache[os.path.abspath(self.file_path)] = (self.stat_key(), data)
+
     def read_json(self):
         """Read JSON data from a file."""
+        if self._cache is not None:
+            cached = self._cache.get(os.path.abspath(self.file_path))
+            if cached and cached[0] is not None and cached[0] == self.stat_key():
+                return cached[1]  # Shared, callers that change it must write it back
         try:
             print(f"Reading JSON file: {self.file_path}")
-            return json.loads(self.read_file())
+            key = self.stat_key()
+            data = json.loads(self.read_file())
         except json.JSONDecodeError as e:
             print(f"Error reading JSON from {self.file_path}: {e}")
             return None
+        if self._cache is not None:
+            self._cache[os.path.abspath(self.file_path)] = (key, data)
+        return data
 
     def write_json(self, data):
-        """Write JSON data to a file."""
+        """Write JSON data to a file, or to the open transaction on it."""
+        key = os.path.abspath(self.file_path)
+        if key in self._transactions:
+            self._transactions[key] = data  # Written once, when the transaction ends
+            return
         try:
             print(f"Writing JSON to file: {self.file_path}")
-            self.write_file(json.dumps(data, indent=4))
+            content = json.dumps(data, indent=4)
+            with self.lock():
+                self.write_file(content)
+                self.remember(data)
             print(f"JSON data written to {self.file_path}")
         except TypeError as e:
             print(f"Error writing JSON to {self.file_path}: {e}")
+
+    # Per thread, absolute path -> data of the transactions it holds; the agent and fleet run commands on many threads
+    _held = threading.local()
+
+    @property
+    def _transactions(self):
+        if not hasattr(self._held, 'transactions'):
+            self._held.transactions = {}
+        return self._held.transactions
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive flock on the file's .lock sidecar, the file itself is replaced by every write."""
+        import fcntl
+        with open(f'{self.file_path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Lock, read once and yield the data for any number of changes, then write once if it changed."""
+        key = os.path.abspath(self.file_path)
+        if key in self._transactions:  # Nested, the outer transaction reads and writes
+            yield self._transactions[key]
+            return
+        with self.lock():
+            data = self.read_json() if self.file_exists() else None
+            snapshot = json.dumps(data, sort_keys=True)
+            if self._cache is not None:  # Change a copy, readers may be holding the cached data
+                data = json.loads(json.dumps(data))  # Not the snapshot, it has its keys sorted
+            self._transactions[key] = data
+            try:
+                yield data
+            finally:
+                data = self._transactions.pop(key)
+            if json.dumps(data, sort_keys=True) != snapshot:
+                print(f"Writing JSON to file: {self.file_path}")
+                self.write_file(json.dumps(data, indent=4))
+                self.remember(data)
+            else:
+                print(f"No changes to {self.file_path}")
             
             
             
+class ZBProxyShards:
+    """Class to run ZBProxy as N instances (ZBProxy@N units), with the services of ZBProxy.json partitioned across them."""
+
+    UNIT = 'ZBProxy@'
+    UNIT_DIR = '/etc/systemd/system'
+    NOFILE_BUDGET = 1048576  # fs.nr_open's default, shared out between the instances
+    MIN_NOFILE = 65536
+    NICE = -5
+    LOAD_DAYS = 7  # Of logins, from the log index, to balance by
+
+    def __init__(self, config_path: str = 'ZBProxy.json', system_control: 'SystemControl' = None, unit_dir: str = UNIT_DIR) -> None:
+        """Initialize ZBProxyShards object, the shards live next to config_path."""
+        self.config_path = config_path
+        self.base_dir = os.path.dirname(os.path.abspath(config_path))
+        self.state_file = HandleJsonFile(os.path.join(self.base_dir, STATE_DIR, 'shards.json'))
+        self.system_control = system_control or SystemControl()
+        self.unit_dir = unit_dir
+        self.pending_actions = {}  # Shard -> "restart", from the last write, for activate()
+
+    def state(self):
+        """The shard layout: count, loads, assignment of service names to shards; empty when not sharded."""
+        return (self.state_file.read_json() if self.state_file.file_exists() else None) or {}
+
+    def enabled(self):
+        return self.state().get("count", 0) > 0
+
+    def units(self):
+        """The systemd units ZBProxy runs as."""
+        count = self.state().get("count", 0)
+        return [f'{self.UNIT}{shard}' for shard in range(count)] if count else ['ZBProxy']
+
+    def shard_path(self, shard: int):
+        return os.path.join(self.base_dir, 'shards', str(shard), 'ZBProxy.json')
+
+    @staticmethod
+    def partition(names, count: int, loads: dict = None, assignment: dict = None):
+        """Assign service names to shards, heaviest first onto the lightest shard.
+
+        Names already in assignment stay on their shard, so adding a service never moves the others.
+        Without loads every service weighs the same, which balances by service count.
+        """
+        loads = loads or {}
+        assignment = {name: shard for name, shard in (assignment or {}).items() if name in names and shard < count}
+        totals, sizes = [0] * count, [0] * count
+        for name, shard in assignment.items():
+            totals[shard] += loads.get(name, 0) + 1
+            sizes[shard] += 1
+        for name in sorted((name for name in names if name not in assignment), key=lambda name: (-loads.get(name, 0), name)):
+            shard = min(range(count), key=lambda shard: (totals[shard], sizes[shard], shard))
+            assignment[name] = shard
+            totals[shard] += loads.get(name, 0) + 1
+            sizes[shard] += 1
+        return assignment
+
+    @staticmethod
+    def shard_config(config: dict, names):
+        """A shard's ZBProxy.json: its services, and only the lists they use."""
+        services = [service for service in config.get('Services', []) if service['Name'] in names]
+        tags = {tag for service in services for tag in DesiredConfig.list_tags(service)}
+        return {**config, "Services": services, "Lists": {tag: names for tag, names in config.get('Lists', {}).items() if tag in tags}}
+
+    def sync(self, config: dict):
+        """Write the shard configs a change of ZBProxy.json touches, new services join the lightest shard.
+
+        The instances watch their own config, so an untouched shard never notices the change.
+        """
+        state = self.state()
+        count = state.get("count", 0)
+        if not count or not config:
+            return {}
+        assignment = self.partition([service['Name'] for service in config.get('Services', [])], count,
+                                    state.get("loads"), state.get("assignment"))
+        if assignment != state.get("assignment"):
+            state["assignment"] = assignment
+            self.state_file.write_json(state)
+        actions = {}
+        for shard in range(count):
+            shard_file = HandleJsonFile(self.shard_path(shard))
+            old = shard_file.read_json() if shard_file.file_exists() else None
+            new = self.shard_config(config, {name for name, owner in assignment.items() if owner == shard})
+            if old == new:
+                continue
+            os.makedirs(os.path.dirname(shard_file.file_path), exist_ok=True)
+            shard_file.write_json(new)
+            if ProxyServer.required_action(old, new) != 'none':  # Otherwise the instance's config watcher applies it
+                actions[shard] = 'restart'
+        self.pending_actions = actions
+        return actions
+
+    def activate(self):
+        """Restart only the instances the last write changed beyond what their config watcher applies."""
+        actions, self.pending_actions = self.pending_actions, {}
+        if not actions:
+            print("No shard needs a restart")
+            return 'none'
+        for shard in sorted(actions):
+            self.system_control.run_command(f'sudo systemctl restart {self.UNIT}{shard}')
+        return 'restart'
+
+    @staticmethod
+    def cpu_sets(count: int, cpus: list):
+        """Split the CPUs into count contiguous sets, or share them round robin when there are more shards than CPUs."""
+        if count >= len(cpus):
+            return [[cpus[shard % len(cpus)]] for shard in range(count)]
+        return [cpus[len(cpus) * shard // count:len(cpus) * (shard + 1) // count] for shard in range(count)]
+
+    def unit_content(self, binary_path: str):
+        """The ZBProxy@.service template, %i is the shard number."""
+        return f"""
+[Unit]
+Description=ZBProxy shard %i
+After=network.target
+
+[Service]
+ExecStart={binary_path}
+WorkingDirectory={self.base_dir}/shards/%i
+Restart=always
+StandardOutput=syslog
+StandardError=syslog
+SyslogIdentifier={ZBProxyLog.IDENTIFIER}
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+    @staticmethod
+    def drop_in_content(cpus: list, nofile: int, nice: int):
+        """The drop-in of a ZBProxy@N unit: its own CPUs, with the same LimitNOFILE and Nice as every other instance."""
+        return f"""[Service]
+CPUAffinity={' '.join(str(cpu) for cpu in cpus)}
+LimitNOFILE={nofile}
+Nice={nice}
+"""
+
+    def setup(self, count: int, by: str = 'load', nice: int = NICE, cpus: list = None, loads: dict = None):
+        """Partition the services into count shards and switch the ZBProxy unit over to ZBProxy@0..count-1.
+
+        By load, services are weighed by their logins in the log index, unless loads are given.
+        """
+        config = HandleJsonFile(self.config_path).read_json() or {}
+        loads = loads or {}
+        if by == 'load' and not loads:
+            index = LogIndex(os.path.join(self.base_dir, LogIndex.DIRECTORY))
+            index.index()
+            loads = index.service_load(self.LOAD_DAYS)
+        previous = self.state().get("count", 0)
+        names = [service['Name'] for service in config.get('Services', [])]
+        os.makedirs(os.path.dirname(self.state_file.file_path), exist_ok=True)
+        self.state_file.write_json({"count": count, "by": by, "loads": loads, "nice": nice,
+                                    "assignment": self.partition(names, count, loads)})
+        self.sync(config)
+        self.pending_actions = {}
+
+        cpu_sets = self.cpu_sets(count, cpus or sorted(os.sched_getaffinity(0)))
+        nofile = max(self.MIN_NOFILE, self.NOFILE_BUDGET // count)
+        os.makedirs(self.unit_dir, exist_ok=True)
+        HandleFile(os.path.join(self.unit_dir, f'{self.UNIT}.service')).write_file(self.unit_content(f'{self.base_dir}/zbproxy'))
+        for shard in range(count):
+            drop_in_dir = os.path.join(self.unit_dir, f'{self.UNIT}{shard}.service.d')
+            os.makedirs(drop_in_dir, exist_ok=True)
+            HandleFile(os.path.join(drop_in_dir, 'oproxy.conf')).write_file(self.drop_in_content(cpu_sets[shard], nofile, nice))
+        self.system_control.run_command('sudo systemctl daemon-reload')
+        for shard in range(count, previous):  # Left over from a layout with more shards
+            self.remove_shard(shard)
+        self.system_control.run_command('sudo systemctl disable --now ZBProxy')
+        for shard in range(count):  # A restart, so the new CPUAffinity and limits apply
+            self.system_control.run_command(f'sudo systemctl enable {self.UNIT}{shard}')
+            self.system_control.run_command(f'sudo systemctl restart {self.UNIT}{shard}')
+        print(f"ZBProxy running as {count} shards")
+        return self.show()
+
+    def remove_shard(self, shard: int):
+        """Stop a shard's instance and remove its tuning and config."""
+        self.system_control.run_command(f'sudo systemctl disable --now {self.UNIT}{shard}')
+        shutil.rmtree(os.path.join(self.unit_dir, f'{self.UNIT}{shard}.service.d'), ignore_errors=True)
+        shutil.rmtree(os.path.dirname(self.shard_path(shard)), ignore_errors=True)
+
+    def off(self):
+        """Go back to the single ZBProxy unit."""
+        count = self.state().get("count", 0)
+        if not count:
+            print("ZBProxy is not sharded")
+            return 'not sharded'
+        for shard in range(count):
+            self.remove_shard(shard)
+        template = os.path.join(self.unit_dir, f'{self.UNIT}.service')
+        if os.path.exists(template):
+            os.remove(template)
+        os.remove(self.state_file.file_path)
+        self.system_control.run_command('sudo systemctl daemon-reload')
+        self.system_control.run_command('sudo systemctl enable --now ZBProxy')
+        print("ZBProxy running as one instance")
+        return 'done'
+
+    def show(self):
+        """Each shard's services, load and tuning."""
+        state = self.state()
+        shards = []
+        for shard in range(state.get("count", 0)):
+            names = sorted(name for name, owner in state["assignment"].items() if owner == shard)
+            drop_in = os.path.join(self.unit_dir, f'{self.UNIT}{shard}.service.d', 'oproxy.conf')
+            tuning = {}
+            if os.path.exists(drop_in):
+                with open(drop_in) as file:
+                    tuning = dict(line.strip().split('=', 1) for line in file if '=' in line)
+            shards.append({"unit": f'{self.UNIT}{shard}', "services": names,
+                           "load": sum(state.get("loads", {}).get(name, 0) for name in names), **tuning})
+        return shards
+
+
+class ShardedJsonFile(HandleJsonFile):
+    """ZBProxy.json of a sharded host, every write is also routed to the shard configs it changes."""
+
+    def __init__(self, file_path, shards: ZBProxyShards) -> None:
+        """Initialize ShardedJsonFile object."""
+        super().__init__(file_path)
+        self.shards = shards
+
+    def write_file(self, content):
+        """Write ZBProxy.json, then the shard configs that changed with it."""
+        super().write_file(content)
+        self.shards.sync(json.loads(content))
+
+
+class DesiredConfig:
+    """Class to bring ZBProxy.json to a desired state: services matched by Name, lists by tag, other keys as a whole.
+
+    Sections the desired state leaves out are left as they are. Unchanged services keep their place and key order,
+    so applying the state already in place changes not a byte.
+    """
+
+    def __init__(self, desired: dict) -> None:
+        """Initialize DesiredConfig object, raises ValueError if desired is not a valid state."""
+        if not isinstance(desired, dict):
+            raise ValueError("the desired state must be a mapping")
+        services = desired.get("Services", [])
+        if not isinstance(services, list) or not all(isinstance(service, dict) and service.get("Name") for service in services):
+            raise ValueError("Services must be a list of services, each with a Name")
+        names = [service["Name"] for service in services]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"services named more than once: {', '.join(duplicates)}")
+        lists = desired.get("Lists", {})
+        if not isinstance(lists, dict) or not all(isinstance(names, list) for names in lists.values()):
+            raise ValueError("Lists must map each tag to a list of names")
+        self.desired = desired
+
+    @classmethod
+    def load(cls, source: str):
+        """Read a desired state from a .json or .yaml file, or JSON from stdin with "-"."""
+        with (contextlib.nullcontext(sys.stdin) if source == '-' else open(source)) as stream:
+            if source.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ValueError("reading YAML needs PyYAML (pip install pyyaml), or give the state as JSON")
+                try:
+                    return cls(yaml.safe_load(stream))
+                except yaml.YAMLError as e:
+                    raise ValueError(str(e))
+            return cls(json.load(stream))
+
+    @staticmethod
+    def list_tags(service: dict):
+        """The list tags a service uses, in its IPAccess, NameAccess and HostnameAccess."""
+        minecraft = service.get('Minecraft') or {}
+        return {tag for access in (service.get('IPAccess'), minecraft.get('NameAccess'), minecraft.get('HostnameAccess'))
+                for tag in (access or {}).get('ListTags') or []}
+
+    @classmethod
+    def differences(cls, old, new, path: str = ''):
+        """Yield (dotted path, old, new) for every value that differs, looking into nested mappings."""
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in list(old) + [key for key in new if key not in old]:
+                yield from cls.differences(old.get(key), new.get(key), f'{path}.{key}' if path else key)
+        elif old != new:
+            yield path, old, new
+
+    def plan(self, live: dict):
+        """Return (config, changes): live brought to the desired state, and what changed in it, empty when nothing did."""
+        live = live or {}
+        config = dict(live)
+        changes = []
+        if "Services" in self.desired:
+            wanted = {service["Name"]: service for service in self.desired["Services"]}
+            services, seen = [], set()
+            for service in live.get("Services", []):
+                name = service.get("Name")
+                if name in seen:
+                    changes.append(f"- service {name} (duplicate)")
+                elif name not in wanted:
+                    changes.append(f"- service {name}")
+                else:
+                    if service != wanted[name]:
+                        details = ', '.join(f"{path} {json.dumps(old)} -> {json.dumps(new)}" for path, old, new in self.differences(service, wanted[name]))
+                        changes.append(f"~ service {name}: {details}")
+                        service = wanted[name]
+                    services.append(service)
+                seen.add(name)
+            for name, service in wanted.items():
+                if name not in seen:
+                    changes.append(f"+ service {name} (Listen {service.get('Listen')})")
+                    services.append(service)
+            config["Services"] = services
+        if "Lists" in self.desired:
+            current = live.get("Lists", {})
+            lists = {}
+            for tag, names in current.items():
+                if tag not in self.desired["Lists"]:
+                    changes.append(f"- list {tag} ({len(names)} names)")
+                    continue
+                wanted = set(self.desired["Lists"][tag])
+                added, removed = wanted - set(names), set(names) - wanted
+                if added or removed:
+                    changes.append(f"~ list {tag}: +{len(added)} -{len(removed)} names")
+                    names = sorted(wanted)  # Sorted, as the whitelist commands keep them
+                lists[tag] = names
+            for tag, names in self.desired["Lists"].items():
+                if tag not in current:
+                    changes.append(f"+ list {tag} ({len(set(names))} names)")
+                    lists[tag] = sorted(set(names))
+            config["Lists"] = lists
+        for key, value in self.desired.items():
+            if key not in ("Services", "Lists") and live.get(key) != value:
+                changes.append(f"{'~' if key in live else '+'} {key}")
+                config[key] = value
+        missing = sorted({tag for service in config.get("Services", []) for tag in self.list_tags(service)} - set(config.get("Lists", {})))
+        if missing:
+            raise ValueError(f"services use lists that would not exist: {', '.join(missing)}")
+        return (config if changes else live), changes
+
+    @staticmethod
+    def listen_ports(config: dict):
+        return {service.get("Listen") for service in (config or {}).get("Services", [])}
+
+
 class ProxyServer:
     """Class to manage operations specific to a proxy server."""
     
-    def __init__(self, gh_token) -> None:
+    def __init__(self, gh_token, system_control: 'SystemControl' = None, config_path: str = 'ZBProxy.json') -> None:
         """Initialize ProxyServer object."""
+        self.gh_token = gh_token
         self.network_control = NetworkControl()
-        self.system_control = SystemControl()
-        self.program_control = ProgramControl(gh_token)
-        self.zbproxy_config = HandleJsonFile('ZBProxy.json')
+        self.system_control = system_control or SystemControl()
+        self.shards = ZBProxyShards(config_path, self.system_control)
+        # Sharded, every write of ZBProxy.json is routed to the shards whose services it touches
+        self.zbproxy_config = ShardedJsonFile(config_path, self.shards) if self.shards.enabled() else HandleJsonFile(config_path)
         self.zbproxy_config.create_file()
+
+    @functools.cached_property
+    def program_control(self):
+        """ProgramControl, only built by the commands that talk to GitHub."""
+        return ProgramControl(self.gh_token)
+
+    def ensure_firewall(self):
+        """Install ufw, only for the commands that open ports."""
         self.system_control.install_package('ufw')
+
+    @staticmethod
+    def required_action(old_config, new_config):
+        """Return "none" or "restart" for a change from old_config to new_config.
+
+        ZBProxy's config watcher applies edits of Lists and of a service's NameAccess to the running process, so they keep
+        live connections; anything else is only read on start.
+        """
+        def read_on_start(config):
+            return [{**service, "Minecraft": {key: value for key, value in service.get("Minecraft", {}).items() if key != 'NameAccess'}}
+                    for service in config.get('Services', [])]
+        if old_config is None or new_config is None:
+            return 'none' if old_config == new_config else 'restart'
+        return 'none' if read_on_start(old_config) == read_on_start(new_config) else 'restart'
+
+    def reconcile_firewall(self, dry_run: bool = False):
+        """Open and close ufw ports to match the Listen ports, once per batch."""
+        if getattr(ProxyServer._batch, 'actions', None) is not None:
+            ProxyServer._batch.firewall = True
+            print("Firewall sync deferred to the end of the batch")
+            return None
+        self.ensure_firewall()
+        return FirewallReconciler(self.system_control, self.zbproxy_config).reconcile(dry_run)
+
+    # Per thread: the actions asked for inside its batch, None outside of one, and whether the batch owes a firewall sync
+    _batch = threading.local()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Apply many changes with one config write and at most one restart.
+
+        Yields a summary that is filled in when the batch ends.
+        """
+        summary = {}
+        with self.zbproxy_config.transaction() as config:
+            before = json.loads(json.dumps(config))
+            ProxyServer._batch.actions, ProxyServer._batch.firewall = [], False
+            try:
+                yield summary
+            finally:
+                actions = [action for action in ProxyServer._batch.actions if action != 'none']
+                firewall = ProxyServer._batch.firewall
+                ProxyServer._batch.actions, ProxyServer._batch.firewall = None, False
+        if before == self.zbproxy_config.read_json():
+            action = 'none'  # The changes cancelled out
+        else:
+            action = 'restart' if actions else 'none'
+        if firewall:
+            self.reconcile_firewall()
+        summary['action'] = self.activate(action)
+        summary['saved'] = len(actions) - (summary['action'] != 'none')
+        print(f"Batch applied with {summary['action']}, {summary['saved']} restarts saved")
+
+    def activate(self, action: str):
+        """Make the running ZBProxy pick up its config by restarting it, unless its config watcher applies the change."""
+        if getattr(ProxyServer._batch, 'actions', None) is not None:
+            ProxyServer._batch.actions.append(action)
+            print(f"ZBProxy {action} deferred to the end of the batch")
+            return action
+        if action == 'none':
+            print("Nothing ZBProxy reads on start changed, no restart needed")
+            return 'none'
+        if isinstance(self.zbproxy_config, ShardedJsonFile):
+            return self.shards.activate()
+        self.system_control.run_command('sudo systemctl restart ZBProxy')
+        return 'restart'
+
+    def apply_desired(self, desired: DesiredConfig, dry_run: bool = False):
+        """Bring ZBProxy.json to a desired state with at most one write and one restart.
+
+        Returns {"changes", "action", "written"}; a state already in place writes nothing and calls nothing.
+        """
+        if dry_run:
+            live = self.zbproxy_config.read_json() if self.zbproxy_config.file_exists() else None
+            config, changes = desired.plan(live)
+            return {"changes": changes, "action": self.required_action(live, config), "written": False}
+        with self.zbproxy_config.transaction() as live:
+            config, changes = desired.plan(live)
+            if changes:
+                self.zbproxy_config.write_json(config)  # Written when the transaction ends
+        if not changes:
+            print("ZBProxy.json is already in the desired state")
+            return {"changes": [], "action": 'none', "written": False}
+        if DesiredConfig.listen_ports(live) != DesiredConfig.listen_ports(config):
+            self.reconcile_firewall()
+        return {"changes": changes, "action": self.activate(self.required_action(live, config)), "written": True}
         
 
     def download_zbproxy(self, token):
         """Download ZBProxy software."""
         print("Downloading ZBProxy...")
-        return self.network_control.download_file(self.program_control.get_latest_artifact_download_url(token), "zbproxy")
+        self.program_control.token = token
+        run_id = self.program_control.latest_zbproxy_run_id()
+        stage = self.program_control.build_source(run_id) if run_id is not None else None
+        if stage is None:
+            print("Failed to get the download URL.")
+            return "Failed to get the download URL."
+        result = stage("zbproxy")
+        if result.endswith('downloaded successfully'):
+            self.program_control.latest_run_id = run_id
+            self.program_control.record_installed_build(run_id, sha256=self.program_control.cache_installed_build(run_id))
+        return result
+
+    @staticmethod
+    def service_config(target_ip: str, target_port, listen_on):
+        """Build the ZBProxy service entry of a proxy server."""
+        return {
+            "Name": "MinecraftProxy",
+            "TargetAddress": target_ip,
+            "TargetPort": int(target_port),
+            "Listen": int(listen_on),
+            "Flow": "auto",
+            "IPAccess": {
+                "Mode": ""
+            },
+            "Minecraft": {
+                "EnableHostnameRewrite": True,
+                "OnlineCount": {
+                    "Max": 114514,
+                    "Online": -1,
+                    "EnableMaxLimit": False
+                },
+                "HostnameAccess": {
+                    "Mode": "allow",
+                    "ListTags" : ["TransitServerIP"]
+                },
+                "NameAccess": {
+                    "Mode": ""
+                },
+                "PingMode": "",
+                "MotdFavicon": "{DEFAULT_MOTD}",
+                "MotdDescription": "§d{NAME}§e service is working on §a§o{INFO}§r\n§c§lProxy for §6§n{HOST}:{PORT}§r"
+            },
+            "TLSSniffing": {
+                "RejectNonTLS": False
+            },
+            "Outbound": {
+                "Type": ""
+            }
+        }
 
     def init_zbproxy(self, target_ip: str, target_port: str, listen_on: str):
         """Initialize ZBProxy configuration."""
         print("Initializing ZBProxy...")
         self.system_control.run_command("chmod +x zbproxy")
         self.zbproxy_config.write_json({
-            "Services": [
-                {
-                    "Name": "MinecraftProxy",
-                    "TargetAddress": target_ip,
-                    "TargetPort": int(target_port),
-                    "Listen": int(listen_on),
-                    "Flow": "auto",
-                    "IPAccess": {
-                        "Mode": ""
-                    },
-                    "Minecraft": {
-                        "EnableHostnameRewrite": True,
-                        "OnlineCount": {
-                            "Max": 114514,
-                            "Online": -1,
-                            "EnableMaxLimit": False
-                        },
-                        "HostnameAccess": {
-                            "Mode": "allow",
-                            "ListTags" : ["TransitServerIP"]
-                        },
-                        "NameAccess": {
-                            "Mode": ""
-                        },
-                        "PingMode": "",
-                        "MotdFavicon": "{DEFAULT_MOTD}",
-                        "MotdDescription": "§d{NAME}§e service is working on §a§o{INFO}§r\n§c§lProxy for §6§n{HOST}:{PORT}§r"
-                    },
-                    "TLSSniffing": {
-                        "RejectNonTLS": False
-                    },
-                    "Outbound": {
-                        "Type": ""
-                    }
-                }
-            ],
+            "Services": [self.service_config(target_ip, target_port, listen_on)],
             "Lists": {
                 "TransitServerIP" : []
             }
@@ -272,59 +3052,100 @@ class ProxyServer:
     def run_zbproxy(self):
         """Run ZBProxy as a service."""
         print("Running ZBProxy...")
+        if self.shards.enabled():
+            for unit in self.shards.units():
+                self.system_control.run_command(f'sudo systemctl enable --now {unit}')
+            self.reconcile_firewall()
+            print("ZBProxy shards running")
+            return
         zbproxy_service = SystemService('ZBProxy', 'ZBProxy service', f'{os.getcwd()}/zbproxy', os.getcwd(), 'zbproxy')
         zbproxy_service.fill_service_content()
         zbproxy_service.enable_service()
         self.system_control.run_command('sudo chmod +x zbproxy')
         print(zbproxy_service.start_service())
-        self.system_control.run_command('sudo ufw allow 25565/tcp')  # Allow traffic on port 25565
+        self.reconcile_firewall()  # Allow traffic on the configured Listen ports
         print("ZBProxy running")
 
     def add_transit_server_ip(self, ip: str):
-        config = self.zbproxy_config.read_json()
-        if ip not in config['Lists']['TransitServerIP']:
-            config['Lists']['TransitServerIP'].append(ip)
-            self.zbproxy_config.write_json(config)
-            print(f"Added {ip} to TransitServerIP list")
-            return 'done'
-        else:
-            print('IP already exists in TransitServerIP list')
-            return 'IP already exists'
+        with self.zbproxy_config.transaction() as config:
+            if ip not in config['Lists']['TransitServerIP']:
+                config['Lists']['TransitServerIP'].append(ip)
+                print(f"Added {ip} to TransitServerIP list")
+                return 'done'
+            else:
+                print('IP already exists in TransitServerIP list')
+                return 'IP already exists'
     
     def remove_transit_server_ip(self, ip: str):
-        config = self.zbproxy_config.read_json()
-        if ip in config['Lists']['TransitServerIP']:
-            config['Lists']['TransitServerIP'].remove(ip)
-            self.zbproxy_config.write_json(config)
-            print(f"Removed {ip} from TransitServerIP list")
+        with self.zbproxy_config.transaction() as config:
+            if ip in config['Lists']['TransitServerIP']:
+                config['Lists']['TransitServerIP'].remove(ip)
+                print(f"Removed {ip} from TransitServerIP list")
+                return 'done'
+            else:
+                print(f"{ip} not found in TransitServerIP list")
+                return 'Not found'
+
+    def add_upstream(self, address: str, service: str = 'MinecraftProxy'):
+        """Add host[:port] to the upstream pool of a service, for `failover run` to choose from."""
+        address = UpstreamSelector.address(*LatencyProbe.parse_address(address))
+        with self.zbproxy_config.transaction() as config:
+            pool = config.setdefault('Lists', {}).setdefault(UpstreamSelector.list_name(service), [])
+            if address in pool:
+                print(f"{address} is already an upstream of {service}")
+                return 'Upstream already exists'
+            pool.append(address)
+            print(f"Added {address} to the upstreams of {service}")
             return 'done'
-        else:
-            print(f"{ip} not found in TransitServerIP list")
-            return 'Not found'
-        
+
+    def remove_upstream(self, address: str, service: str = 'MinecraftProxy'):
+        """Remove host[:port] from the upstream pool of a service, unless it is the service's target, which always counts."""
+        address = UpstreamSelector.address(*LatencyProbe.parse_address(address))
+        with self.zbproxy_config.transaction() as config:
+            if any(entry['Name'] == service and UpstreamSelector.address(entry['TargetAddress'], entry['TargetPort']) == address
+                   for entry in config.get('Services', [])):
+                print(f"{address} is the target of {service}, it stays in the pool until failover moves off it")
+                return f"Failed to remove {address}: it is the target of {service}"
+            pool = config.get('Lists', {}).get(UpstreamSelector.list_name(service), [])
+            if address not in pool:
+                print(f"{address} is not an upstream of {service}")
+                return 'Not found'
+            pool.remove(address)
+            print(f"Removed {address} from the upstreams of {service}")
+            return 'done'
+
+    def switch_upstream(self, service: str, host: str, port: int):
+        """Point a service at another upstream with one write and one restart; the target it leaves stays in its pool."""
+        with self.zbproxy_config.transaction() as config:
+            before = json.loads(json.dumps(config))
+            for entry in config['Services']:
+                if entry['Name'] == service:
+                    # The original target is in no list, without this the service could never fail back to it
+                    pool = config.setdefault('Lists', {}).setdefault(UpstreamSelector.list_name(service), [])
+                    left = UpstreamSelector.address(entry['TargetAddress'], entry['TargetPort'])
+                    if left not in (UpstreamSelector.address(*LatencyProbe.parse_address(address)) for address in pool):
+                        pool.append(left)
+                    entry['TargetAddress'], entry['TargetPort'] = host, int(port)
+        return self.activate(self.required_action(before, config))
+
     def turn_on_hostname_access(self):
         print("Turning on hostname access...")
-        config = self.zbproxy_config.read_json()
-        config['Services'][0]['Minecraft']['HostnameAccess']['Mode'] = 'allow'
-        self.zbproxy_config.write_json(config)
+        with self.zbproxy_config.transaction() as config:
+            config['Services'][0]['Minecraft']['HostnameAccess']['Mode'] = 'allow'
     
     def turn_off_hostname_access(self):
         print("Turning off hostname access...")
-        config = self.zbproxy_config.read_json()
-        config['Services'][0]['Minecraft']['HostnameAccess']['Mode'] = ''
-        self.zbproxy_config.write_json(config)
+        with self.zbproxy_config.transaction() as config:
+            config['Services'][0]['Minecraft']['HostnameAccess']['Mode'] = ''
 
 
 
 class TransitServer(ProxyServer):
     """Class to manage operations specific to a transit server, inheriting from ProxyServer."""
     
-    def __init__(self, gh_token):
+    def __init__(self, gh_token, system_control: 'SystemControl' = None, config_path: str = 'ZBProxy.json'):
         """Initialize TransitServer object."""
-        super().__init__(gh_token)
-        self.network_control = NetworkControl()
-        self.system_control = SystemControl()
-        self.zbproxy_config = HandleJsonFile('ZBProxy.json')
+        super().__init__(gh_token, system_control, config_path)
 
 
     def init_zbproxy(self):
@@ -340,68 +3161,131 @@ class TransitServer(ProxyServer):
     def add_service(self, service_dict: dict):
         """Add a service configuration to ZBProxy."""
         print("Adding service...")
-        self.system_control.run_command(f'ufw allow {service_dict["Listen"]}/tcp')  # Allow traffic on specified port
-        org_config = self.zbproxy_config.read_json()
-        org_config["Services"].append(service_dict)
-        service_name = service_dict["Name"]
-        if service_name not in org_config["Lists"]:
-            org_config["Lists"][service_name] = []
-        self.zbproxy_config.write_json(org_config)
+        with self.zbproxy_config.transaction() as org_config:
+            service_name = service_dict["Name"]
+            for index, service in enumerate(org_config["Services"]):
+                if service["Name"] == service_name:  # Replaced, not added a second time
+                    org_config["Services"][index] = service_dict
+                    break
+            else:
+                org_config["Services"].append(service_dict)
+            if service_name not in org_config["Lists"]:
+                org_config["Lists"][service_name] = []
+        self.reconcile_firewall()  # Allow traffic on specified port
     
     def remove_service(self, service_name: str):
         """Remove a service configuration from ZBProxy."""
         print(f"Removing service {service_name}...")
-        org_config = self.zbproxy_config.read_json()
-        for service in org_config["Services"]:
-            if service["Name"] == service_name:
-                org_config["Services"].remove(service)
-                self.zbproxy_config.write_json(org_config)
-                print(f"Service {service_name} removed")
-                return f"Service {service_name} removed"
+        with self.zbproxy_config.transaction() as org_config:
+            for service in org_config["Services"]:
+                if service["Name"] == service_name:
+                    org_config["Services"].remove(service)
+                    break
+            else:
+                return None
+        self.reconcile_firewall()  # Close the port nothing listens on anymore
+        print(f"Service {service_name} removed")
+        return f"Service {service_name} removed"
         
 
+    @staticmethod
+    def sorted_names(config: dict, group: str):
+        """Return a whitelist, sorted in place first if an older OProxy left it unsorted."""
+        names = config["Lists"][group]
+        if any(names[i] > names[i + 1] for i in range(len(names) - 1)):
+            names.sort()
+        return names
+
     def add_whitelist(self, name: str, group: str):
         """Add an item to a whitelist in ZBProxy configuration."""
         print(f"Adding {name} to the {group}...")
-        config = self.zbproxy_config.read_json()
-        if config and group in config["Lists"] and name not in config["Lists"][group]:
-            config["Lists"][group].append(name)
-            self.zbproxy_config.write_json(config)
-            print(f"{name} added to {group}")
-        else:
+        with self.zbproxy_config.transaction() as config:
+            if config and group in config["Lists"]:
+                names = self.sorted_names(config, group)
+                index = bisect.bisect_left(names, name)
+                if index == len(names) or names[index] != name:
+                    names.insert(index, name)
+                    print(f"{name} added to {group}")
+                    return f"Added {name} to the {group}"
             print(f'{name} is already in the {group} or failed to read the config')
         return f"Added {name} to the {group}"
 
     def remove_whitelist(self, name: str, group: str):
         """Remove an item from a whitelist in ZBProxy configuration."""
         print(f"Removing {name} from the {group}...")
-        config = self.zbproxy_config.read_json()
-        if config and group in config["Lists"] and name in config["Lists"][group]:
-            config["Lists"][group].remove(name)
-            self.zbproxy_config.write_json(config)
-            print(f"{name} removed from {group}")
+        with self.zbproxy_config.transaction() as config:
+            if config and group in config["Lists"]:
+                names = self.sorted_names(config, group)
+                index = bisect.bisect_left(names, name)
+                if index < len(names) and names[index] == name:
+                    del names[index]
+                    print(f"{name} removed from {group}")
         return f"Removed {name} from the {group}"
 
+    @staticmethod
+    def read_names(stream):
+        """Yield the player names of a stream, one per line, skipping blank lines and # comments."""
+        for line in stream:
+            name = line.strip()
+            if name and not name.startswith('#'):
+                yield name
 
-    def turn_on_whitelist(self, service_name):
+    def import_whitelist(self, group: str, stream, merge: bool = False):
+        """Make a whitelist match the names of a stream, as one diff and one write.
+
+        With merge, names already on the list and missing from the stream are kept.
+        """
+        print(f"Importing whitelist for {group}...")
+        names = set(self.read_names(stream))
+        with self.zbproxy_config.transaction() as config:
+            if not config or group not in config["Lists"]:
+                print(f'{group} does not exist or failed to read the config')
+                return f"Failed to import the {group}"
+            current = set(config["Lists"][group])
+            added = names - current
+            removed = set() if merge else current - names
+            if added or removed:
+                config["Lists"][group] = sorted((current | added) - removed)
+        print(f"{len(added)} added to and {len(removed)} removed from {group}")
+        return f"Imported the {group}: {len(added)} added, {len(removed)} removed"
+
+    def export_whitelist(self, group: str, stream):
+        """Write a whitelist to a stream, one name per line."""
+        print(f"Exporting whitelist for {group}...")
         config = self.zbproxy_config.read_json()
-        for service in config["Services"]:
-            if service["Name"] == service_name:
-                service["Minecraft"]["NameAccess"]["Mode"] = "allow"
-                self.zbproxy_config.write_json(config)
-                self.system_control.run_command('sudo systemctl restart ZBProxy')
-                print(f"Whitelist turned on for {service_name}")
-                return f"Whitelist turned on for {service_name}"
+        if not config or group not in config["Lists"]:
+            print(f'{group} does not exist or failed to read the config')
+            return f"Failed to export the {group}"
+        names = sorted(config["Lists"][group])
+        stream.writelines(f"{name}\n" for name in names)
+        return f"Exported {len(names)} names from the {group}"
+
+
+    def set_name_access_mode(self, service_name, mode: str):
+        """Set a service's NameAccess mode, returns how ZBProxy was told, or None if there is no such service."""
+        with self.zbproxy_config.transaction() as config:
+            before = json.loads(json.dumps(config))
+            for service in config["Services"]:
+                if service["Name"] == service_name:
+                    service["Minecraft"]["NameAccess"]["Mode"] = mode
+                    break
+            else:
+                return None
+        return self.activate(self.required_action(before, config))
+
+    def turn_on_whitelist(self, service_name):
+        action = self.set_name_access_mode(service_name, "allow")
+        if action is None:
+            return None
+        print(f"Whitelist turned on for {service_name} ({action})")
+        return f"Whitelist turned on for {service_name}"
 
     def turn_off_whitelist(self, service_name):
-        config = self.zbproxy_config.read_json()
-        for service in config["Services"]:
-            if service["Name"] == service_name:
-                service["Minecraft"]["NameAccess"]["Mode"] = ""
-                self.zbproxy_config.write_json(config)
-                self.system_control.run_command('sudo systemctl restart ZBProxy')
-                print(f"Whitelist turned off for {service_name}")
-                return f"Whitelist turned off for {service_name}"
+        action = self.set_name_access_mode(service_name, "")
+        if action is None:
+            return None
+        print(f"Whitelist turned off for {service_name} ({action})")
+        return f"Whitelist turned off for {service_name}"
 
 
 
@@ -450,88 +3334,525 @@ class MinecraftTransitService:
         }
 
 
+class BlueGreenUpdate:
+    """Class to swap in a new ZBProxy build: smoke test on a spare port, atomic swap, health check, rollback.
+
+    Healthy means the process is up and accepting connections on its Listen ports. A status ping would go through to
+    the upstream, or be refused by HostnameAccess, and roll back a good build for reasons that are not the build's.
+    """
+
+    def __init__(self, restart, binary_path: str = 'zbproxy', config_path: str = 'ZBProxy.json',
+                 health_timeout: float = 30, smoke_timeout: float = 10, is_active=None) -> None:
+        """Initialize BlueGreenUpdate object, restart is called to restart the running service and is_active, if given, to ask whether it is running."""
+        self.restart = restart
+        self.is_active = is_active
+        self.binary_path = binary_path
+        self.staged_path = f'{binary_path}.new'
+        self.previous_path = f'{binary_path}.previous'
+        self.config_path = config_path
+        self.health_timeout = health_timeout
+        self.smoke_timeout = smoke_timeout
+        self.outage_seconds = None
+
+    @staticmethod
+    def spare_port():
+        """Return a free local TCP port."""
+        import socket
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def accepting(port: int, timeout: float = 1):
+        """Check whether something accepts TCP connections on a local port."""
+        import socket
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=timeout):
+                return True
+        except OSError:
+            return False
+
+    def smoke_test(self, staged_path: str):
+        """Run the staged build against a temp config on a spare port and check that it stays up and listens."""
+        print(f"Smoke testing {staged_path}...")
+        with tempfile.TemporaryDirectory() as work_dir:
+            port = self.spare_port()
+            # Nothing listens on the upstream, the smoke test is about the build, not the network
+            service = MinecraftTransitService('127.0.0.1', self.spare_port(), port, 'SmokeTest').service_dict
+            service['Minecraft']['NameAccess'] = {"Mode": ""}
+            with open(os.path.join(work_dir, 'ZBProxy.json'), 'w') as file:
+                json.dump({"Services": [service], "Lists": {}}, file)
+            process = subprocess.Popen([os.path.abspath(staged_path)], cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                deadline = time.monotonic() + self.smoke_timeout
+                while time.monotonic() < deadline:
+                    if process.poll() is not None:
+                        print(f"Smoke test failed: the new build exited with code {process.returncode}")
+                        return False
+                    if self.accepting(port):
+                        print("Smoke test passed")
+                        return True
+                    time.sleep(0.1)
+                print(f"Smoke test failed: nothing listening on port {port}")
+                return False
+            finally:
+                process.terminate()
+                try:
+                    process.wait(5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    def listen_ports(self):
+        """Return the Listen ports of the configured services."""
+        try:
+            with open(self.config_path) as file:
+                services = json.load(file).get('Services', [])
+        except (OSError, ValueError):
+            return []
+        return sorted({int(service['Listen']) for service in services})
+
+    def wait_healthy(self, since: float):
+        """Wait until the service is active and accepts on every Listen port, returns the seconds since `since` or None on timeout."""
+        ports = self.listen_ports()
+        if not ports:
+            print("No service to health check, skipping")
+            return 0.0
+        while time.monotonic() - since < self.health_timeout:
+            if (self.is_active is None or self.is_active()) and all(self.accepting(port) for port in ports):
+                return time.monotonic() - since
+            time.sleep(0.05)
+        return None
+
+    def run(self, stage):
+        """Stage a build with stage(path), then swap it in, returns a result message."""
+        result = stage(self.staged_path)
+        if not result.endswith('downloaded successfully'):
+            return result
+        if not self.smoke_test(self.staged_path):
+            os.remove(self.staged_path)
+            return "Failed to update ZBProxy: the new build did not pass the smoke test."
+
+        had_previous = os.path.exists(self.binary_path)
+        if had_previous:
+            # Keep the running build for rollback, link then rename so both steps are atomic
+            os.link(self.binary_path, f'{self.previous_path}.tmp')
+            os.replace(f'{self.previous_path}.tmp', self.previous_path)
+        os.replace(self.staged_path, self.binary_path)
+
+        started = time.monotonic()
+        self.restart()
+        self.outage_seconds = self.wait_healthy(started)
+        if self.outage_seconds is None:
+            print("Health check failed after the swap")
+            if not had_previous:
+                return "Failed to update ZBProxy: the new build is not healthy and there is nothing to roll back to."
+            os.replace(self.previous_path, self.binary_path)
+            started = time.monotonic()
+            self.restart()
+            self.outage_seconds = self.wait_healthy(started)
+            if self.outage_seconds is None:
+                print("Health check failed after the rollback")
+                return "Failed to update ZBProxy: rolled back to the previous build, but it is not healthy either."
+            print("Rolled back to the previous build")
+            return "Failed to update ZBProxy: rolled back to the previous build."
+        print(f"Outage window: {self.outage_seconds:.2f}s")
+        return "ZBProxy updated successfully."
+
+
+class CpuFeatures:
+    """Class to work out which ZBProxy build runs fastest here: the x86-64 psABI level from /proc/cpuinfo, or arm64."""
+
+    CPUINFO = '/proc/cpuinfo'
+    # The /proc/cpuinfo flags each x86-64 psABI level adds to the one below it
+    LEVELS = {
+        1: {'cmov', 'cx8', 'fpu', 'fxsr', 'mmx', 'sse', 'sse2', 'lm'},
+        2: {'cx16', 'lahf_lm', 'popcnt', 'pni', 'sse4_1', 'sse4_2', 'ssse3'},  # pni is SSE3
+        3: {'avx', 'avx2', 'bmi1', 'bmi2', 'f16c', 'fma', 'abm', 'movbe', 'xsave'},  # abm includes LZCNT
+        4: {'avx512f', 'avx512bw', 'avx512cd', 'avx512dq', 'avx512vl'},
+    }
+    ARM64_MACHINES = ('aarch64', 'arm64')
+
+    def __init__(self, cpuinfo: str = None, machine: str = None) -> None:
+        """Initialize CpuFeatures object, from this host unless cpuinfo and machine are given."""
+        self.machine = (machine or platform.machine()).lower()
+        if cpuinfo is None:
+            try:
+                with open(self.CPUINFO) as file:
+                    cpuinfo = file.read()
+            except OSError:
+                cpuinfo = ''
+        self.cpuinfo = cpuinfo
+
+    @functools.cached_property
+    def flags(self):
+        """The flags every processor has, a feature missing on one core rules it out."""
+        sets = [set(line.split(':', 1)[1].split()) for line in self.cpuinfo.splitlines()
+                if line.split(':', 1)[0].strip() in ('flags', 'Features') and ':' in line]
+        return set.intersection(*sets) if sets else set()
+
+    @property
+    def arch(self):
+        return 'arm64' if self.machine in self.ARM64_MACHINES else 'amd64'
+
+    @functools.cached_property
+    def level(self):
+        """The x86-64 psABI level, 1 to 4; 1 also when the flags are hidden. None on arm64."""
+        if self.arch != 'amd64':
+            return None
+        level = 1
+        for number in (2, 3, 4):
+            if not self.LEVELS[number] <= self.flags:
+                break
+            level = number
+        return level
+
+    @property
+    def label(self):
+        return 'arm64' if self.arch == 'arm64' else f'amd64-v{self.level}'
+
+    def candidates(self):
+        """The artifact names this CPU can run, fastest first."""
+        if self.arch == 'arm64':
+            return ['ZBProxy-linux-arm64']
+        return [f'ZBProxy-linux-amd64-v{level}' for level in range(self.level, 0, -1)] + ['ZBProxy-linux-amd64']
+
+    def choose(self, names):
+        """The fastest artifact among names that this CPU can run, or None."""
+        return next((candidate for candidate in self.candidates() if candidate in names), None)
+
+
+class BuildCache:
+    """Class to keep downloaded ZBProxy builds by SHA-256, keyed by workflow run and artifact, least recently used evicted past a size.
+
+    Builds are hard linked in and out when on the same filesystem, so installing one from the cache copies nothing.
+    """
+
+    DIRECTORY = os.path.join(STATE_DIR, 'builds')
+    MAX_BYTES = 512 * 1024 * 1024  # "build_cache_mb" in config.json
+    SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, directory: str = DIRECTORY, max_bytes: int = None) -> None:
+        """Initialize BuildCache object."""
+        self.directory = directory
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.index_file = HandleJsonFile(os.path.join(directory, 'index.json'))
+
+    @staticmethod
+    def key(run_id, artifact: str):
+        return f'{run_id}/{artifact}'
+
+    def object_path(self, sha256: str):
+        return os.path.join(self.directory, 'objects', sha256)
+
+    @staticmethod
+    def sha256_of(path: str):
+        with open(path, 'rb') as file:
+            return hashlib.file_digest(file, 'sha256').hexdigest()
+
+    @staticmethod
+    def link(source: str, target: str):
+        """Hard link source to target atomically, copied when they are on different filesystems."""
+        temp_path = f'{target}.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+            os.chmod(temp_path, 0o755)
+        os.replace(temp_path, target)
+
+    def entries(self):
+        """The cached builds, by key."""
+        return ((self.index_file.read_json() if self.index_file.file_exists() else None) or {}).get("builds", {})
+
+    def find(self, run_id, cpu: 'CpuFeatures'):
+        """The entry of the fastest cached build of a run that cpu can run, or None."""
+        builds = {entry["artifact"]: entry for entry in self.entries().values()
+                  if str(entry["run_id"]) == str(run_id) and os.path.exists(self.object_path(entry["sha256"]))}
+        artifact = cpu.choose(builds)
+        return builds[artifact] if artifact else None
+
+    def add(self, run_id, artifact: str, path: str, keep=()):
+        """Store a build, then evict least recently used builds past the size limit, never those in keep (SHA-256s)."""
+        sha256 = self.sha256_of(path)
+        os.makedirs(os.path.dirname(self.object_path(sha256)), exist_ok=True)
+        if not os.path.exists(self.object_path(sha256)):
+            self.link(path, self.object_path(sha256))
+        now = time.time()
+        entry = {"run_id": run_id, "artifact": artifact, "sha256": sha256, "size": os.path.getsize(path), "added": now, "used": now}
+        with self.index_file.transaction() as index:
+            index = index or {"builds": {}}
+            index["builds"][self.key(run_id, artifact)] = entry
+            self.evict(index["builds"], set(keep) | {sha256})
+            self.index_file.write_json(index)  # Written when the transaction ends
+        print(f"Cached {artifact} of run {run_id} ({sha256[:12]})")
+        return entry
+
+    def evict(self, builds: dict, keep: set):
+        """Drop least recently used entries, and objects no entry uses anymore, until the objects fit."""
+        sizes = {entry["sha256"]: entry["size"] for entry in builds.values()}
+        total = sum(sizes.values())
+        for key, entry in sorted(builds.items(), key=lambda item: item[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            if entry["sha256"] in keep:
+                continue
+            del builds[key]
+            if all(other["sha256"] != entry["sha256"] for other in builds.values()):
+                total -= entry["size"]
+                if os.path.exists(self.object_path(entry["sha256"])):
+                    os.remove(self.object_path(entry["sha256"]))
+                print(f"Evicted {entry['artifact']} of run {entry['run_id']} from the build cache")
+
+    def install(self, entry: dict, target: str):
+        """Link a cached build to target after checking its SHA-256, returns a download-style result message."""
+        path = self.object_path(entry["sha256"])
+        if not os.path.exists(path) or self.sha256_of(path) != entry["sha256"]:
+            with self.index_file.transaction() as index:
+                if index:
+                    index["builds"].pop(self.key(entry["run_id"], entry["artifact"]), None)
+            if os.path.exists(path):
+                os.remove(path)
+            print(f"Cached {entry['artifact']} of run {entry['run_id']} is damaged, dropped it")
+            return f"Failed to install {target}: the cached build is damaged"
+        self.link(path, target)
+        with self.index_file.transaction() as index:
+            cached = (index or {}).get("builds", {}).get(self.key(entry["run_id"], entry["artifact"]))
+            if cached:
+                cached["used"] = time.time()
+        print(f"Installed {entry['artifact']} of run {entry['run_id']} from the build cache")
+        return f"{target} downloaded successfully"
+
+    def routes(self):
+        """HttpEndpoint routes of a mirror: the index as JSON, and each build by SHA-256, resumable."""
+        def index(request):
+            return HttpEndpoint.json_response(sorted(
+                ({key: entry[key] for key in ("run_id", "artifact", "sha256", "size")} for entry in self.entries().values()),
+                key=lambda entry: (str(entry["run_id"]), entry["artifact"])))
+
+        def build(request):
+            sha256 = request.path.split('?')[0].rsplit('/', 1)[-1]
+            path = self.object_path(sha256)
+            if not self.SHA256.match(sha256) or not os.path.exists(path):
+                return 404, {}, b'Not Found'
+
+            def read_at(offset, length):
+                with open(path, 'rb') as file:
+                    file.seek(offset)
+                    return file.read(length)
+            # Objects are named by their content, the hash is a strong validator for resuming
+            return HttpEndpoint.byte_range_response(request, os.path.getsize(path), read_at, f'"{sha256}"')
+        return {'/builds': index, '/builds/': build}
+
+
 class ProgramControl:
     
-    def __init__(self, token) -> None:
-        self.system_control = SystemControl()
-        self.network_control = NetworkControl()
+    API_URL = 'https://api.github.com'
+    ZBPROXY_MEMBER = 'ZBProxy-linux-*'  # The binary inside the artifact zip
+    INSTALLED_BUILD = os.path.join(STATE_DIR, 'zbproxy_build.json')
+    MIRROR = None  # Base URL of an `OProxy mirror serve` to take builds from instead of GitHub, "mirror" in config.json
+
+    def __init__(self, token, http_client: HttpClient = None, api_url: str = None, metadata_cache: MetadataCache = None) -> None:
+        self.http_client = http_client or HttpClient.shared()
+        self.network_control = NetworkControl(self.http_client)
+        self.metadata_cache = metadata_cache or MetadataCache.shared()
+        self.api_url = api_url or self.API_URL
         
         self.token = token
-        self.cpu_model = platform.processor()
+        self.latest_artifact = None  # Chosen by get_latest_artifact_download_url
+
+    @functools.cached_property
+    def cpu(self):
+        return CpuFeatures()
+
+    @functools.cached_property
+    def build_cache(self):
+        return BuildCache()
+
+    @functools.cached_property
+    def system_control(self):
+        return SystemControl()
     
 
-    def get_latest_artifact_download_url(self, token):
-        GITHUB_TOKEN = token
-        REPO_OWNER = 'layou233'
-        REPO_NAME = 'ZBProxy'
-        
+    def github_headers(self, token):
         # 设置请求头
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
+        return {
+            'Authorization': f'token {token}',
             'Accept': 'application/vnd.github+json'
         }
 
+    def get_latest_run_id(self, token):
+        """Return the id of the latest ZBProxy workflow run, or None."""
         # 获取最新的workflow run
-        workflow_runs_url = f'https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/actions/runs'
-        response = requests.get(workflow_runs_url, headers=headers)
-        response.raise_for_status()  # 确保请求成功
-        workflow_runs = response.json()
-
+        workflow_runs_url = f'{self.api_url}/repos/layou233/ZBProxy/actions/runs?per_page=1'
+        workflow_runs = self.metadata_cache.get_json(self.http_client, workflow_runs_url, self.github_headers(token))
         if 'workflow_runs' in workflow_runs and workflow_runs['workflow_runs']:
-            latest_run = workflow_runs['workflow_runs'][0]
-            run_id = latest_run['id']
+            return workflow_runs['workflow_runs'][0]['id']
+        print('没有找到workflow runs，则返回None')
+        return None  # 如果没有找到workflow runs，则返回None
+
+    def get_installed_run_id(self):
+        """Return the workflow run id of the installed ZBProxy build, or None."""
+        installed = HandleJsonFile(self.INSTALLED_BUILD)
+        return (installed.read_json() or {}).get('run_id') if installed.file_exists() else None
+
+    def installed_for_this_cpu(self):
+        """Whether the installed build was chosen for this CPU; one recorded before OProxy told levels apart was not."""
+        installed = HandleJsonFile(self.INSTALLED_BUILD)
+        return (installed.read_json() or {}).get('cpu') == self.cpu.label if installed.file_exists() else False
+
+    def record_installed_build(self, run_id, outage_seconds: float = None, sha256: str = None):
+        """Remember which workflow run the installed ZBProxy build came from, and which build for which CPU."""
+        os.makedirs(STATE_DIR, exist_ok=True)
+        HandleJsonFile(self.INSTALLED_BUILD).write_json({'run_id': run_id, 'installed_at': int(time.time()), 'outage_seconds': outage_seconds,
+                                                         'artifact': self.latest_artifact, 'cpu': self.cpu.label, 'sha256': sha256})
+
+    def cache_installed_build(self, run_id, binary_path: str = 'zbproxy'):
+        """Keep the build just installed in the build cache, returns its SHA-256."""
+        if self.latest_artifact is None:
+            return None
+        installed = HandleJsonFile(self.INSTALLED_BUILD)
+        previous = (installed.read_json() or {}).get('sha256') if installed.file_exists() else None
+        # The build being replaced stays too, it is the rollback
+        return self.build_cache.add(run_id, self.latest_artifact, binary_path, keep={previous} - {None})["sha256"]
+
+    def get_latest_artifact_download_url(self, token):
+        REPO_OWNER = 'layou233'
+        REPO_NAME = 'ZBProxy'
+        headers = self.github_headers(token)
 
+        run_id = self.get_latest_run_id(token)
+        self.latest_run_id = run_id
+        if run_id is not None:
             # 获取该workflow run的artifacts
-            artifacts_url = f'https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/actions/runs/{run_id}/artifacts'
-            response = requests.get(artifacts_url, headers=headers)
-            response.raise_for_status()  # 确保请求成功
-            artifacts = response.json()
+            artifacts_url = f'{self.api_url}/repos/{REPO_OWNER}/{REPO_NAME}/actions/runs/{run_id}/artifacts'
+            artifacts = self.metadata_cache.get_json(self.http_client, artifacts_url, headers)
 
             if 'artifacts' in artifacts and artifacts['artifacts']:
-                for artifact in artifacts['artifacts']:
-                    if artifact['name'] == ('ZBProxy-linux-amd64-v3' if ('v3' in self.cpu_model) else 'ZBProxy-linux-amd64-v1'):
-                        artifact_id = artifact['id']
-                        break
-                else:
+                # 选择这个CPU能运行的最快的构建
+                self.latest_artifacts = {artifact['name']: artifact['id'] for artifact in artifacts['artifacts']}
+                self.latest_artifact = self.cpu.choose(self.latest_artifacts)
+                if self.latest_artifact is None:
                     print('没有找到指定名称的artifact，则返回None')
                     return None  # 如果没有找到指定名称的artifact，则返回None
-
-                # 获取artifact下载URL
-                download_url = f'https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/actions/artifacts/{artifact_id}/zip'
-                response = requests.get(download_url, headers=headers, allow_redirects=False)
-                response.raise_for_status()  # 确保请求成功
-
-                if response.status_code == 302:  # 重定向
-                    download_redirect_url = response.headers['Location']
-                    return download_redirect_url
-                else:
-                    print('下载链接获取失败，则返回None')
-                    return None  # 如果下载链接获取失败，则返回None
+                print(f"Using {self.latest_artifact} for this {self.cpu.label} CPU")
+                return self.artifact_download_url(token, self.latest_artifacts[self.latest_artifact])
             else:
                 print('没有找到artifacts，则返回None')
                 return None  # 如果没有找到artifacts，则返回None
         else:
-            print('没有找到workflow runs，则返回None')
-            return None  # 如果没有找到workflow runs，则返回None
+            return None
 
-    def unzip_zbproxy(self):
-        self.system_control.install_package('unzip')
-        self.system_control.run_command('unzip zbproxy.zip')
-        self.system_control.run_command('rm -rf zbproxy.zip')
+    def artifact_download_url(self, token, artifact_id):
+        """Return the signed download URL of an artifact, or None."""
+        # 获取artifact下载URL, 签名链接会过期，不缓存
+        download_url = f'{self.api_url}/repos/layou233/ZBProxy/actions/artifacts/{artifact_id}/zip'
+        response = self.http_client.get(download_url, headers=self.github_headers(token), allow_redirects=False)
+        response.raise_for_status()  # 确保请求成功
+
+        if response.status_code == 302:  # 重定向
+            return response.headers['Location']
+        print('下载链接获取失败，则返回None')
+        return None  # 如果下载链接获取失败，则返回None
+
+    def mirror_build(self, run_id=None):
+        """(run id, artifact, SHA-256) of the newest build, or of run_id, on the mirror that this CPU can run, or None."""
+        import requests
+        try:
+            response = self.http_client.get(f'{self.MIRROR}/builds')
+            response.raise_for_status()
+            builds = response.json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Mirror {self.MIRROR} is unavailable, using GitHub: {e}")
+            return None
+        runs = sorted({build["run_id"] for build in builds if run_id is None or str(build["run_id"]) == str(run_id)},
+                      key=lambda run: int(run), reverse=True)
+        for run in runs:
+            by_artifact = {build["artifact"]: build for build in builds if build["run_id"] == run}
+            artifact = self.cpu.choose(by_artifact)
+            if artifact:
+                return run, artifact, by_artifact[artifact]["sha256"]
+        return None
+
+    def latest_zbproxy_run_id(self):
+        """The newest workflow run, on the mirror if one is set and up, else on GitHub."""
+        build = self.mirror_build() if self.MIRROR else None
+        return build[0] if build else self.get_latest_run_id(self.token)
+
+    def build_source(self, run_id, from_github: bool = True):
+        """Return stage(path) for a run's build: from the build cache, else the mirror, else GitHub; None if none has it.
+
+        GitHub only has the latest run's builds, rolling back to an older run leaves it out with from_github False.
+        Sets latest_artifact to the build it will stage.
+        """
+        cached = self.build_cache.find(run_id, self.cpu)
+        if cached:
+            self.latest_artifact = cached["artifact"]
+            return lambda path: self.build_cache.install(cached, path)
+        build = self.mirror_build(run_id) if self.MIRROR else None
+        if build:
+            self.latest_artifact, sha256 = build[1], build[2]
+            print(f"Using {self.latest_artifact} of run {run_id} from the mirror")
 
-    def update_zbproxy(self):
+            def from_mirror(path):
+                result = self.network_control.download_file(f'{self.MIRROR}/builds/{sha256}', path, sha256)
+                if result.endswith('downloaded successfully'):
+                    os.chmod(path, 0o755)
+                return result
+            return from_mirror
+        if not from_github:
+            return None
+        download_url = self.get_latest_artifact_download_url(self.token)
+        if not download_url or str(self.latest_run_id) != str(run_id):
+            return None
+        return lambda path: self.network_control.download_zip_member(download_url, self.ZBPROXY_MEMBER, path)
+
+    def cache_latest_builds(self):
+        """Fetch every build of the latest run that is not cached yet, for a mirror to serve any CPU."""
+        if self.get_latest_artifact_download_url(self.token) is None:
+            return []
+        fetched = []
+        for artifact, artifact_id in self.latest_artifacts.items():
+            if any(entry["artifact"] == artifact and str(entry["run_id"]) == str(self.latest_run_id)
+                   for entry in self.build_cache.entries().values()):
+                continue
+            os.makedirs(self.build_cache.directory, exist_ok=True)
+            staged_path = os.path.join(self.build_cache.directory, f'{artifact}.download')
+            result = self.network_control.download_zip_member(self.artifact_download_url(self.token, artifact_id),
+                                                              self.ZBPROXY_MEMBER, staged_path)
+            if result.endswith('downloaded successfully'):
+                self.build_cache.add(self.latest_run_id, artifact, staged_path)
+                os.remove(staged_path)
+                fetched.append(artifact)
+        return fetched
+
+    def update_zbproxy(self, force: bool = False, run_id=None):
+        """Install the newest build, or with run_id a cached (or mirrored) earlier one, which is how to roll back."""
         print("Updating ZBProxy...")
         try:
-            download_url = self.get_latest_artifact_download_url(self.token)
-            if download_url:
-                self.system_control.run_command('rm -rf zbproxy')
-                self.network_control.download_file(download_url, 'zbproxy.zip')
-                self.unzip_zbproxy()
-                self.system_control.run_command(f"mv {('ZBProxy-linux-amd64-v3' if ('v3' in self.cpu_model) else 'ZBProxy-linux-amd64-v1')} zbproxy")
-                self.system_control.run_command('sudo chmod +x zbproxy')
-                self.system_control.run_command('sudo systemctl restart ZBProxy')
+            latest_run_id = self.latest_zbproxy_run_id() if run_id is None else run_id
+            if not force and latest_run_id is not None and str(latest_run_id) == str(self.get_installed_run_id()) and self.installed_for_this_cpu():
+                print(f"ZBProxy is already up to date (run {latest_run_id}, {self.cpu.label}).")
+                return "ZBProxy is already up to date."
+            stage = self.build_source(latest_run_id, from_github=run_id is None) if latest_run_id is not None else None
+            if stage:
+                # The running binary is untouched until the new build is staged and smoke tested
+                units = ' '.join(ZBProxyShards(system_control=self.system_control).units())
+                deployment = BlueGreenUpdate(lambda: self.system_control.run_command(f"sudo systemctl restart {units}"),
+                                             is_active=lambda: self.system_control.run_command(f"systemctl is-active --quiet {units}")[1] == 0)
+                result = deployment.run(stage)
+                if result != "ZBProxy updated successfully.":
+                    print(result)
+                    return result
+                self.latest_run_id = latest_run_id
+                sha256 = self.cache_installed_build(latest_run_id, deployment.binary_path)
+                self.record_installed_build(latest_run_id, deployment.outage_seconds, sha256)
                 print("ZBProxy updated successfully.")
                 return "ZBProxy updated successfully."
+            elif run_id is not None:
+                print(f"Failed to update ZBProxy: run {run_id} is not in the build cache or on the mirror.")
+                return f"Failed to update ZBProxy: run {run_id} is not in the build cache or on the mirror."
             else:
                 print("Failed to get the download URL.")
                 return "Failed to get the download URL."
@@ -539,13 +3860,11 @@ class ProgramControl:
             print(f"Failed to update ZBProxy: {str(e)}")
             return f"Failed to update ZBProxy: {str(e)}"
 
-    @staticmethod
-    def get_latest_release_download_url(repo_owner, repo_name, asset_name):
+    def get_latest_release_download_url(self, repo_owner, repo_name, asset_name):
+        """Download URL of an asset of the latest release, None if it has no such asset."""
         # 获取最新的release
-        releases_url = f'https://api.github.com/repos/{repo_owner}/{repo_name}/releases/latest'
-        response = requests.get(releases_url)
-        response.raise_for_status()  # 确保请求成功
-        release = response.json()
+        releases_url = f'{self.api_url}/repos/{repo_owner}/{repo_name}/releases/latest'
+        release = self.metadata_cache.get_json(self.http_client, releases_url)
 
         # 检查release中的assets
         if 'assets' in release and release['assets']:
@@ -553,63 +3872,670 @@ class ProgramControl:
                 if asset['name'] == asset_name:
                     download_url = asset['browser_download_url']
                     return download_url
-            return "No matching asset found in the latest release."
+            print("No matching asset found in the latest release.")
         else:
-            return "No assets found in the latest release."
+            print("No assets found in the latest release.")
+        return None
     
     def upgrade_program(self):
         print("Updating program...")
         try:
+            download_url = self.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy')
+            if download_url is None:
+                print("Failed to get the download URL.")
+                return "Failed to get the download URL."
+
             # 备份旧版本
             self.system_control.run_command('sudo mv OProxy OProxy.old')
             
             # 下载新版本
-            download_url = self.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy')
-            if download_url:
-                self.network_control.download_file(download_url, 'OProxy')
-                self.system_control.run_command('sudo rm -rf OProxy.old')
-                self.system_control.run_command('sudo chmod +x OProxy')
-                print("Program updated successfully.")
-                return "Program updated successfully."
-            else:
-                print("Failed to get the download URL.")
-                return "Failed to get the download URL."
+            result = self.network_control.download_file(download_url, 'OProxy')
+            if not result.endswith('downloaded successfully'):
+                self.system_control.run_command('sudo mv OProxy.old OProxy')  # Put the old version back
+                return result
+            self.system_control.run_command('sudo rm -rf OProxy.old')
+            self.system_control.run_command('sudo chmod +x OProxy')
+            print("Program updated successfully.")
+            return "Program updated successfully."
         except Exception as e:
             print(f"Failed to upgrade program: {str(e)}")
             return f"Failed to upgrade program: {str(e)}"
 
 
 
+class ThreadOutput:
+    """Class to give each thread its own sys.stdout/sys.stderr, so concurrent agent requests keep their output apart."""
+
+    def __init__(self, fallback):
+        """Initialize ThreadOutput object, writing to fallback outside of requests."""
+        self.fallback = fallback
+        self.local = threading.local()
+
+    @property
+    def stream(self):
+        """The stream the calling thread writes to."""
+        return getattr(self.local, 'stream', None) or self.fallback
+
+    def capture(self):
+        """Start collecting the calling thread's output."""
+        self.local.stream = io.StringIO()
+
+    def release(self):
+        """Stop collecting and return what the calling thread wrote."""
+        stream, self.local.stream = self.local.stream, None
+        return stream.getvalue()
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        """Like contextlib.redirect_stdout, but only for the calling thread."""
+        previous, self.local.stream = getattr(self.local, 'stream', None), target
+        try:
+            yield target
+        finally:
+            self.local.stream = previous
+
+    def write(self, text):
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+class Agent:
+    """Class to serve Main.run over a Unix socket, keeping config and connections warm between commands."""
+
+    SOCKET_PATH = os.path.join(STATE_DIR, 'agent.sock')
+
+    # Commands that only read, they run alongside each other; everything else runs one at a time
+    READ_ONLY = [
+        ["transit", "whitelist", "export"],
+        ["changes", "show"],
+        ["agent", "status"],
+        ["shard", "show"],
+        ["mirror", "list"],
+        ["watchdog", "status"],
+        ["failover", "status"],
+    ]
+
+    # Commands the thin client always runs itself: long-running, or reading its stdin or files
+    LOCAL = [
+        ["agent", "serve"],
+        ["benchmark"],
+        ["fleet"],
+        ["probe"],
+        ["metrics"],
+        ["logs"],
+        ["mirror", "serve"],
+        ["apply"],
+        ["watchdog", "run"],
+        ["failover", "run"],
+    ]
+
+    def __init__(self, main: 'Main', socket_path: str = None) -> None:
+        """Initialize Agent object."""
+        self.main = main
+        self.socket_path = socket_path or self.SOCKET_PATH
+        self.started = time.time()
+        self.served = 0
+        self.loop = None  # Set up by serve()
+        self.write_lock = None
+        self.stopped = None
+
+    @staticmethod
+    def matches(args: list, commands: list):
+        """Check whether args (without the program name) start with one of the commands."""
+        return any(args[:len(command)] == command for command in commands)
+
+    @classmethod
+    def runs_locally(cls, args: list):
+        """Check whether the thin client has to run args (without the program name) itself."""
+        return (cls.matches(args, cls.LOCAL) or "--debounce" in args
+                or (args[:3] == ["transit", "whitelist", "import"] and args[4:5] == ["-"]))
+
+    def status(self):
+        """Describe the running agent."""
+        return {
+            "pid": os.getpid(),
+            "socket": os.path.abspath(self.socket_path),
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "requests_served": self.served,
+        }
+
+    def execute(self, args: list):
+        """Run one command in a worker thread and collect its output."""
+        sys.stdout.capture()
+        sys.stderr.capture()
+        error = None
+        try:
+            exit_code = self.main.run([sys.argv[0]] + args)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            error, exit_code = f"{type(e).__name__}: {e}", 1
+        if exit_code and error is None:
+            error = f"exited with {exit_code}"
+        self.served += 1
+        return {"stdout": sys.stdout.release(), "stderr": sys.stderr.release(), "error": error, "exit_code": exit_code}
+
+    async def handle(self, reader, writer):
+        """Answer newline-delimited JSON requests {"id", "args"} on one connection."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    args = [str(arg) for arg in request["args"]]
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"id": None, "stdout": "", "stderr": "", "error": f"bad request: {e}", "exit_code": 2}
+                else:
+                    if self.matches(args, self.READ_ONLY):
+                        response = await loop.run_in_executor(None, self.execute, args)
+                    else:
+                        async with self.write_lock:
+                            response = await loop.run_in_executor(None, self.execute, args)
+                    response["id"] = request.get("id")
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # Client gone, or the agent is stopping
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Listen on the socket until stopped."""
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        self.write_lock = asyncio.Lock()
+        self.stopped = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():  # Tests serve from a side thread
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, self.stopped.set)
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)  # Left behind by an agent that did not stop cleanly
+        umask = os.umask(0o177)  # Bound owner-only, a chmod after the bind leaves a window for other users to connect
+        try:
+            server = await asyncio.start_unix_server(self.handle, self.socket_path, limit=2 ** 24)
+        finally:
+            os.umask(umask)
+        print(f"Agent listening on {self.socket_path}")
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+        print("Agent stopped")
+
+    def stop(self):
+        """Stop serving, from any thread; the current request still gets its answer."""
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def run(self):
+        """Serve in the foreground, until SIGINT/SIGTERM or `agent stop`."""
+        import asyncio
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+        HandleJsonFile.enable_cache()
+        self.main.agent = self
+        asyncio.run(self.serve())
+
+
+class AgentClient:
+    """Class for the thin CLI: hand a command to a running agent."""
+
+    @staticmethod
+    def request(args: list, socket_path: str = Agent.SOCKET_PATH, request_id=None):
+        """Send one command line (without the program name) and return the agent's answer."""
+        import socket
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps({"id": request_id, "args": args}).encode() + b'\n')
+            chunks = []
+            while not chunks or not chunks[-1].endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ConnectionError("agent closed the connection")
+                chunks.append(chunk)
+        return json.loads(b''.join(chunks))
+
+    @classmethod
+    def forward(cls, argv: list, socket_path: str = Agent.SOCKET_PATH):
+        """Run argv through the agent if one is listening; False means run it here."""
+        args = argv[1:]
+        if not args or Agent.runs_locally(args) or not os.path.exists(socket_path):
+            return False
+        try:
+            response = cls.request(args, socket_path)
+        except (ConnectionError, FileNotFoundError, OSError):
+            return False  # Stale socket, nobody is serving it
+        sys.stdout.write(response["stdout"])
+        sys.stderr.write(response["stderr"])
+        if response["error"]:
+            print(f"Agent: {response['error']}", file=sys.stderr)
+            sys.exit(response.get("exit_code") or 1)  # An agent from before exit codes only sends the error
+        return True
+
+
+class SshTransport:
+    """Class to run OProxy on a fleet host over ssh, reusing one master connection per host."""
+
+    def __init__(self, timeout: float = 120) -> None:
+        """Initialize SshTransport object, timeout bounds each command."""
+        self.timeout = timeout
+
+    @staticmethod
+    def command(host: dict, args: list):
+        """Build the ssh command line running args in the host's OProxy directory."""
+        import shlex
+        user = host.get("user", "root")
+        sudo = "" if user == "root" else "sudo -n "
+        remote = f"cd {shlex.quote(host.get('dir', '/root'))} && {sudo}{host.get('command', './OProxy')} {shlex.join(args)}"
+        return ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=10",
+                # Retries and the next fleet command skip the handshake
+                "-o", "ControlMaster=auto", "-o", "ControlPath=~/.ssh/oproxy-%C", "-o", "ControlPersist=60",
+                "-p", str(host.get("port", 22)), f"{user}@{host['address']}", remote]
+
+    def run(self, host: dict, args: list):
+        """Run args on host, returning (output, returncode); 255 means ssh itself failed."""
+        try:
+            completed = subprocess.run(self.command(host, args), capture_output=True, text=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return f"Timed out after {self.timeout}s", 255
+        return completed.stdout + completed.stderr, completed.returncode
+
+
+class Fleet:
+    """Class to run one OProxy command on many hosts from an inventory, a bounded number at a time."""
+
+    INVENTORY = 'fleet.json'
+    TRANSPORTS = {"ssh": SshTransport}
+
+    def __init__(self, inventory_path: str = INVENTORY, transports: dict = None) -> None:
+        """Initialize Fleet object, transports overrides the transport built for a kind of host."""
+        inventory_file = HandleJsonFile(inventory_path)
+        if not inventory_file.file_exists():
+            print(f"Inventory {inventory_path} not found")
+            sys.exit(1)
+        self.inventory = inventory_file.read_json()
+        self.concurrency = self.inventory.get("concurrency", 8)
+        self.retries = self.inventory.get("retries", 2)
+        self.backoff = self.inventory.get("backoff", 1)
+        self.transports = dict(transports or {})
+
+    def transport(self, host: dict):
+        """Return the transport for a host, one shared instance per kind."""
+        kind = host.get("transport", "ssh")
+        if kind not in self.transports:
+            self.transports[kind] = self.TRANSPORTS[kind]()
+        return self.transports[kind]
+
+    def select(self, args: list, selector: str = None):
+        """Pick hosts by a comma-separated list of names and roles, or by the command's role (transit/proxy)."""
+        hosts = self.inventory["hosts"]
+        if selector:
+            wanted = set(selector.split(','))
+            return [host for host in hosts if host["name"] in wanted or host.get("role") in wanted]
+        return [host for host in hosts if host.get("role") in (None, args[0])]
+
+    def run_on(self, host: dict, args: list):
+        """Run args on one host, retrying with backoff, and time it."""
+        started = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            output, returncode = self.transport(host).run(host, args)
+            if returncode == 0:
+                break
+            if attempt < self.retries:
+                time.sleep(min(self.backoff * 2 ** attempt, 30) * random.uniform(0.5, 1))
+        return {
+            "host": host["name"],
+            "ok": returncode == 0,
+            "returncode": returncode,
+            "attempts": attempt + 1,
+            "seconds": round(time.perf_counter() - started, 3),
+            "output": output,
+        }
+
+    def run(self, args: list, selector: str = None, concurrency: int = None, quiet: bool = False):
+        """Run args on the selected hosts and return the per-host results in inventory order."""
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        hosts = self.select(args, selector)
+        streams = sys.stdout, sys.stderr
+        if not isinstance(sys.stdout, ThreadOutput):  # Keep each host's output apart
+            sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+        results = {}
+        try:
+            with ThreadPoolExecutor(concurrency or self.concurrency) as pool:
+                futures = [pool.submit(self.run_on, host, args) for host in hosts]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[result["host"]] = result
+                    if not quiet:
+                        print(f"{'ok' if result['ok'] else 'FAILED':<8}{result['host']:<24}"
+                              f"{result['attempts']} attempt(s)  {result['seconds']:.2f}s")
+        finally:
+            sys.stdout, sys.stderr = streams
+        return [results[host["name"]] for host in hosts]
+
+
+class Benchmark:
+    """Class to measure OProxy itself, so performance regressions show up."""
+
+    # Subcommands timed by the startup benchmark, run against a scratch transit config
+    STARTUP_COMMANDS = [
+        ["transit", "whitelist", "add", "bench_player", "bench_group"],
+        ["transit", "whitelist", "remove", "bench_player", "bench_group"],
+        ["transit", "whitelist", "on", "bench_group"],
+        ["transit", "target", "remove", "bench_group"],
+        ["proxy", "transit", "add", "127.0.0.1"],
+        ["proxy", "hostname", "on"],
+    ]
+
+    @staticmethod
+    def summarize(samples):
+        """Summarize a list of timings in milliseconds."""
+        ordered = sorted(samples)
+        return {
+            "runs": len(ordered),
+            "min_ms": round(ordered[0], 2),
+            "median_ms": round(statistics.median(ordered), 2),
+            "max_ms": round(ordered[-1], 2),
+        }
+
+    @staticmethod
+    def parse_importtime(stderr: str, top: int = 10):
+        """Parse `-X importtime` output into the slowest top-level imports."""
+        imports = []
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            if name.startswith("  "):  # Nested import, already counted by its parent
+                continue
+            imports.append((int(cumulative_us), name.strip()))
+        imports.sort(reverse=True)
+        return imports[:top]
+
+    @staticmethod
+    def seed_work_dir(work_dir: str):
+        """Write a config.json and a one-service transit ZBProxy.json into work_dir."""
+        with open(os.path.join(work_dir, "config.json"), 'w') as file:
+            json.dump({"token": "bench"}, file)
+        with open(os.path.join(work_dir, "ZBProxy.json"), 'w') as file:
+            json.dump({
+                "Services": [MinecraftTransitService("127.0.0.1", 25565, 25566, "bench_group").service_dict],
+                "Lists": {"bench_group": [], "TransitServerIP": []}
+            }, file, indent=4)
+
+    def startup(self, runs: int = 5):
+        """Measure wall-clock time and import time of each CLI subcommand."""
+        print(f"Benchmarking startup over {runs} runs per command...")
+        results = {}
+        with tempfile.TemporaryDirectory() as work_dir:
+            for command in self.STARTUP_COMMANDS:
+                samples = []
+                for _ in range(runs):
+                    # Fresh config each run so every command does the same work
+                    self.seed_work_dir(work_dir)
+                    started = time.perf_counter()
+                    subprocess.run(self_command() + command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    samples.append((time.perf_counter() - started) * 1000)
+                results[" ".join(command)] = self.summarize(samples)
+                print(f"{' '.join(command):<50} median {results[' '.join(command)]['median_ms']:>8} ms")
+
+            if "__compiled__" not in globals():
+                self.seed_work_dir(work_dir)
+                completed = subprocess.run([sys.executable, "-X", "importtime"] + self_command()[1:] + self.STARTUP_COMMANDS[0],
+                                           cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+                print("Slowest imports (cumulative us):")
+                for cumulative_us, name in self.parse_importtime(completed.stderr):
+                    print(f"{cumulative_us:>10}  {name}")
+                results["importtime"] = self.parse_importtime(completed.stderr)
+        return results
+
+    def tune(self, connections: int = 2000, megabytes: int = 256):
+        """Compare loopback accept bursts and throughput on this host, stock against tuned; run it before and after `tune apply`."""
+        import socket
+        results = {}
+        # This host, as it is now: run before and after `tune apply` to compare
+        host = NetworkTuning()
+        host_profile = host.profile()
+        results["host"] = {row["key"]: row["current"] for row in host.show()}
+        somaxconn = int(host.read('net.core.somaxconn') or 4096)
+
+        # Accept burst: clients connect while nothing accepts, the listen backlog decides how many get in at once
+        import resource
+        connections = min(connections, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 64)
+        bursts = {}
+        for label, backlog in (("backlog_128", 128), ("backlog_somaxconn", somaxconn)):
+            with socket.socket() as listener, selectors.DefaultSelector() as selector:
+                listener.bind(('127.0.0.1', 0))
+                listener.listen(backlog)  # The kernel caps it at somaxconn
+                clients = []
+                try:
+                    started = time.perf_counter()
+                    for _ in range(connections):
+                        client = socket.socket()
+                        client.setblocking(False)
+                        client.connect_ex(listener.getsockname())
+                        clients.append(client)
+                        selector.register(client, selectors.EVENT_WRITE)
+                    connected = 0
+                    deadline = time.perf_counter() + 0.5  # Well under the 1 s SYN retransmit
+                    while connected < connections and time.perf_counter() < deadline:
+                        for key, _ in selector.select(0.05):
+                            selector.unregister(key.fileobj)
+                            connected += 1
+                    bursts[label] = {"backlog": min(backlog, somaxconn), "connected_in_500ms": connected,
+                                     "seconds": round(time.perf_counter() - started, 3)}
+                finally:
+                    for client in clients:
+                        client.close()
+        results["accept_burst"] = {"clients": connections, **bursts}
+
+        # Bulk throughput with the kernel's default buffers, and with the profile's buffer size asked for per socket
+        def throughput(buffer_size):
+            chunk = memoryview(bytearray(1 << 20))
+            with socket.socket() as listener:
+                if buffer_size:
+                    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+                listener.bind(('127.0.0.1', 0))
+                listener.listen(1)
+                received = [0]
+
+                def receive():
+                    connection, _ = listener.accept()
+                    with connection:
+                        buffer = bytearray(1 << 20)
+                        while (count := connection.recv_into(buffer)):
+                            received[0] += count
+                thread = threading.Thread(target=receive)
+                thread.start()
+                with socket.socket() as client:
+                    if buffer_size:
+                        client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+                    client.connect(listener.getsockname())
+                    effective = client.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+                    started = time.perf_counter()
+                    for _ in range(megabytes):
+                        client.sendall(chunk)
+                    client.shutdown(socket.SHUT_WR)
+                    thread.join()
+                seconds = time.perf_counter() - started
+            return {"send_buffer": effective, "mb_per_second": round(received[0] / 1e6 / seconds)}
+        results["throughput"] = {
+            "stock": throughput(None),
+            "profile_buffers": throughput(int(host_profile["net.core.wmem_max"])),
+        }
+        print(f"burst {bursts['backlog_128']['connected_in_500ms']} vs {bursts['backlog_somaxconn']['connected_in_500ms']} connected, "
+              f"{results['throughput']['stock']['mb_per_second']} vs {results['throughput']['profile_buffers']['mb_per_second']} MB/s")
+        return results
+
+    def cpu(self, binaries: list = None):
+        """Detect the psABI level of this host, then load test given ZBProxy builds of different levels."""
+        results = {}
+        host = CpuFeatures()
+        results["host"] = {"machine": host.machine, "label": host.label, "candidates": host.candidates()}
+        # Builds of different levels (e.g. zbproxy-v1 and zbproxy-v3 unzipped from their artifacts) under the same load
+        for binary in binaries or []:
+            result = self.load(variants=["transit"], binary_path=binary)
+            result = result.get("transit", result)
+            results[f"load {binary}"] = {key: result.get(key) for key in ("connections_per_second", "bytes_per_second", "error_rate", "error")}
+        print(f"This host is {host.label}")
+        return results
+
+    @staticmethod
+    def wait_for_status(port: int, timeout: float = 10):
+        """Status ping a local port until it answers, returns the status or None."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                return MinecraftProtocol.status_ping('127.0.0.1', port, timeout=1)['status']
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        return None
+
+    # Config variants for the load benchmark: base,option=value,... (flow=<Flow>, rewrite=on|off, whitelist=on|off)
+    LOAD_VARIANTS = ["transit", "transit,whitelist=off", "proxy", "proxy,rewrite=off"]
+
+    @staticmethod
+    def load_config(variant: str, upstream_port: int, listen_port: int, names: list):
+        """Build a ZBProxy.json for a load variant, from the same generators setup uses."""
+        base, *options = variant.split(',')
+        options = dict(option.split('=', 1) for option in options)
+        if base == "proxy":
+            service = ProxyServer.service_config('127.0.0.1', upstream_port, listen_port)
+            lists = {"TransitServerIP": ["127.0.0.1"]}  # The hostname the clients connect with
+        else:
+            service = MinecraftTransitService('127.0.0.1', upstream_port, listen_port, 'LoadTest').service_dict
+            lists = {"LoadTest": names}
+        if "flow" in options:
+            service["Flow"] = options["flow"]
+        if "rewrite" in options:
+            service["Minecraft"]["EnableHostnameRewrite"] = options["rewrite"] == "on"
+        if "whitelist" in options:
+            service["Minecraft"]["NameAccess"] = {"Mode": "allow", "ListTags": ["LoadTest"]} if options["whitelist"] == "on" else {"Mode": ""}
+            lists.setdefault("LoadTest", names)
+        return {"Services": [service], "Lists": lists}
+
+    def load(self, clients: int = 2000, concurrency: int = 200, payload_kb: int = 64, variants: list = None,
+             binary_path: str = 'zbproxy'):
+        """Drive simulated clients through ZBProxy in front of a stand-in upstream, once per config variant."""
+        if not os.access(binary_path, os.X_OK):
+            print(f"No ZBProxy build at {binary_path}, run `OProxy proxy update` or pass one")
+            return {"error": f"no ZBProxy build at {binary_path}"}
+        names = [f"Player{i}" for i in range(clients)]
+        print(f"Load testing {binary_path} in front of a stand-in upstream...")
+        results = {}
+        with tempfile.TemporaryDirectory() as work_dir:
+            for variant in variants or self.LOAD_VARIANTS:
+                listen_port = BlueGreenUpdate.spare_port()
+                upstream_port = BlueGreenUpdate.spare_port()
+                config = self.load_config(variant, upstream_port, listen_port, names)
+                with open(os.path.join(work_dir, 'ZBProxy.json'), 'w') as file:
+                    json.dump(config, file)
+                processes = []
+                try:
+                    upstream = {"Services": [{"Name": "Upstream", "Listen": upstream_port}]}
+                    with open(os.path.join(work_dir, 'upstream.json'), 'w') as file:
+                        json.dump(upstream, file)
+                    # The upstream runs in its own process, so it does not share the clients' interpreter
+                    processes.append(subprocess.Popen(self_command() + ["benchmark", "load-upstream", "upstream.json"],
+                                                      cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                    processes.append(subprocess.Popen([os.path.abspath(binary_path)], cwd=work_dir,
+                                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                    if self.wait_for_status(listen_port) is None:
+                        print(f"{variant:<28}nothing answered on the Listen port")
+                        results[variant] = {"error": "nothing answered on the Listen port"}
+                        continue
+                    results[variant] = LoadGenerator('127.0.0.1', listen_port, clients, concurrency,
+                                                     payload_kb * 1024, names=names).run()
+                finally:
+                    for process in processes:
+                        process.terminate()
+                        process.wait()
+                result = results[variant]
+                print(f"{variant:<28}{result['connections_per_second']:>9} conn/s  status p95 {result['handshake_status']['p95_ms']} ms  "
+                      f"login p95 {result['login']['p95_ms']} ms  {result['bytes_per_second'] / 1e6:.1f} MB/s  errors {result['error_rate']:.2%}")
+        return results
+
 
 class Main:
     """Main class to orchestrate setup and execution of proxy and transit servers."""
     
-    def __init__(self) -> None:
+    def __init__(self, load_config: bool = True, system_control: 'SystemControl' = None,
+                 config_path: str = 'ZBProxy.json') -> None:
         """Initialize Main object."""
         self.config = HandleJsonFile("config.json")
+        self.token = None
+        self.system_control = system_control
+        self.config_path = config_path
+        self.agent = None  # The Agent serving this Main, if any
+        self.command = threading.local()  # Per thread, the exit_code of the command it runs; the agent runs several at once
+        if not load_config:  # Local-only commands and tests need no token
+            return
         if self.config.create_file():
             self.config.write_json({"token": "your_token"})
             print('config.json created, please edit it and restart the program.')
             sys.exit()
         else:
             print("config.json exists, continue...")
-            self.token = self.config.read_json()["token"]
-            self.program_control = ProgramControl(self.token)
-            self.proxy_server = ProxyServer(self.token)
-            self.transit_server = TransitServer(self.token)
+            config = self.config.read_json()
+            self.token = config["token"]
+            # Optional "http" settings: connect_timeout, read_timeout, retries, backoff, max_backoff
+            HttpClient.shared(**config.get("http", {}))
+            # Seconds GitHub metadata is trusted before it is revalidated with its ETag
+            MetadataCache.shared(ttl=config.get("metadata_ttl", 60))
+            # Builds come from this `OProxy mirror serve` instead of GitHub, and the local cache is kept under a size
+            ProgramControl.MIRROR = (config.get("mirror") or '').rstrip('/') or None
+            BuildCache.MAX_BYTES = int(config.get("build_cache_mb", BuildCache.MAX_BYTES // 1024 // 1024)) * 1024 * 1024
+
+    # Subsystems are built on first use, so each command only pays for what it touches
+
+    @functools.cached_property
+    def program_control(self):
+        return ProgramControl(self.token)
+
+    @functools.cached_property
+    def proxy_server(self):
+        return ProxyServer(self.token, self.system_control, self.config_path)
+
+    @functools.cached_property
+    def transit_server(self):
+        return TransitServer(self.token, self.system_control, self.config_path)
+
+    # A subsystem result starting with one of these means the command failed
+    FAILURES = ('Failed', 'Not found')
 
-    def update_zbproxy(self):
-        """Update ZBProxy."""
+    def fail(self, message: str = None, exit_code: int = 1):
+        """Print why the command failed, if given, and make it exit with exit_code."""
+        if message is not None:
+            print(message)
+        self.command.exit_code = exit_code
+
+    def report(self, result):
+        """Print a subsystem's result, failing the command when it is a failure."""
+        print(result)
+        if isinstance(result, str) and result.startswith(self.FAILURES):
+            self.command.exit_code = 1
+
+    def update_zbproxy(self, force: bool = False, run_id=None):
+        """Update ZBProxy, or with run_id roll back to an earlier build."""
         print("Updating ZBProxy...")
-        print(self.program_control.update_zbproxy())
-        print("ZBProxy updated successfully.")
-        return "ZBProxy updated successfully."
+        result = self.program_control.update_zbproxy(force, run_id)
+        self.report(result)
+        return result
 
     def upgrade_program(self):
         """Upgrade the program."""
         print("Upgrading program...")
-        print(self.program_control.upgrade_program())
-        print("Program upgraded successfully.")
+        self.report(self.program_control.upgrade_program())
 
     def setup_proxy_server(self, target_ip, target_port, listen_port):
         """Set up the proxy server."""
@@ -635,12 +4561,20 @@ class Main:
     def add_a_transit_server_for_proxy(self, transit_server_hostname: str):
         """Add a transit server for the proxy server."""
         print("Adding a transit server...")
-        print(self.proxy_server.add_transit_server_ip(transit_server_hostname))
+        self.report(self.proxy_server.add_transit_server_ip(transit_server_hostname))
     
     def remove_a_transit_server_for_proxy(self, transit_server_hostname: str):
         """Remove a transit server for the proxy server."""
         print("Removing a transit server...")
-        print(self.proxy_server.remove_transit_server_ip(transit_server_hostname))
+        self.report(self.proxy_server.remove_transit_server_ip(transit_server_hostname))
+
+    def add_upstream(self, address: str):
+        """Add an upstream to the proxy server's failover pool."""
+        self.report(self.proxy_server.add_upstream(address))
+
+    def remove_upstream(self, address: str):
+        """Remove an upstream from the proxy server's failover pool."""
+        self.report(self.proxy_server.remove_upstream(address))
 
 
     def add_a_transit_service(self, target_ip, target_port, listen_port, service_name):
@@ -651,7 +4585,8 @@ class Main:
     def remove_a_transit_service(self, service_name):
         """Remove a transit service from the transit server."""
         print("Removing a transit service...")
-        self.transit_server.remove_service(service_name)
+        if self.transit_server.remove_service(service_name) is None:
+            self.fail(f"Not found: no service {service_name}")
 
 
     
@@ -660,22 +4595,392 @@ class Main:
     def add_to_whitelist(self, name: str, group: str):
         """Add an item to a whitelist in the transit server."""
         print(f"Adding {name} to the {group}...")
-        print(self.transit_server.add_whitelist(name, group))
+        self.report(self.transit_server.add_whitelist(name, group))
 
     def remove_from_whitelist(self, name: str, group: str):
         """Remove an item from a whitelist in the transit server."""
         print(f"Removing {name} from the {group}...")
-        print(self.transit_server.remove_whitelist(name, group))
+        self.report(self.transit_server.remove_whitelist(name, group))
+
+    def import_whitelist(self, group: str, source: str, merge: bool = False):
+        """Import a whitelist from a file, or from stdin with "-"."""
+        print(f"Importing {group} from {source}...")
+        with (contextlib.nullcontext(sys.stdin) if source == '-' else open(source)) as stream:
+            self.report(self.transit_server.import_whitelist(group, stream, merge))
+
+    def export_whitelist(self, group: str, target: str = '-'):
+        """Export a whitelist to a file, or to stdout with "-"."""
+        if target == '-':
+            # Inside the agent, stdout is per request and only this request's logs may move
+            output = getattr(sys.stdout, 'stream', sys.stdout)
+            redirect = getattr(sys.stdout, 'redirect', contextlib.redirect_stdout)
+            with redirect(sys.stderr):  # Keep the names alone on stdout
+                self.report(self.transit_server.export_whitelist(group, output))
+        else:
+            with open(target, 'w') as output:
+                self.report(self.transit_server.export_whitelist(group, output))
 
     def turn_on_whitelist(self, group: str):
         """Turn on the whitelist in the transit server."""
         print(f'Turning on whitelist for {group}...')
-        print(self.transit_server.turn_on_whitelist(group))
+        self.report(self.transit_server.turn_on_whitelist(group) or f"Not found: no service {group}")
 
     def turn_off_whitelist(self, group: str):
         """Turn off the whitelist in the transit server."""
         print(f'Turning off whitelist for {group}...')
-        print(self.transit_server.turn_off_whitelist(group))
+        self.report(self.transit_server.turn_off_whitelist(group) or f"Not found: no service {group}")
+
+    def apply(self, args):
+        """Bring ZBProxy.json to the desired state of a JSON or YAML file."""
+        if len(args) < 3:
+            self.fail("error input : apply needs a desired state file", 2)
+            return
+        as_json = "--json" in args[3:]
+        with contextlib.redirect_stdout(sys.stderr) if as_json else contextlib.nullcontext():  # Keep JSON alone on stdout
+            try:
+                desired = DesiredConfig.load(args[2])
+                result = self.proxy_server.apply_desired(desired, "--dry-run" in args[3:])
+            except (OSError, ValueError) as e:
+                self.fail(f"Failed to apply {args[2]}: {e}")
+                return
+        if as_json:
+            print(json.dumps(result, indent=4))
+            return
+        for change in result["changes"]:
+            print(change)
+        verb = "Would apply" if "--dry-run" in args[3:] else "Applied"
+        print(f"{verb} {len(result['changes'])} changes, ZBProxy {result['action']}")
+
+    # Firewall functions
+
+    def sync_firewall(self, dry_run: bool = False):
+        """Open and close firewall ports to match ZBProxy.json."""
+        print("Syncing firewall rules...")
+        result = self.proxy_server.reconcile_firewall(dry_run)
+        print(result)
+        if result and result.get("error"):
+            self.fail()
+
+    # Change journal functions
+
+    def defer_change(self, args):
+        """Queue a change and make sure a debounced apply will pick it up."""
+        if not ChangeJournal.deferrable(args):
+            self.fail(f"error input : {' '.join(args[1:])} cannot be deferred", 2)
+            return
+        if args[3:4] == ["import"]:
+            args = args[:5] + [os.path.abspath(args[5])] + args[6:]  # Applied later, maybe from elsewhere
+        ChangeJournal().queue(args)
+        debounce = (self.config.read_json() or {}).get("defer_debounce", 2)
+        subprocess.Popen(self_command() + ["changes", "apply", "--debounce", str(debounce)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def apply_changes(self, debounce: float = None):
+        """Apply the queued changes, after `debounce` quiet seconds if given."""
+        journal = ChangeJournal()
+
+        def replay(changes):
+            with self.proxy_server.batch() as summary:
+                for change in changes:
+                    self.run(change["args"])
+            return summary
+
+        if debounce is None:
+            print(journal.apply(replay))
+            return
+        import fcntl
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(os.path.join(STATE_DIR, 'applier.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("Another apply is already waiting for changes")
+                return
+            while journal.pending():
+                idle = journal.idle_seconds()
+                if idle < debounce:
+                    time.sleep(debounce - idle)
+                    continue
+                print(journal.apply(replay))
+
+    def show_changes(self):
+        """Show the queued changes."""
+        for change in ChangeJournal().pending():
+            print(' '.join(change["args"][1:]))
+
+    def discard_changes(self):
+        """Drop the queued changes."""
+        print(f"Discarded {ChangeJournal().discard()} queued changes")
+
+    # Probe functions
+
+    @staticmethod
+    def parse_options(args, defaults: dict):
+        """Split `--name value` options known to defaults from the other arguments."""
+        options, rest = dict(defaults), []
+        while args:
+            if args[0].startswith('--') and args[0][2:] in options and len(args) > 1:
+                options[args[0][2:]] = args[1]
+                args = args[2:]
+            else:
+                rest.append(args[0])
+                args = args[1:]
+        return options, rest
+
+    def probe(self, args):
+        """Rank the service upstreams and transit servers by Minecraft round trip."""
+        options, extra = self.parse_options(args[2:], {"count": 10, "interval": 0.2, "timeout": 3})
+        options = {key: float(value) for key, value in options.items()}
+        as_json = "--json" in extra
+        extra = [arg for arg in extra if arg != "--json"]
+        with contextlib.redirect_stdout(sys.stderr) if as_json else contextlib.nullcontext():  # Keep JSON alone on stdout
+            config = HandleJsonFile(self.config_path)
+            targets = LatencyProbe.targets(config.read_json() or {}) if config.file_exists() else []
+            targets += [(f"target {address}", *LatencyProbe.parse_address(address)) for address in extra]
+            if not targets:
+                self.fail(f"Nothing to probe: no services or TransitServerIP entries in {self.config_path}")
+                return
+            probe = LatencyProbe(int(options["count"]), options["interval"], options["timeout"])
+            print(f"Probing {len(targets)} targets, {probe.count} pings each...")
+            results = probe.run(targets)
+        print(json.dumps(results, indent=4) if as_json else LatencyProbe.table(results))
+
+    # Metrics functions
+
+    def serve_metrics(self, args):
+        """Follow ZBProxy's log and serve Prometheus metrics."""
+        options, flags = self.parse_options(args[3:], {"host": "127.0.0.1", "port": 9464, "source": None})
+        config = HandleJsonFile(self.config_path)
+        metrics = ZBProxyMetrics(config.read_json() if config.file_exists() else None)
+        MetricsExporter(metrics, options["source"], from_start="--from-start" in flags).serve(options["host"], int(options["port"]))
+
+    def logs(self, args):
+        """Index ZBProxy's syslog lines, then answer questions about past sessions from the index."""
+        options, flags = self.parse_options(args[3:], {"source": LogIndex.SOURCES, "player": None, "ip": None,
+                                                        "service": None, "days": None, "top": 10})
+        action = args[2] if len(args) > 2 else None
+        if action not in ("index", "sessions", "rejected", "stale"):
+            self.fail(f'error input {action}', 2)
+            return
+        if action == "sessions" and options["player"] is None and options["ip"] is None:
+            self.fail("error input : logs sessions needs --player or --ip", 2)
+            return
+        index = LogIndex()
+        with contextlib.redirect_stdout(sys.stderr):  # Keep the answer alone on stdout
+            summary = index.index(options["source"]) if action == "index" or "--no-update" not in flags else None
+            config = HandleJsonFile(self.config_path)
+            config = config.read_json() if config.file_exists() else None
+            match action:
+                case "index":
+                    result = summary
+                case "sessions":
+                    result = index.sessions(options["player"], options["ip"], options["service"], float(options["days"] or 7))
+                case "rejected":
+                    result = index.top_rejected(config, float(options["days"] or 7), int(options["top"]))
+                case "stale":
+                    result = index.stale(config, float(options["days"] or 30))
+        if "--json" in flags or action == "index":
+            print(json.dumps(result, indent=4))
+        elif action == "sessions":
+            for session in result:
+                duration = "open" if session["duration_seconds"] is None else f"{session['duration_seconds']}s"
+                print(f"{session['start']}  {session['service']:<16} {session['player']:<16} {session['ip']:<39} {duration}")
+            print(f"{len(result)} sessions")
+        elif action == "rejected":
+            for group, names in result.items():
+                print(f"{group}: " + ", ".join(f"{name} ({count})" for name, count in names))
+        else:
+            for group, entries in result.items():
+                print(f"{group}: " + ", ".join(f"{entry['name']} ({entry['last_login'] or 'never'})" for entry in entries))
+
+    # Tuning functions
+
+    def tune(self, args):
+        """Apply, revert or show the sysctl profile for proxy/transit hosts."""
+        options, flags = self.parse_options(args[3:], {"root": "/"})
+        tuning = NetworkTuning(options["root"], self.system_control)
+        match args[2] if len(args) > 2 else None:
+            case "apply":
+                tuning.apply()
+            case "revert":
+                tuning.revert()
+            case "show":
+                rows = tuning.show()
+                if "--json" in flags:
+                    print(json.dumps(rows, indent=4))
+                    return
+                for row in rows:
+                    prior = f" (was {row['prior']})" if row['prior'] is not None and row['prior'] != row['current'] else ''
+                    state = 'ok' if row['applied'] else f"-> {row['profile']}"
+                    print(f"{row['key']:<40} {row['current']}{prior} {state}")
+            case other:
+                self.fail(f'error input {other}', 2)
+
+    # Shard functions
+
+    @functools.cached_property
+    def shards(self):
+        return ZBProxyShards(self.config_path, self.system_control)
+
+    def setup_shards(self, args):
+        """Run ZBProxy as count instances with the services partitioned across them."""
+        options, rest = self.parse_options(args[3:], {"by": "load", "nice": ZBProxyShards.NICE})
+        if not rest or not rest[0].isdigit() or int(rest[0]) < 1 or options["by"] not in ("load", "count"):
+            self.fail("error input : shard setup <count> [--by load|count] [--nice <n>]", 2)
+            return
+        shards = self.shards.setup(int(rest[0]), options["by"], int(options["nice"]))
+        # Built before the switch, they would keep writing the single config
+        self.__dict__.pop('proxy_server', None)
+        self.__dict__.pop('transit_server', None)
+        self.print_shards(shards)
+
+    def show_shards(self):
+        """Show each shard's services, load and tuning."""
+        shards = self.shards.show()
+        if not shards:
+            print("ZBProxy is not sharded")
+        self.print_shards(shards)
+
+    @staticmethod
+    def print_shards(shards):
+        for shard in shards:
+            tuning = ", ".join(f"{key} {value}" for key, value in shard.items() if key not in ("unit", "services", "load"))
+            print(f"{shard['unit']}: {len(shard['services'])} services, load {shard['load']} ({tuning})")
+            print(f"    {' '.join(shard['services'])}")
+
+    def turn_off_shards(self):
+        """Go back to running ZBProxy as one instance."""
+        print(self.shards.off())
+        self.__dict__.pop('proxy_server', None)
+        self.__dict__.pop('transit_server', None)
+
+    # Fleet functions
+
+    def run_fleet(self, args):
+        """Run a command on the hosts of the fleet inventory."""
+        options = {"inventory": Fleet.INVENTORY, "hosts": None, "concurrency": None}
+        command = args[2:]
+        while command[:1] and command[0].startswith('--') and command[0][2:] in options:
+            options[command[0][2:]] = command[1]
+            command = command[2:]
+        as_json = "--json" in command
+        command = [arg for arg in command if arg != "--json"]
+        if not command:
+            self.fail("error input : fleet needs a command to run", 2)
+            return
+        fleet = Fleet(options["inventory"])
+        concurrency = int(options["concurrency"]) if options["concurrency"] else None
+        results = fleet.run(command, options["hosts"], concurrency, quiet=as_json)
+        failed = [result for result in results if not result["ok"]]
+        if as_json:
+            print(json.dumps(results, indent=4))
+        else:
+            for result in failed:
+                print(f"--- {result['host']} (exit {result['returncode']}) ---\n{result['output'].strip()}")
+            print(f"{len(results) - len(failed)}/{len(results)} hosts succeeded")
+        if failed:
+            self.fail()
+
+    # Agent functions
+
+    def serve_mirror(self, args):
+        """Serve the build cache to other hosts, fetching every build of each new workflow run from GitHub."""
+        options, _ = self.parse_options(args[3:], {"host": "0.0.0.0", "port": 8765, "refresh": 600})
+        cache = self.program_control.build_cache
+        with HttpEndpoint(cache.routes(), options["host"], int(options["port"])) as url:
+            print(f"Serving {cache.directory} at {url}/builds")
+            try:
+                while True:
+                    try:
+                        fetched = self.program_control.cache_latest_builds()
+                        if fetched:
+                            print(f"Fetched {', '.join(fetched)} of run {self.program_control.latest_run_id}")
+                    except Exception as e:  # GitHub being down must not take the mirror down, the cache is still served
+                        print(f"Failed to refresh the mirror: {e}")
+                    time.sleep(float(options["refresh"]))
+            except KeyboardInterrupt:
+                print("Mirror stopped")
+
+    def list_builds(self):
+        """List the builds in the build cache."""
+        installed = HandleJsonFile(ProgramControl.INSTALLED_BUILD)
+        installed = (installed.read_json() or {}).get('sha256') if installed.file_exists() else None
+        entries = sorted(BuildCache().entries().values(), key=lambda entry: (str(entry["run_id"]), entry["artifact"]))
+        for entry in entries:
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry["used"]))
+            marker = '*' if entry["sha256"] == installed else ' '
+            print(f"{marker} {entry['run_id']:<12} {entry['artifact']:<28} {entry['size'] / 1024 / 1024:6.1f} MiB  {entry['sha256'][:12]}  used {used}")
+        print(f"{len(entries)} builds, {sum(entry['size'] for entry in entries) / 1024 / 1024:.1f} MiB")
+
+    def run_watchdog(self):
+        """Status ping the services and their upstreams until stopped, restarting and alerting on failures."""
+        config = (self.config.read_json() if self.config.file_exists() else None) or {}
+        HealthWatchdog(self.config_path, self.system_control, config.get("watchdog")).run()
+
+    def show_health(self, as_json: bool = False):
+        """Show the watchdog's last view of every target."""
+        status_file = HandleJsonFile(HealthWatchdog.STATUS_FILE)
+        with contextlib.redirect_stdout(sys.stderr):
+            status = status_file.read_json() if status_file.file_exists() else None
+        if status is None:
+            print("No health status yet, is `watchdog run` running?")
+            return
+        if as_json:
+            print(json.dumps(status, indent=4))
+            return
+        for key, target in status["targets"].items():
+            last = '-' if target["last_ms"] is None else f"{target['last_ms']:.1f} ms"
+            print(f"{target['state']:<9} {key:<40} {target['failures']}/{target['checks']} failed  {last:>10}  "
+                  f"{','.join(target['services'])[:40]}" + (f"  ({target['last_error']})" if target["last_error"] else ''))
+        for action in status["actions"]:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(action['time']))}  {action['action']} {action['unit']}: {action['reason']}")
+        print(f"Updated {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(status['updated']))}")
+
+    def run_failover(self):
+        """Keep the proxy service on the fastest upstream of its pool until stopped."""
+        config = (self.config.read_json() if self.config.file_exists() else None) or {}
+        HandleJsonFile.enable_cache()  # ZBProxy.json is read every round, parsed only when it changed
+        UpstreamSelector(self.proxy_server, config.get("failover")).run()
+
+    def show_failover(self, as_json: bool = False):
+        """Show the selector's last view of the upstream pool."""
+        status_file = HandleJsonFile(UpstreamSelector.STATUS_FILE)
+        with contextlib.redirect_stdout(sys.stderr):
+            status = status_file.read_json() if status_file.file_exists() else None
+        if status is None:
+            print("No failover status yet, is `failover run` running?")
+            return
+        if as_json:
+            print(json.dumps(status, indent=4))
+            return
+        for key, candidate in status["candidates"].items():
+            marker = '*' if key == status["active"] else '>' if key == status["challenger"] else ' '
+            score = 'down' if candidate["score_ms"] is None else f"{candidate['score_ms']:.1f} ms"
+            loss = '-' if candidate["loss"] is None else f"{candidate['loss'] * 100:.0f}%"
+            print(f"{marker} {key:<40} {score:>10}  loss {loss:>4}")
+        for switch in status["switches"]:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(switch['time']))}  {switch['from']} -> {switch['to']} "
+                  f"({switch['action']}): {switch['reason']}")
+        print(f"{status['service']} on {status['active']}, updated {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(status['updated']))}")
+
+    def serve_agent(self):
+        """Serve commands over the agent socket until stopped."""
+        Agent(self).run()
+
+    def agent_status(self):
+        """Show the agent's status; only reached here when no agent answered."""
+        if self.agent is None:
+            print("Agent is not running")
+            return
+        print(json.dumps(self.agent.status(), indent=4))
+
+    def stop_agent(self):
+        """Stop the agent."""
+        if self.agent is None:
+            print("Agent is not running")
+            return
+        print("Stopping agent...")
+        self.agent.stop()
 
     # Running functions
 
@@ -689,10 +4994,45 @@ class Main:
         print("Running Transit Server...")
         self.transit_server.run_zbproxy()
 
+    # Benchmark functions
+
+    def benchmark_startup(self, runs):
+        """Benchmark the startup time of each subcommand."""
+        print(json.dumps(Benchmark().startup(int(runs)), indent=4))
+
+    def benchmark_cpu(self, binaries):
+        """Benchmark CPU level detection, and optionally ZBProxy builds of different levels."""
+        print(json.dumps(Benchmark().cpu(binaries), indent=4))
+
+    def benchmark_tune(self, connections, megabytes):
+        """Benchmark loopback networking on this host, before and after `tune apply`."""
+        print(json.dumps(Benchmark().tune(int(connections), int(megabytes)), indent=4))
+
+    def benchmark_load(self, args):
+        """Benchmark simulated Minecraft clients through ZBProxy, one run per config variant."""
+        clients, concurrency, payload_kb = (int(arg) for arg in (args[:3] + ["2000", "200", "64"][len(args[:3]):]))
+        print(json.dumps(Benchmark().load(clients, concurrency, payload_kb, args[3:] or None), indent=4))
+
     def run(self, args):
-        """Main entry point to run the script."""
+        """Main entry point to run the script, returns the exit code of the command."""
+        nested = hasattr(self.command, 'exit_code')  # A queued change replayed by `changes apply`, its failure is that command's
+        if not nested:
+            self.command.exit_code = 0
+        try:
+            self.dispatch(args)
+            return self.command.exit_code
+        finally:
+            if not nested:
+                del self.command.exit_code
+
+    def dispatch(self, args):
+        """Run the command of args."""
         if len(args) < 2:
-            print("Insufficient arguments provided.")
+            self.fail("Insufficient arguments provided.", 2)
+            return
+
+        if "--defer" in args:
+            self.defer_change([arg for arg in args if arg != "--defer"])
             return
 
         command = args[1]
@@ -715,14 +5055,18 @@ class Main:
                                 self.add_to_whitelist(args[4], args[5])
                             case "remove":
                                 self.remove_from_whitelist(args[4], args[5])
+                            case "import":
+                                self.import_whitelist(args[4], args[5], "--merge" in args[6:])
+                            case "export":
+                                self.export_whitelist(args[4], args[5] if len(args) > 5 else '-')
                             case "on":
                                 self.turn_on_whitelist(args[4])
                             case "off":
                                 self.turn_off_whitelist(args[4])
                             case other:
-                                print(f'error input : {other}')
+                                self.fail(f'error input : {other}', 2)
                     case other:
-                        print(f'error input {other}')
+                        self.fail(f'error input {other}', 2)
 
             case "proxy":
                 match args[2]:
@@ -737,7 +5081,15 @@ class Main:
                             case "remove":
                                 self.remove_a_transit_server_for_proxy(args[4])
                             case other:
-                                print(f'error input {other}')
+                                self.fail(f'error input {other}', 2)
+                    case "upstream":
+                        match args[3]:
+                            case "add":
+                                self.add_upstream(args[4])
+                            case "remove":
+                                self.remove_upstream(args[4])
+                            case other:
+                                self.fail(f'error input {other}', 2)
                     case "hostname":
                         match args[3]:
                             case "on":
@@ -745,22 +5097,132 @@ class Main:
                             case "off":
                                 self.turn_off_hostname_access()
                             case other:
-                                print(f'error input {other}')
+                                self.fail(f'error input {other}', 2)
                     case other:
-                        print(f'error input {other}')
+                        self.fail(f'error input {other}', 2)
 
             case "update":
                 match args[2]:
                     case "zbproxy":
-                        self.update_zbproxy()
+                        options, flags = self.parse_options(args[3:], {"run": None})
+                        self.update_zbproxy("--force" in flags, options["run"])
                     case "program":
                         self.upgrade_program()
                     case other:
-                        print(f'error input {other}')
+                        self.fail(f'error input {other}', 2)
+
+            case "apply":
+                self.apply(args)
+
+            case "watchdog":
+                match args[2]:
+                    case "run":
+                        self.run_watchdog()
+                    case "status":
+                        self.show_health("--json" in args[3:])
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "failover":
+                match args[2]:
+                    case "run":
+                        self.run_failover()
+                    case "status":
+                        self.show_failover("--json" in args[3:])
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "firewall":
+                match args[2]:
+                    case "sync":
+                        self.sync_firewall("--dry-run" in args[3:])
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "changes":
+                match args[2]:
+                    case "apply":
+                        self.apply_changes(float(args[4]) if args[3:4] == ["--debounce"] else None)
+                    case "show":
+                        self.show_changes()
+                    case "discard":
+                        self.discard_changes()
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "fleet":
+                self.run_fleet(args)
+
+            case "probe":
+                self.probe(args)
+
+            case "metrics":
+                match args[2]:
+                    case "serve":
+                        self.serve_metrics(args)
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "logs":
+                self.logs(args)
+
+            case "tune":
+                self.tune(args)
+
+            case "mirror":
+                match args[2]:
+                    case "serve":
+                        self.serve_mirror(args)
+                    case "list":
+                        self.list_builds()
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "shard":
+                match args[2]:
+                    case "setup":
+                        self.setup_shards(args)
+                    case "show":
+                        self.show_shards()
+                    case "off":
+                        self.turn_off_shards()
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "agent":
+                match args[2]:
+                    case "serve":
+                        self.serve_agent()
+                    case "status":
+                        self.agent_status()
+                    case "stop":
+                        self.stop_agent()
+                    case other:
+                        self.fail(f'error input {other}', 2)
+
+            case "benchmark":
+                match args[2]:
+                    case "startup":
+                        self.benchmark_startup(args[3] if len(args) > 3 else 5)
+                    case "cpu":
+                        self.benchmark_cpu(args[3:])
+                    case "tune":
+                        self.benchmark_tune(args[3] if len(args) > 3 else 2000, args[4] if len(args) > 4 else 256)
+                    case "load":
+                        self.benchmark_load(args[3:])
+                    case "load-upstream":
+                        MinecraftEchoServer.serve_config(args[3] if len(args) > 3 else 'ZBProxy.json')
+                    case other:
+                        self.fail(f'error input {other}', 2)
             case other:
-                print(f'error input {other}')    
+                self.fail(f'error input {other}', 2)    
 
 
 if __name__ == "__main__":
-    main = Main()
-    main.run(sys.argv)
+    # With an agent running, this process is only a thin client
+    if "--no-agent" in sys.argv:
+        sys.argv.remove("--no-agent")
+    elif AgentClient.forward(sys.argv):
+        sys.exit()
+    main = Main(load_config=sys.argv[1:2] not in (["benchmark"], ["fleet"], ["probe"], ["metrics"], ["logs"], ["tune"], ["watchdog"], ["failover"]))
+    sys.exit(main.run(sys.argv))
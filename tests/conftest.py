@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    """A scratch directory to run in, OProxy resolves ZBProxy.json, config.json and .oproxy/ from the working directory."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def no_shared_state():
+    """Leave no process-wide cache or HTTP session behind for the next test."""
+    yield
+    main.HandleJsonFile._cache = None
+    main.HttpClient._shared = None
+    main.MetadataCache._shared = None
@@ -0,0 +1,356 @@
+"""Local stand-ins for the tests: HTTP and Minecraft servers, a stand-in ZBProxy process, fake systemctl and ufw, fleet hosts.
+
+Run as a script, this file stands in for ZBProxy: `python tests/fakes.py [ZBProxy.json]`.
+"""
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:  # Run as a script
+    sys.path.insert(0, ROOT)
+
+from main import (HttpEndpoint, Main, MinecraftEchoServer, MinecraftProtocol, MinecraftTransitService, NetworkControl,  # noqa: E402
+                  SystemControl, ThreadOutput)
+
+# Starts the stand-in ZBProxy, in the directory of its ZBProxy.json
+STAND_IN_ZBPROXY = [sys.executable, os.path.abspath(__file__)]
+
+
+class LocalHttpServer(HttpEndpoint):
+    """HttpEndpoint with the faults of a real link: a slow handshake, ETags, dropped downloads; counts connections."""
+
+    def __init__(self, routes: dict, host: str = '127.0.0.1', port: int = 0, connect_delay: float = 0) -> None:
+        """Initialize LocalHttpServer object, connect_delay is slept once per new connection, like a TCP+TLS handshake."""
+        super().__init__(routes, host, port)
+        self.connect_delay = connect_delay
+        self.connections = 0
+
+    def handler_class(self):
+        owner = self
+
+        class DelayedHandler(super().handler_class()):
+            def setup(self):
+                owner.connections += 1
+                time.sleep(owner.connect_delay)
+                super().setup()
+        return DelayedHandler
+
+    @staticmethod
+    def etag_json_response(request, data):
+        """Build a JSON route result with an ETag, answering 304 when If-None-Match matches."""
+        body = json.dumps(data).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        return 200, {'Content-Type': 'application/json', 'ETag': etag}, body
+
+    @staticmethod
+    def byte_range_response(request, size: int, read_at, drop_after: int = None, **kwargs):
+        """HttpEndpoint.byte_range_response, closing the connection after drop_after bytes like a flaky link."""
+        status, headers, body = HttpEndpoint.byte_range_response(request, size, read_at, **kwargs)
+        if drop_after is None or status not in (200, 206):
+            return status, headers, body
+        headers['Connection'] = 'close'
+
+        def dropped():
+            sent = 0
+            for chunk in body:
+                if sent + len(chunk) >= drop_after:
+                    yield chunk[:drop_after - sent]
+                    return
+                sent += len(chunk)
+                yield chunk
+        return status, headers, dropped()
+
+
+class FakeMinecraftServer(MinecraftEchoServer):
+    """MinecraftEchoServer that can be slowed down, made to jitter or made to hang while it runs."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0, hang: bool = False,
+                 description: str = 'OProxy stand-in', jitter: float = 0) -> None:
+        """Initialize FakeMinecraftServer object, latency, jitter and hang can be changed while it runs."""
+        super().__init__(host, port, description)
+        self.latency = latency
+        self.jitter = jitter  # Up to this many seconds are added to latency at random
+        self.hang = hang
+
+    def read_packet(self, sock):
+        packet = super().read_packet(sock)
+        while self.hang:  # A wedged listener: accepts, then never answers
+            time.sleep(0.05)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        return packet
+
+    def stop(self):
+        self.hang = False
+        super().stop()
+
+    @classmethod
+    def serve_config(cls, config_path: str = 'ZBProxy.json'):
+        """Stand in for ZBProxy: serve every Listen port of a ZBProxy.json until killed.
+
+        Like ZBProxy's config watcher, edits of Lists and NameAccess are applied to the running servers; anything else
+        is only read on start. The status description shows the service name and its NameAccess mode, so both a restart
+        and a live edit can be observed. An "allow" NameAccess admits only the names on its lists.
+        """
+        def apply(config, servers):
+            lists = config.get('Lists', {})
+            for service in config['Services']:
+                if service['Listen'] not in servers:
+                    continue
+                name_access = service['Minecraft']['NameAccess']
+                server = servers[service['Listen']]
+                server.description = f"{service['Name']} NameAccess={name_access.get('Mode', '')}"
+                server.names = ({name for tag in name_access.get('ListTags', []) for name in lists.get(tag, [])}
+                                if name_access.get('Mode') == 'allow' else None)
+
+        seen = os.stat(config_path).st_mtime_ns
+        with open(config_path) as file:
+            config = json.load(file)
+        servers = {service['Listen']: cls(host='0.0.0.0', port=service['Listen']) for service in config['Services']}
+        apply(config, servers)
+        for server in servers.values():
+            server.start()
+        print(f"Stand-in ZBProxy serving {len(servers)} services")
+        while True:
+            time.sleep(0.05)
+            try:
+                if os.stat(config_path).st_mtime_ns != seen:
+                    seen = os.stat(config_path).st_mtime_ns
+                    with open(config_path) as file:
+                        apply(json.load(file), servers)
+            except (OSError, ValueError):  # Caught mid-write, the next poll reads it whole
+                seen = None
+
+
+class RecordingSystemControl(SystemControl):
+    """SystemControl that records commands instead of running them."""
+
+    def __init__(self, installed=()) -> None:
+        """Initialize RecordingSystemControl object, installed lists the packages reported as present."""
+        self.commands = []
+        self.installed = set(installed)
+
+    def installed_packages(self):
+        return self.installed
+
+    def run_command(self, command: str):
+        """Record a shell command."""
+        print(f"Recording command: {command}")
+        self.commands.append(command)
+        return '', 0
+
+    def systemctl(self, action: str = ''):
+        """The recorded systemctl commands, of one action if given."""
+        return [command for command in self.commands if f'systemctl {action}'.strip() in command]
+
+
+class FakeUfwSystemControl(RecordingSystemControl):
+    """RecordingSystemControl that keeps ufw rules in memory and answers `ufw show added` from them."""
+
+    def __init__(self, rules: dict = None, refused=()) -> None:
+        """Initialize FakeUfwSystemControl object, rules map a port to its comment, ufw fails to add a refused port."""
+        super().__init__(installed=('ufw',))
+        self.rules = dict(rules or {})
+        self.refused = set(refused)
+        self.ufw_calls = 0
+
+    def run_command(self, command: str):
+        """Record a shell command, acting out the ufw calls in it up to the first that fails."""
+        super().run_command(command)
+        output = []
+        for part in command.split('&&'):
+            words = part.strip().removeprefix('sudo ').split()
+            if not words or words[0] != 'ufw':
+                continue
+            self.ufw_calls += 1
+            match words[1:]:
+                case ['show', 'added']:
+                    output.append("Added user rules (see 'ufw status' for running firewall):")
+                    for port, comment in sorted(self.rules.items()):
+                        output.append(f"ufw allow {port}/tcp" + (f" comment '{comment}'" if comment else ''))
+                case ['allow', rule, *rest]:
+                    if int(rule.split('/')[0]) in self.refused:
+                        return f"ERROR: Could not update running firewall for {rule}", 1
+                    self.rules.setdefault(int(rule.split('/')[0]), rest[1].strip("'") if rest[:1] == ['comment'] else '')
+                case ['delete', 'allow', rule]:
+                    self.rules.pop(int(rule.split('/')[0]), None)
+        return '\n'.join(output), 0
+
+
+class StandInServiceControl(RecordingSystemControl):
+    """RecordingSystemControl that runs the stand-in ZBProxy and applies systemctl restart to it."""
+
+    def __init__(self, work_dir: str, command: list = None) -> None:
+        """Initialize StandInServiceControl object, command starts the stand-in inside work_dir."""
+        super().__init__(installed=('ufw',))
+        self.command = command or STAND_IN_ZBPROXY
+        self.work_dir = work_dir
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        """Start the stand-in process."""
+        self.process = subprocess.Popen(self.command, cwd=self.work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        """Stop the stand-in process."""
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def run_command(self, command: str):
+        """Record a shell command, acting out systemctl restart of ZBProxy."""
+        super().run_command(command)
+        if 'systemctl restart ZBProxy' in command:
+            self.restarts += 1
+            self.stop()
+            self.start()
+        return '', 0
+
+
+class LocalTransport:
+    """Fleet transport where each host is a local directory, with a RecordingSystemControl as its system."""
+
+    def __init__(self, latency: float = 0, failures: dict = None) -> None:
+        """Initialize LocalTransport object."""
+        self.latency = latency  # Seconds added to every command, like a network round trip
+        self.failures = dict(failures or {})  # Host name -> attempts that fail like a dropped connection
+        self.systems = {}  # Host name -> its RecordingSystemControl
+        self.lock = threading.Lock()
+
+    def run(self, host: dict, args: list):
+        """Run args against the host's directory, returning (output, returncode)."""
+        time.sleep(self.latency)
+        with self.lock:
+            if self.failures.get(host["name"], 0) > 0:
+                self.failures[host["name"]] -= 1
+                return "Connection reset by stand-in", 255
+            system = self.systems.setdefault(host["name"], RecordingSystemControl(installed=('ufw',)))
+        main = Main(load_config=False, system_control=system, config_path=os.path.join(host["dir"], 'ZBProxy.json'))
+        capturing = isinstance(sys.stdout, ThreadOutput)
+        if capturing:
+            sys.stdout.capture()
+        try:
+            returncode = main.run([sys.argv[0]] + args)
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+            returncode = 1
+        return (sys.stdout.release() if capturing else ''), returncode
+
+
+def pattern_reader(seed: bytes = b'OProxy'):
+    """Return a read_at(offset, length) over an endless deterministic byte pattern."""
+    block = b''.join(hashlib.sha256(seed + i.to_bytes(4, 'big')).digest() for i in range(2048))
+
+    def read_at(offset, length):
+        data = bytearray()
+        while len(data) < length:
+            start = (offset + len(data)) % len(block)
+            data += block[start:start + length - len(data)]
+        return bytes(data)
+    return read_at
+
+
+def sha256_of(read_at, size: int):
+    """SHA-256 of the first size bytes of read_at."""
+    digest = hashlib.sha256()
+    for offset in range(0, size, NetworkControl.CHUNK_SIZE):
+        digest.update(read_at(offset, min(NetworkControl.CHUNK_SIZE, size - offset)))
+    return digest.hexdigest()
+
+
+def github_routes(base_url_holder: list, run_id: int = 42, failures: list = None):
+    """Routes of a stand-in for the GitHub API calls made by ProgramControl.
+
+    failures holds status codes answered, one per call, before the runs listing succeeds.
+    """
+    failures = failures if failures is not None else []
+
+    def runs(request):
+        if failures:
+            return LocalHttpServer.json_response({"message": "stand-in failure"}, failures.pop(0), {'Retry-After': '0'})
+        return LocalHttpServer.etag_json_response(request, {"workflow_runs": [{"id": run_id}]})
+
+    def artifacts(request):
+        return LocalHttpServer.etag_json_response(request, {"artifacts": [
+            {"name": "ZBProxy-linux-amd64-v1", "id": 1},
+            {"name": "ZBProxy-linux-amd64-v3", "id": 3},
+        ]})
+
+    def artifact_zip(request):
+        return 302, {'Location': f'{base_url_holder[0]}/download/zbproxy.zip', 'Content-Length': '0'}, b''
+
+    def release(request):
+        return LocalHttpServer.etag_json_response(request, {"assets": [{"name": "OProxy", "browser_download_url": f'{base_url_holder[0]}/download/OProxy'}]})
+
+    return {
+        '/repos/layou233/ZBProxy/actions/runs': runs,
+        f'/repos/layou233/ZBProxy/actions/runs/{run_id}/artifacts': artifacts,
+        '/repos/layou233/ZBProxy/actions/artifacts/1/zip': artifact_zip,
+        '/repos/layou233/ZBProxy/actions/artifacts/3/zip': artifact_zip,
+        '/repos/GTBoost2024/OProxy/releases/latest': release,
+    }
+
+
+def counted_routes(routes: dict, statuses: list):
+    """Wrap routes so every answered status code is appended to statuses."""
+    def counted(route):
+        def handle(request):
+            status, headers, body = route(request)
+            statuses.append(status)
+            return status, headers, body
+        return handle
+    return {path: counted(route) for path, route in routes.items()}
+
+
+def write_config(path: str, services: list, lists: dict = None):
+    """Write a ZBProxy.json of services and lists."""
+    with open(path, 'w') as file:
+        json.dump({"Services": services, "Lists": lists if lists is not None else {}}, file)
+
+
+def transit_service(listen: int, name: str, target_port: int = 25565):
+    """A transit service as `transit target add` writes it."""
+    return MinecraftTransitService('127.0.0.1', target_port, listen, name).service_dict
+
+
+def count_writes(config_file):
+    """Count the writes of a HandleJsonFile into a list it returns."""
+    writes = []
+    write_file = config_file.write_file
+    config_file.write_file = lambda content: writes.append(1) or write_file(content)
+    return writes
+
+
+def wait_for(condition, timeout: float = 10):
+    """Poll condition until it holds, returns whether it did."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def handshake_only(port: int):
+    """Open a connection with its status answered and the ping not sent yet, like a player on the server list."""
+    import socket
+    sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+    sock.sendall(MinecraftProtocol.handshake('127.0.0.1', port) + MinecraftProtocol.packet(0x00))
+    MinecraftProtocol.read_packet(sock)
+    return sock
+
+
+if __name__ == "__main__":
+    FakeMinecraftServer.serve_config(sys.argv[1] if len(sys.argv) > 1 else 'ZBProxy.json')
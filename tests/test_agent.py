@@ -0,0 +1,167 @@
+import contextlib
+import json
+import os
+import stat
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import ROOT
+from main import Agent, AgentClient, Benchmark, Main, ThreadOutput, self_command
+from fakes import RecordingSystemControl, wait_for
+
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+@pytest.fixture
+def agent(work_dir):
+    Benchmark.seed_work_dir(str(work_dir))
+    agent = Agent(Main(load_config=False, system_control=RecordingSystemControl(installed=('ufw',))))
+    server = threading.Thread(target=agent.run)
+    server.start()
+    assert wait_for(lambda: os.path.exists(Agent.SOCKET_PATH))
+    yield agent
+    agent.stop()
+    server.join(10)
+    assert not os.path.exists(Agent.SOCKET_PATH)
+
+
+@contextlib.contextmanager
+def thread_output():
+    """Give the agent its per-thread sys.stdout, pytest puts its own back at every test phase."""
+    streams = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = streams
+
+
+def stored(tag='bench_group'):
+    with open('ZBProxy.json') as file:
+        return json.load(file)["Lists"][tag]
+
+
+def test_socket_is_owner_only_from_the_bind(work_dir, monkeypatch):
+    import asyncio
+    modes = []
+    start_unix_server = asyncio.start_unix_server
+
+    async def bind(*args, **kwargs):
+        server = await start_unix_server(*args, **kwargs)
+        modes.append(stat.S_IMODE(os.stat(Agent.SOCKET_PATH).st_mode))  # Before anything else can touch it
+        return server
+    monkeypatch.setattr(asyncio, 'start_unix_server', bind)
+    agent = Agent(Main(load_config=False, system_control=RecordingSystemControl()))
+    server = threading.Thread(target=agent.run)
+    server.start()
+    try:
+        assert wait_for(lambda: modes)
+    finally:
+        agent.stop()
+        server.join(10)
+    assert modes == [0o600]
+    umask = os.umask(UMASK)
+    assert umask == UMASK  # Put back for the rest of the process
+
+
+def test_socket_request_runs_the_command(agent):
+    with thread_output():
+        response = AgentClient.request(["transit", "whitelist", "add", "Steve", "bench_group"], request_id=7)
+        assert response["id"] == 7 and response["error"] is None
+        assert "Steve" in response["stdout"]
+        assert stored() == ["Steve"]
+
+
+def test_failed_command_exits_non_zero_through_the_agent(agent):
+    with thread_output():
+        response = AgentClient.request(["transit", "whitelist", "on", "no_such_group"])
+        assert (response["exit_code"], response["error"]) == (1, "exited with 1")
+        for args, exit_code in ((["transit", "whitelist", "on", "no_such_group"], 1), (["transit", "bogus"], 2),
+                                (["transit", "bogus", "--no-agent"], 2)):
+            completed = subprocess.run(self_command() + args, capture_output=True, text=True, timeout=30)
+            assert completed.returncode == exit_code
+        assert agent.served == 3  # Run by the agent, not by the client
+
+
+def test_thin_client_forwards_to_the_agent(agent):
+    with thread_output():
+        completed = subprocess.run(self_command() + ["transit", "whitelist", "add", "Alex", "bench_group"],
+                                   capture_output=True, text=True, timeout=30)
+        assert completed.returncode == 0
+        assert stored() == ["Alex"]
+        assert agent.served == 1  # Run by the agent, not by the client
+
+
+COLD_START = """
+import sys
+sys.path[:0] = [{root!r}, {tests!r}]
+import main
+from fakes import RecordingSystemControl
+main.Main(load_config=False, system_control=RecordingSystemControl(installed=('ufw',))).run(['OProxy'] + {args!r})
+"""
+
+
+def test_agent_request_beats_a_cold_start(agent):
+    """A whitelist toggle in a fresh interpreter, as every command ran before the agent, against one on the agent socket."""
+    toggles = [["transit", "whitelist", "on" if i % 2 == 0 else "off", "bench_group"] for i in range(5)]
+    cold, warm = [], []
+    with thread_output():
+        for args in toggles:
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', COLD_START.format(root=ROOT, tests=f'{ROOT}/tests', args=args)],
+                           capture_output=True, check=True, timeout=30)
+            cold.append(time.perf_counter() - started)
+        for args in toggles:
+            started = time.perf_counter()
+            assert AgentClient.request(args)["error"] is None
+            warm.append(time.perf_counter() - started)
+    print(f"whitelist toggle: cold start {statistics.median(cold) * 1000:.1f} ms, agent {statistics.median(warm) * 1000:.1f} ms")
+    assert statistics.median(warm) * 3 < statistics.median(cold)
+
+
+def test_concurrent_adds_are_all_kept(agent):
+    with thread_output():
+        names = [f"Player{i}" for i in range(40)]
+        with ThreadPoolExecutor(8) as pool:
+            responses = list(pool.map(lambda name: AgentClient.request(["transit", "whitelist", "add", name, "bench_group"]), names))
+        assert [response["error"] for response in responses] == [None] * len(names)
+        assert set(stored()) == set(names)
+
+
+def test_status_reports_requests_served(agent):
+    with thread_output():
+        AgentClient.request(["transit", "whitelist", "on", "bench_group"])
+        status = json.loads(AgentClient.request(["agent", "status"])["stdout"])
+        assert status["requests_served"] == 1
+        assert status["pid"] == os.getpid()
+
+
+def test_bad_request_is_answered(agent):
+    with thread_output():
+        import socket
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(Agent.SOCKET_PATH)
+            sock.sendall(b'not json\n')
+            assert json.loads(sock.makefile().readline())["error"].startswith("bad request")
+
+
+@pytest.mark.parametrize('args, local', [
+    (["agent", "serve"], True),
+    (["fleet", "run"], True),
+    (["transit", "whitelist", "import", "bench_group", "-"], True),
+    (["transit", "whitelist", "import", "bench_group", "names.txt"], False),
+    (["transit", "whitelist", "on", "bench_group"], False),
+])
+def test_runs_locally(args, local):
+    assert Agent.runs_locally(args) is local
+
+
+def test_no_socket_runs_in_process(work_dir):
+    assert AgentClient.forward([sys.argv[0], "transit", "whitelist", "on", "bench_group"]) is False
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from main import DesiredConfig, TransitServer
+from fakes import FakeUfwSystemControl, count_writes, transit_service, write_config
+
+SERVICES = 10
+
+
+def desired_state(listen_offset: int = 0, extra_names: int = 0):
+    config = {"Services": [], "Lists": {}}
+    for i in range(SERVICES):
+        config["Services"].append(transit_service(30000 + i + (listen_offset if i == 0 else 0), f'test{i}'))
+        config["Lists"][f'test{i}'] = [f'player{j}' for j in range(5 + (extra_names if i == 1 else 0))]
+    return config
+
+
+@pytest.fixture
+def transit(work_dir):
+    live = desired_state()
+    live["Services"] += [dict(service) for service in live["Services"][:3]]  # Left by the old blindly appending add_service
+    write_config('ZBProxy.json', live["Services"], live["Lists"])
+    server = TransitServer('test', FakeUfwSystemControl({30000 + i: 'OProxy' for i in range(SERVICES)}))
+    server.writes = count_writes(server.zbproxy_config)
+    return server
+
+
+def apply(transit, desired, dry_run=False):
+    transit.writes.clear()
+    transit.system_control.commands.clear()
+    transit.system_control.ufw_calls = 0
+    return transit.apply_desired(DesiredConfig(json.loads(json.dumps(desired))), dry_run)
+
+
+def test_first_apply_drops_duplicates(transit):
+    result = apply(transit, desired_state())
+    assert sum('(duplicate)' in change for change in result["changes"]) == 3
+    assert len(transit.writes) == 1
+    assert len(transit.zbproxy_config.read_json()["Services"]) == SERVICES
+
+
+def test_applying_the_state_in_place_does_nothing(transit):
+    apply(transit, desired_state())
+    result = apply(transit, desired_state())
+    assert result == {"changes": [], "action": 'none', "written": False}
+    assert transit.writes == []
+    assert transit.system_control.commands == []
+
+
+def test_dry_run_plans_without_writing(transit):
+    apply(transit, desired_state())
+    result = apply(transit, desired_state(extra_names=3), dry_run=True)
+    assert result["changes"] == ["~ list test1: +3 -0 names"]
+    assert result["written"] is False
+    assert transit.writes == [] and transit.system_control.commands == []
+
+
+def test_list_change_writes_once_and_restarts_nothing(transit):
+    apply(transit, desired_state())
+    result = apply(transit, desired_state(extra_names=3))
+    assert len(transit.writes) == 1
+    assert transit.system_control.ufw_calls == 0
+    assert result["action"] == 'none'
+    assert transit.system_control.systemctl('restart') == []
+    assert len(transit.zbproxy_config.read_json()["Lists"]["test1"]) == 8
+
+
+def test_listen_change_restarts_and_moves_the_firewall(transit):
+    apply(transit, desired_state())
+    result = apply(transit, desired_state(listen_offset=1000))
+    assert result["action"] == 'restart'
+    assert len(transit.system_control.systemctl('restart')) == 1
+    assert 31000 in transit.system_control.rules and 30000 not in transit.system_control.rules
+
+
+def test_yaml_state_matches_json(transit, work_dir):
+    yaml = pytest.importorskip('yaml')
+    apply(transit, desired_state())
+    with open('desired.yaml', 'w') as file:
+        yaml.safe_dump(desired_state(), file)
+    assert DesiredConfig.load('desired.yaml').plan(transit.zbproxy_config.read_json())[1] == []
+
+
+def test_fresh_host_is_provisioned_in_one_write(transit):
+    write_config('ZBProxy.json', [], {})
+    result = apply(transit, desired_state())
+    assert len(result["changes"]) == 2 * SERVICES
+    assert len(transit.writes) == 1
+    assert len(transit.system_control.systemctl()) == 1
+
+
+@pytest.mark.parametrize('desired', [
+    {"Services": [{"Name": "a"}, {"Name": "a"}]},
+    {"Services": [{"Listen": 1}]},
+    {"Lists": {"a": "Steve"}},
+    [],
+])
+def test_invalid_states_are_refused(desired):
+    with pytest.raises(ValueError):
+        DesiredConfig(desired)
+
+
+def test_missing_list_is_refused(transit):
+    desired = desired_state()
+    del desired["Lists"]["test0"]
+    with pytest.raises(ValueError, match='test0'):
+        apply(transit, desired)
+    assert transit.writes == []
+
+
+@pytest.mark.parametrize('access', ['IPAccess', 'NameAccess', 'HostnameAccess'])
+def test_missing_list_of_any_access_block_is_refused(transit, access):
+    desired = desired_state()
+    service = desired["Services"][0]
+    block = service if access == 'IPAccess' else service["Minecraft"]
+    block[access] = {"Mode": "allow", "ListTags": ["nowhere"]}
+    with pytest.raises(ValueError, match='nowhere'):
+        apply(transit, desired)
+    desired["Lists"]["nowhere"] = []
+    assert apply(transit, desired)["written"] is True
@@ -0,0 +1,137 @@
+import contextlib
+import io
+import json
+import os
+import stat
+import threading
+import time
+
+from main import HandleJsonFile
+from fakes import count_writes
+
+
+def empty_config(path):
+    with open(path, 'w') as file:
+        json.dump({"Services": [], "Lists": {"test": []}}, file)
+
+
+def run_children(targets):
+    """Run each target in a forked child, quietly, and wait for them all."""
+    children = []
+    for target in targets:
+        pid = os.fork()
+        if pid == 0:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            try:
+                target()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def test_parallel_writers_lose_no_updates_and_readers_see_no_torn_file(work_dir):
+    writers, count = 6, 40
+    empty_config('ZBProxy.json')
+
+    def writer(index):
+        config_file = HandleJsonFile('ZBProxy.json')
+        for i in range(count):
+            with config_file.transaction() as config:
+                config["Lists"]["test"].append(f"writer{index}_{i}")
+
+    def reader():
+        torn = 0
+        stop_at = time.monotonic() + 1
+        while time.monotonic() < stop_at:
+            try:
+                with open('ZBProxy.json') as file:
+                    json.load(file)
+            except ValueError:
+                torn += 1
+        with open('torn_reads', 'w') as file:
+            file.write(str(torn))
+
+    run_children([reader] + [lambda index=index: writer(index) for index in range(writers)])
+    with open('ZBProxy.json') as file:
+        names = json.load(file)["Lists"]["test"]
+    assert sorted(names) == sorted(f"writer{index}_{i}" for index in range(writers) for i in range(count))
+    assert (work_dir / 'torn_reads').read_text() == '0'
+
+
+def test_threads_each_hold_their_own_transaction(work_dir):
+    threads, count = 8, 25
+    empty_config('ZBProxy.json')
+    HandleJsonFile.enable_cache()
+    seen_foreign = []
+
+    def writer(index):
+        for i in range(count):
+            with HandleJsonFile('ZBProxy.json').transaction() as config:
+                name = f"thread{index}_{i}"
+                config["Lists"]["test"].append(name)
+                config["Lists"]["holder"] = [name]
+                time.sleep(0.0005)  # Let the other threads try to join in
+                if config["Lists"]["holder"] != [name]:
+                    seen_foreign.append(name)
+            if i % 5 == 0:  # A plain write waits for the lock, it does not land in another thread's transaction
+                with HandleJsonFile('ZBProxy.json').transaction() as config:
+                    HandleJsonFile('ZBProxy.json').write_json({**config, "Lists": {**config["Lists"], f"thread{index}": []}})
+
+    workers = [threading.Thread(target=writer, args=(index,)) for index in range(threads)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    with open('ZBProxy.json') as file:
+        lists = json.load(file)["Lists"]
+    assert sorted(lists["test"]) == sorted(f"thread{index}_{i}" for index in range(threads) for i in range(count))
+    assert {f"thread{index}" for index in range(threads)} <= set(lists)
+    assert seen_foreign == []
+
+
+def test_transaction_writes_once_and_only_on_change(work_dir):
+    empty_config('ZBProxy.json')
+    config_file = HandleJsonFile('ZBProxy.json')
+    writes = count_writes(config_file)
+    with config_file.transaction() as config:
+        for i in range(50):
+            config["Lists"]["test"].append(f"player{i}")
+    assert len(writes) == 1
+    with config_file.transaction() as config:
+        config["Lists"]["test"] = list(config["Lists"]["test"])
+    assert len(writes) == 1
+
+
+def test_nested_transactions_and_writes_join_the_outer_one(work_dir):
+    empty_config('ZBProxy.json')
+    config_file = HandleJsonFile('ZBProxy.json')
+    writes = count_writes(config_file)
+    with config_file.transaction() as config:
+        with HandleJsonFile('ZBProxy.json').transaction() as inner:
+            inner["Lists"]["inner"] = []
+        HandleJsonFile('ZBProxy.json').write_json({**config, "Lists": {**config["Lists"], "written": []}})
+        assert len(writes) == 0
+    assert len(writes) == 1
+    with open('ZBProxy.json') as file:
+        assert set(json.load(file)["Lists"]) == {"test", "inner", "written"}
+
+
+def test_writes_are_atomic_and_keep_the_mode(work_dir):
+    empty_config('ZBProxy.json')
+    os.chmod('ZBProxy.json', 0o640)
+    HandleJsonFile('ZBProxy.json').write_json({"Services": [], "Lists": {}})
+    assert stat.S_IMODE(os.stat('ZBProxy.json').st_mode) == 0o640
+    assert sorted(os.listdir(work_dir)) == ['ZBProxy.json', 'ZBProxy.json.lock']  # No temp file left
+
+
+def test_cache_is_revalidated_after_another_process_writes(work_dir):
+    empty_config('ZBProxy.json')
+    HandleJsonFile.enable_cache()
+    config_file = HandleJsonFile('ZBProxy.json')
+    assert config_file.read_json()["Lists"] == {"test": []}
+    run_children([lambda: HandleJsonFile('ZBProxy.json').write_json({"Services": [], "Lists": {"other": []}})])
+    assert config_file.read_json()["Lists"] == {"other": []}
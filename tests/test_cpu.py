@@ -0,0 +1,45 @@
+import pytest
+
+from main import CpuFeatures
+
+# Trimmed /proc/cpuinfo of real CPUs: machine, cpuinfo, expected label
+CPUINFO_BASE = ("fpu vme de pse tsc msr pae mce cx8 apic sep mtrr pge mca cmov pat pse36 clflush mmx fxsr sse sse2 ss ht "
+                "syscall nx lm constant_tsc rep_good nopl cpuid pni monitor ssse3 cx16 lahf_lm")
+CPUINFO_V2 = f"{CPUINFO_BASE} sse4_1 sse4_2 popcnt aes pclmulqdq"
+CPUINFO_V3 = f"{CPUINFO_V2} xsave avx f16c fma movbe abm bmi1 bmi2 avx2 rdrand"
+CPUINFO_FIXTURES = {
+    "core2": ("x86_64", f"processor\t: 0\nmodel name\t: Intel(R) Core(TM)2 Duo CPU E6550\nflags\t\t: {CPUINFO_BASE}\n", "amd64-v1"),
+    "westmere": ("x86_64", f"processor\t: 0\nmodel name\t: Intel(R) Xeon(R) CPU X5650\nflags\t\t: {CPUINFO_V2}\n", "amd64-v2"),
+    "haswell": ("x86_64", f"processor\t: 0\nmodel name\t: Intel(R) Xeon(R) CPU E5-2680 v3\nflags\t\t: {CPUINFO_V3}\n", "amd64-v3"),
+    "epyc_rome": ("x86_64", f"processor\t: 0\nmodel name\t: AMD EPYC 7B12\nflags\t\t: {CPUINFO_V3} sse4a misalignsse sha_ni clzero\n", "amd64-v3"),
+    "icelake_server": ("x86_64", f"processor\t: 0\nmodel name\t: Intel(R) Xeon(R) Platinum 8375C\nflags\t\t: {CPUINFO_V3} "
+                                 "avx512f avx512dq avx512cd avx512bw avx512vl avx512_vnni\n", "amd64-v4"),
+    "avx2_without_bmi": ("x86_64", f"processor\t: 0\nflags\t\t: {CPUINFO_V2} xsave avx f16c fma avx2\n", "amd64-v2"),
+    "mixed_cores": ("x86_64", f"processor\t: 0\nflags\t\t: {CPUINFO_V3}\n\nprocessor\t: 1\nflags\t\t: {CPUINFO_V2}\n", "amd64-v2"),
+    "flags_hidden": ("x86_64", "", "amd64-v1"),
+    "neoverse_n1": ("aarch64", "processor\t: 0\nBogoMIPS\t: 50.00\nFeatures\t: fp asimd evtstrm aes pmull sha1 sha2 crc32 "
+                               "atomics fphp asimdhp cpuid asimdrdm lrcpc dcpop asimddp ssbs\nCPU implementer\t: 0x41\n", "arm64"),
+}
+
+
+@pytest.mark.parametrize('machine, cpuinfo, label', CPUINFO_FIXTURES.values(), ids=CPUINFO_FIXTURES)
+def test_label(machine, cpuinfo, label):
+    assert CpuFeatures(cpuinfo, machine).label == label
+
+
+@pytest.mark.parametrize('fixture, artifacts, chosen', [
+    ("icelake_server", ["ZBProxy-linux-amd64-v1", "ZBProxy-linux-amd64-v3", "ZBProxy-linux-amd64-v4"], "ZBProxy-linux-amd64-v4"),
+    ("icelake_server", ["ZBProxy-linux-amd64-v1", "ZBProxy-linux-amd64-v3"], "ZBProxy-linux-amd64-v3"),
+    ("icelake_server", ["ZBProxy-linux-amd64-v1", "ZBProxy-linux-arm64"], "ZBProxy-linux-amd64-v1"),
+    ("westmere", ["ZBProxy-linux-amd64-v3", "ZBProxy-linux-amd64-v1"], "ZBProxy-linux-amd64-v1"),
+    ("neoverse_n1", ["ZBProxy-linux-amd64-v1", "ZBProxy-linux-arm64"], "ZBProxy-linux-arm64"),
+    ("neoverse_n1", ["ZBProxy-linux-amd64-v1", "ZBProxy-linux-amd64-v3"], None),
+])
+def test_choose_falls_back_to_the_best_supported_build(fixture, artifacts, chosen):
+    machine, cpuinfo, _ = CPUINFO_FIXTURES[fixture]
+    assert CpuFeatures(cpuinfo, machine).choose(artifacts) == chosen
+
+
+def test_this_host_is_detected():
+    host = CpuFeatures()
+    assert host.label and host.candidates()
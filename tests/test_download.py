@@ -0,0 +1,134 @@
+import os
+import tracemalloc
+
+import pytest
+
+from main import HttpClient, NetworkControl
+from fakes import LocalHttpServer, pattern_reader, sha256_of
+
+SIZE = 8 * 1024 * 1024
+
+
+@pytest.fixture
+def artifact(work_dir):
+    """A flaky artifact server: (URL, the Range header of every request, drop_after of the next one)."""
+    read_at = pattern_reader()
+    ranges, drops = [], []
+
+    def route(request):
+        ranges.append(request.headers.get('Range'))
+        return LocalHttpServer.byte_range_response(request, SIZE, read_at, drops.pop(0) if drops else None)
+
+    with LocalHttpServer({'/artifact': route}) as base_url:
+        yield f'{base_url}/artifact', ranges, drops, sha256_of(read_at, SIZE)
+
+
+def network_control():
+    return NetworkControl(HttpClient(retries=0))
+
+
+def test_dropped_download_resumes_where_it_stopped(artifact):
+    url, ranges, drops, sha256 = artifact
+    drops.append(SIZE // 2)
+    assert network_control().download_file(url, 'artifact.bin', sha256).startswith('Failed to download')
+    assert os.path.getsize('artifact.bin.part') == SIZE // 2
+    assert not os.path.exists('artifact.bin')
+
+    assert network_control().download_file(url, 'artifact.bin', sha256) == 'artifact.bin downloaded successfully'
+    assert ranges == [None, f'bytes={SIZE // 2}-']
+    assert os.path.getsize('artifact.bin') == SIZE
+    assert not os.path.exists('artifact.bin.part')
+
+
+def test_checksum_mismatch_discards_the_download(artifact):
+    url, _, _, _ = artifact
+    assert network_control().download_file(url, 'artifact.bin', '0' * 64) == 'Failed to download artifact.bin: checksum mismatch'
+    assert not os.path.exists('artifact.bin') and not os.path.exists('artifact.bin.part')
+
+
+def test_complete_part_file_is_not_fetched_again(artifact):
+    url, ranges, _, sha256 = artifact
+    read_at = pattern_reader()
+    with open('artifact.bin.part', 'wb') as part:
+        part.write(read_at(0, SIZE))  # Everything arrived, the rename did not happen
+    assert network_control().download_file(url, 'artifact.bin', sha256) == 'artifact.bin downloaded successfully'
+    assert ranges == [f'bytes={SIZE}-']  # Answered 416, no body
+    assert os.path.getsize('artifact.bin') == SIZE
+
+
+def test_peak_memory_stays_near_one_chunk(artifact):
+    url, _, _, sha256 = artifact
+    control = network_control()
+    tracemalloc.start()
+    try:
+        assert control.download_file(url, 'artifact.bin', sha256) == 'artifact.bin downloaded successfully'
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 16 * NetworkControl.CHUNK_SIZE  # Streamed, never the whole file
+
+
+@pytest.fixture
+def versioned(work_dir):
+    """An artifact server with ETags: (URL, the (Range, If-Range) of every request, drops, current version {"seed", "etag"})."""
+    requests_seen, drops = [], []
+    current = {"seed": b'v1', "etag": '"v1"'}
+
+    def route(request):
+        requests_seen.append((request.headers.get('Range'), request.headers.get('If-Range')))
+        return LocalHttpServer.byte_range_response(request, SIZE, pattern_reader(current["seed"]), drops.pop(0) if drops else None,
+                                                   etag=current["etag"])
+
+    with LocalHttpServer({'/artifact': route}) as base_url:
+        yield f'{base_url}/artifact', requests_seen, drops, current
+
+
+def test_resume_is_conditional_on_the_validator(versioned):
+    url, requests_seen, drops, _ = versioned
+    drops.append(SIZE // 2)
+    network_control().download_file(url, 'artifact.bin')
+    with open('artifact.bin.part.validator') as file:
+        assert file.read() == '"v1"'
+    assert network_control().download_file(url, 'artifact.bin') == 'artifact.bin downloaded successfully'
+    assert requests_seen == [(None, None), (f'bytes={SIZE // 2}-', '"v1"')]
+    assert not os.path.exists('artifact.bin.part.validator')
+
+
+def test_changed_file_is_fetched_from_the_start(versioned):
+    url, requests_seen, drops, current = versioned
+    drops.append(SIZE // 2)
+    network_control().download_file(url, 'artifact.bin')
+    current.update(seed=b'v2', etag='"v2"')  # A new build replaced it on the server
+    sha256 = sha256_of(pattern_reader(b'v2'), SIZE)
+    assert network_control().download_file(url, 'artifact.bin', sha256) == 'artifact.bin downloaded successfully'
+    assert requests_seen[-1] == (f'bytes={SIZE // 2}-', '"v1"')  # Answered 200 with the whole new file
+    with open('artifact.bin', 'rb') as file:
+        assert file.read(1024) == pattern_reader(b'v2')(0, 1024)
+
+
+def test_part_without_validator_or_checksum_is_not_resumed(artifact):
+    url, ranges, drops, _ = artifact
+    drops.append(SIZE // 2)
+    network_control().download_file(url, 'artifact.bin')
+    assert not os.path.exists('artifact.bin.part.validator')  # The server sent neither ETag nor Last-Modified
+    assert network_control().download_file(url, 'artifact.bin') == 'artifact.bin downloaded successfully'
+    assert ranges == [None, None]
+
+
+def test_wrong_content_range_restarts_the_download(work_dir):
+    read_at = pattern_reader()
+    ranges = []
+
+    def route(request):
+        ranges.append(request.headers.get('Range'))
+        if request.headers.get('Range'):  # Ignores the offset asked for, sends the file from byte 0 as a 206
+            return 206, {'Content-Range': f'bytes 0-{SIZE - 1}/{SIZE}', 'Content-Length': str(SIZE)}, read_at(0, SIZE)
+        return LocalHttpServer.byte_range_response(request, SIZE, read_at)
+
+    with open('artifact.bin.part', 'wb') as part:
+        part.write(read_at(0, 1024))
+    with LocalHttpServer({'/artifact': route}) as base_url:
+        result = network_control().download_file(f'{base_url}/artifact', 'artifact.bin', sha256_of(read_at, SIZE))
+    assert result == 'artifact.bin downloaded successfully'
+    assert ranges == ['bytes=1024-', None]
+    assert os.path.getsize('artifact.bin') == SIZE
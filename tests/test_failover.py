@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import json
+import time
+
+import pytest
+
+from main import HandleJsonFile, LatencyProbe, ProxyServer, UpstreamSelector
+from fakes import FakeMinecraftServer, RecordingSystemControl, count_writes
+
+SETTINGS = {"interval": 0.1, "timeout": 0.5, "window": 5, "margin": 0.2, "margin_ms": 5, "hold": 3, "dwell": 0.5,
+            "down_after": 2, "loss_penalty_ms": 1000}
+
+
+async def until(condition, limit: float = 10):
+    deadline = time.monotonic() + limit
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def pool(work_dir):
+    """Stand-in upstreams by name, and a proxy service pointing at the far one with all of them in its pool."""
+    with contextlib.ExitStack() as stack:
+        servers = {"far": FakeMinecraftServer(latency=0.06), "near": FakeMinecraftServer(latency=0.01),
+                   "middle": FakeMinecraftServer(latency=0.03)}
+        names = {f'127.0.0.1:{stack.enter_context(server)}': name for name, server in servers.items()}
+        far = next(key for key, name in names.items() if name == 'far')
+        host, port = LatencyProbe.parse_address(far)
+        with open('ZBProxy.json', 'w') as file:
+            json.dump({"Services": [ProxyServer.service_config(host, port, 25565)],
+                       "Lists": {"TransitServerIP": [], UpstreamSelector.list_name('MinecraftProxy'): sorted(names)}}, file)
+        proxy = ProxyServer(None, RecordingSystemControl())
+        proxy.writes = count_writes(proxy.zbproxy_config)
+        selector = UpstreamSelector(proxy, SETTINGS, str(work_dir / 'failover.json'))
+        yield selector, servers, names
+        for server in servers.values():
+            server.hang = False
+
+
+def run(selector, scenario):
+    async def main():
+        serving = asyncio.get_running_loop().create_task(selector.serve())
+        try:
+            assert await until(lambda: selector.stopped is not None)
+            await scenario()
+        finally:
+            selector.stopped.set()
+            await serving
+    asyncio.run(main())
+
+
+def target_in_config(selector):
+    with open('ZBProxy.json') as file:
+        service = json.load(file)["Services"][0]
+    return UpstreamSelector.address(service['TargetAddress'], service['TargetPort'])
+
+
+def test_converges_on_the_fastest_with_one_write_per_switch(pool):
+    selector, _, names = pool
+
+    async def scenario():
+        assert await until(lambda: names.get(selector.active) == 'near')
+        await asyncio.sleep(SETTINGS["interval"] * 5)  # Settled, no switch back and forth
+    run(selector, scenario)
+    assert [names[switch["to"]] for switch in selector.switches] == ['near']
+    assert names[target_in_config(selector)] == 'near'
+    assert len(selector.proxy_server.writes) == 1
+    assert selector.proxy_server.system_control.systemctl() == ['sudo systemctl restart ZBProxy']  # TargetAddress needs a restart
+    assert len(HandleJsonFile(selector.status_path).read_json()["candidates"]) == 3
+
+
+@pytest.mark.parametrize('change', ['degrade', 'hang', 'die'])
+def test_leaves_an_upstream_that_goes_bad(pool, change):
+    selector, servers, names = pool
+
+    async def scenario():
+        assert await until(lambda: names.get(selector.active) == 'near')
+        near = servers['near']
+        if change == 'degrade':
+            near.latency = 0.1
+        elif change == 'hang':
+            near.hang = True
+        else:
+            near.stop()
+            near.stop = lambda: None  # The fixture has nothing left to stop
+        assert await until(lambda: names.get(selector.active) != 'near')
+    run(selector, scenario)
+    assert names[selector.switches[-1]["to"]] in ('middle', 'far')
+    assert target_in_config(selector) == selector.active
+    assert len(selector.proxy_server.writes) == len(selector.switches)
+
+
+def test_fails_back_to_an_original_target_outside_the_list(pool):
+    selector, servers, names = pool
+    near, middle = (next(key for key, name in names.items() if name == wanted) for wanted in ('near', 'middle'))
+    host, port = LatencyProbe.parse_address(near)
+    with open('ZBProxy.json', 'w') as file:  # The origin is the target and in no list, like after `proxy setup`
+        json.dump({"Services": [ProxyServer.service_config(host, port, 25565)],
+                   "Lists": {"TransitServerIP": [], UpstreamSelector.list_name('MinecraftProxy'): [middle]}}, file)
+
+    async def scenario():
+        assert await until(lambda: selector.rounds > 0)
+        servers['near'].hang = True
+        assert await until(lambda: selector.active == middle)
+        servers['near'].hang = False
+        assert await until(lambda: selector.active == near)
+    run(selector, scenario)
+    assert [names[switch["to"]] for switch in selector.switches] == ['middle', 'near']
+    assert target_in_config(selector) == near
+    assert sorted(selector.pool()[1]) == sorted([near, middle])
+    assert ProxyServer(None, RecordingSystemControl()).remove_upstream(near).startswith('Failed')  # Still the target
+
+
+def test_no_pool_without_the_service(work_dir):
+    with open('ZBProxy.json', 'w') as file:
+        json.dump({"Services": [], "Lists": {}}, file)
+    selector = UpstreamSelector(ProxyServer(None, RecordingSystemControl()), SETTINGS, str(work_dir / 'failover.json'))
+    assert selector.pool() == (None, [])
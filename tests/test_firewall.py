@@ -0,0 +1,56 @@
+import pytest
+
+from main import TransitServer
+from fakes import FakeUfwSystemControl, transit_service, write_config
+
+
+@pytest.fixture
+def transit(work_dir):
+    write_config('ZBProxy.json', [])
+    return TransitServer('test', FakeUfwSystemControl({22: '', 25565: ''}))
+
+
+def test_batch_opens_every_port_in_one_reconcile(transit):
+    ufw = transit.system_control
+    with transit.batch():
+        for i in range(50):
+            transit.add_service(transit_service(30000 + i, f'test{i}'))
+    assert set(range(30000, 30050)) <= set(ufw.rules)
+    assert ufw.rules[30000] == 'OProxy'
+    assert len(ufw.commands) <= 3  # Install check aside: list the rules once, apply them once
+
+
+def test_drift_is_closed_and_unmanaged_rules_kept(transit):
+    ufw = transit.system_control
+    with transit.batch():
+        for i in range(10):
+            transit.add_service(transit_service(30000 + i, f'test{i}'))
+    with transit.zbproxy_config.transaction() as config:
+        del config["Services"][:5]
+
+    plan = transit.reconcile_firewall(dry_run=True)
+    assert (len(plan["open"]), len(plan["close"])) == (0, 5)
+    assert set(range(30000, 30005)) <= set(ufw.rules)  # A dry run changes nothing
+
+    transit.reconcile_firewall()
+    assert not set(range(30000, 30005)) & set(ufw.rules)
+    assert set(range(30005, 30010)) <= set(ufw.rules)
+    assert 22 in ufw.rules and 25565 in ufw.rules
+
+
+def test_up_to_date_firewall_makes_no_changes(transit):
+    ufw = transit.system_control
+    transit.add_service(transit_service(30000, 'test0'))
+    calls = ufw.ufw_calls
+    transit.reconcile_firewall()
+    assert ufw.ufw_calls - calls == 1  # Only `ufw show added`
+
+
+def test_refused_rule_stops_the_sync_and_is_reported(work_dir):
+    write_config('ZBProxy.json', [transit_service(30000 + i, f'test{i}') for i in range(3)])
+    transit = TransitServer('test', FakeUfwSystemControl(refused={30001}))
+    result = transit.reconcile_firewall()
+    assert result["applied"] is False
+    assert '30001' in result["error"]
+    assert 30000 in transit.system_control.rules
+    assert not {30001, 30002} & set(transit.system_control.rules)
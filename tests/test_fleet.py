@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+
+from main import Benchmark, Fleet, SshTransport
+from fakes import LocalTransport
+
+HOSTS = 12
+
+
+@pytest.fixture
+def inventory(work_dir):
+    inventory = {"retries": 2, "backoff": 0.01, "hosts": [
+        {"name": "proxy-1", "role": "proxy", "transport": "local", "dir": str(work_dir / "proxy-1")}
+    ]}
+    for i in range(HOSTS):
+        inventory["hosts"].append({"name": f"transit-{i + 1}", "role": "transit", "transport": "local",
+                                   "dir": str(work_dir / f"transit-{i + 1}")})
+    for host in inventory["hosts"]:
+        os.makedirs(host["dir"])
+        Benchmark.seed_work_dir(host["dir"])
+    with open('fleet.json', 'w') as file:
+        json.dump(inventory, file)
+    return inventory
+
+
+def names_on(host):
+    with open(os.path.join(host["dir"], "ZBProxy.json")) as file:
+        return json.load(file)["Lists"]["bench_group"]
+
+
+@pytest.mark.parametrize('concurrency', [1, 8])
+def test_command_reaches_every_transit_host(inventory, concurrency):
+    # Every fifth host drops its first attempt, the retry has to get it through
+    transport = LocalTransport(failures={f"transit-{i + 1}": 1 for i in range(0, HOSTS, 5)})
+    results = Fleet('fleet.json', {"local": transport}).run(["transit", "whitelist", "add", "Steve", "bench_group"],
+                                                           concurrency=concurrency, quiet=True)
+    assert [result["host"] for result in results] == [f"transit-{i + 1}" for i in range(HOSTS)]
+    assert all(result["ok"] for result in results)
+    assert sum(result["attempts"] > 1 for result in results) == len(range(0, HOSTS, 5))
+    assert all(names_on(host) == ["Steve"] for host in inventory["hosts"][1:])
+    assert names_on(inventory["hosts"][0]) == []  # The proxy role is not selected
+
+
+def test_host_failing_every_attempt_is_reported(inventory):
+    transport = LocalTransport(failures={"transit-1": 10})
+    results = Fleet('fleet.json', {"local": transport}).run(["transit", "whitelist", "on", "bench_group"], quiet=True)
+    assert (results[0]["ok"], results[0]["attempts"], results[0]["returncode"]) == (False, 3, 255)
+    assert all(result["ok"] for result in results[1:])
+
+
+def test_failing_command_is_retried_and_counted_as_failed(inventory):
+    results = Fleet('fleet.json', {"local": LocalTransport()}).run(["transit", "whitelist", "on", "no_such_group"], quiet=True)
+    assert {(result["ok"], result["attempts"], result["returncode"]) for result in results} == {(False, 3, 1)}
+    assert all("Not found" in result["output"] for result in results)
+
+
+def test_selector_picks_hosts_by_name_and_role(inventory):
+    fleet = Fleet('fleet.json', {"local": LocalTransport()})
+    assert [host["name"] for host in fleet.select(["transit"], "proxy-1,transit-2")] == ["proxy-1", "transit-2"]
+    assert [host["name"] for host in fleet.select(["proxy"], "transit")] == [f"transit-{i + 1}" for i in range(HOSTS)]
+    assert [host["name"] for host in fleet.select(["proxy"])] == ["proxy-1"]
+
+
+def test_ssh_command_reuses_a_master_connection():
+    command = SshTransport.command({"name": "a", "address": "10.0.0.1", "user": "ops", "dir": "/srv/oproxy"},
+                                   ["transit", "whitelist", "add", "Steve's alt", "group"])
+    assert "ControlMaster=auto" in command and "ops@10.0.0.1" in command
+    assert command[-1] == "cd /srv/oproxy && sudo -n ./OProxy transit whitelist add 'Steve'\"'\"'s alt' group"
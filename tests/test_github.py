@@ -0,0 +1,112 @@
+import os
+import time
+
+import pytest
+import requests
+
+from main import HttpClient, MetadataCache, ProgramControl
+from fakes import LocalHttpServer, RecordingSystemControl, counted_routes, github_routes
+
+
+@pytest.fixture
+def github(work_dir):
+    """A GitHub stand-in: (base URL, answered status codes, failures to answer next)."""
+    base_url_holder, failures, statuses = [], [], []
+    server = LocalHttpServer(counted_routes(github_routes(base_url_holder, failures=failures), statuses))
+    with server as base_url:
+        base_url_holder.append(base_url)
+        yield base_url, statuses, failures, server
+
+
+def program_control(base_url, work_dir, ttl=0):
+    control = ProgramControl('test', HttpClient(backoff=0.01), base_url, MetadataCache(os.path.join(work_dir, 'metadata.json'), ttl=ttl))
+    control.INSTALLED_BUILD = os.path.join(work_dir, 'zbproxy_build.json')
+    control.system_control = RecordingSystemControl()
+    return control
+
+
+def test_one_pooled_connection_for_many_updates(github, work_dir):
+    base_url, statuses, _, server = github
+    control = program_control(base_url, work_dir)
+    for _ in range(5):
+        assert control.get_latest_artifact_download_url('test') == f'{base_url}/download/zbproxy.zip'
+        assert control.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy') == f'{base_url}/download/OProxy'
+    assert len(statuses) == 20
+    assert server.connections == 1
+
+
+def test_pooled_updates_pay_the_handshake_once(work_dir):
+    """With a slow TCP+TLS handshake, the calls of an update on fresh connections pay it every time, the pooled client once."""
+    handshake, updates = 0.1, 3
+    base_url_holder = []
+    with LocalHttpServer(github_routes(base_url_holder), connect_delay=handshake) as base_url:
+        base_url_holder.append(base_url)
+        started = time.perf_counter()
+        for _ in range(updates):
+            for path in ('/repos/layou233/ZBProxy/actions/runs', '/repos/layou233/ZBProxy/actions/runs/42/artifacts',
+                         '/repos/layou233/ZBProxy/actions/artifacts/1/zip', '/repos/GTBoost2024/OProxy/releases/latest'):
+                requests.get(f'{base_url}{path}', allow_redirects=False)
+        fresh = time.perf_counter() - started
+
+        control = program_control(base_url, work_dir)
+        started = time.perf_counter()
+        for _ in range(updates):
+            control.get_latest_artifact_download_url('test')
+            control.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy')
+        pooled = time.perf_counter() - started
+    assert fresh >= updates * 4 * handshake
+    assert pooled < fresh / 4
+
+
+def test_metadata_is_revalidated_with_etags(github, work_dir):
+    base_url, statuses, _, _ = github
+    control = program_control(base_url, work_dir)
+    control.get_latest_artifact_download_url('test')
+    statuses.clear()
+    assert control.get_latest_artifact_download_url('test') == f'{base_url}/download/zbproxy.zip'
+    assert statuses == [304, 304, 302]  # Runs and artifacts not modified, the signed zip URL is never cached
+
+
+def test_metadata_within_ttl_makes_no_request(github, work_dir):
+    base_url, statuses, _, _ = github
+    control = program_control(base_url, work_dir, ttl=60)
+    control.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy')
+    statuses.clear()
+    control.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy')
+    assert statuses == []
+
+
+def test_up_to_date_update_downloads_and_restarts_nothing(github, work_dir):
+    base_url, statuses, _, _ = github
+    control = program_control(base_url, work_dir, ttl=60)
+    control.get_latest_artifact_download_url('test')
+    control.record_installed_build(control.latest_run_id)
+    statuses.clear()
+    assert control.update_zbproxy() == "ZBProxy is already up to date."
+    assert statuses == []
+    assert control.system_control.commands == []
+
+
+def test_server_errors_and_rate_limits_are_retried(github, work_dir):
+    base_url, statuses, failures, _ = github
+    failures.extend([503, 403])
+    control = program_control(base_url, work_dir)
+    assert control.get_latest_artifact_download_url('test') is not None
+    assert failures == []
+    assert statuses[:2] == [503, 403]
+
+
+def test_upgrade_without_the_asset_keeps_the_old_program(github, work_dir):
+    base_url, _, _, server = github
+    server.routes['/repos/GTBoost2024/OProxy/releases/latest'] = lambda request: LocalHttpServer.json_response({"assets": []})
+    control = program_control(base_url, work_dir)
+    assert control.get_latest_release_download_url('GTBoost2024', 'OProxy', 'OProxy') is None
+    assert control.upgrade_program() == "Failed to get the download URL."
+    assert control.system_control.commands == []
+
+
+def test_failed_upgrade_download_puts_the_old_program_back(github, work_dir):
+    base_url, _, _, _ = github  # The stand-in has no /download/OProxy, the download gets a 404
+    control = program_control(base_url, work_dir)
+    assert control.upgrade_program().startswith("Failed to download OProxy")
+    assert control.system_control.commands == ['sudo mv OProxy OProxy.old', 'sudo mv OProxy.old OProxy']
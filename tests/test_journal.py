@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from main import TransitServer
+from fakes import RecordingSystemControl, count_writes, transit_service, write_config
+
+
+@pytest.fixture
+def transit(work_dir):
+    write_config('ZBProxy.json', [])
+    server = TransitServer('test', RecordingSystemControl(installed=('ufw',)))
+    server.writes = count_writes(server.zbproxy_config)
+    return server
+
+
+def provision(transit, services):
+    for i in range(services):
+        transit.add_service(transit_service(30000 + i, f'test{i}'))
+    for i in range(services):
+        transit.switch_upstream(f'test{i}', '127.0.0.1', 25566)
+
+
+def activations(transit):
+    return len(transit.system_control.systemctl('restart'))
+
+
+def test_one_by_one_writes_and_activates_per_command(transit):
+    provision(transit, 5)
+    assert len(transit.writes) == 10
+    assert activations(transit) == 5  # add_service leaves starting the listener to `zbproxy restart`
+
+
+def test_batch_writes_once_and_activates_once(transit):
+    with transit.batch() as summary:
+        provision(transit, 5)
+    assert len(transit.writes) == 1
+    assert activations(transit) == 1
+    assert summary["saved"] == 4
+    assert len(transit.zbproxy_config.read_json()["Services"]) == 5
+
+
+def test_batch_that_cancels_out_activates_nothing(transit):
+    with transit.batch() as summary:
+        transit.add_service(transit_service(30000, 'test0'))
+        transit.remove_service('test0')
+    assert transit.system_control.systemctl() == []
+    assert summary["action"] == 'none'
+
+
+def test_batch_of_toggles_writes_once_and_restarts_nothing(transit):
+    write_config('ZBProxy.json', [transit_service(30000 + i, f'test{i}') for i in range(3)])
+    with transit.batch() as summary:
+        for i in range(3):
+            transit.turn_off_whitelist(f'test{i}')
+    assert len(transit.writes) == 1
+    assert transit.system_control.systemctl() == []
+    assert summary["action"] == 'none'
+
+
+def test_batch_on_another_thread_defers_nothing_here(work_dir):
+    servers = []
+    for path in ('a.json', 'b.json'):
+        write_config(path, [transit_service(30000 + i, f'test{i}') for i in range(2)])
+        servers.append(TransitServer('test', RecordingSystemControl(installed=('ufw',)), path))
+    opened, release, summaries = threading.Event(), threading.Event(), []
+
+    def batched():
+        with servers[0].batch() as summary:
+            servers[0].switch_upstream('test0', '127.0.0.1', 25566)
+            opened.set()
+            release.wait(5)
+            servers[0].switch_upstream('test1', '127.0.0.1', 25566)
+        summaries.append(summary)
+
+    worker = threading.Thread(target=batched)
+    worker.start()
+    try:
+        assert opened.wait(5)
+        servers[1].switch_upstream('test0', '127.0.0.1', 25566)  # Outside of any batch on this thread, so applied at once
+        assert servers[1].system_control.systemctl() == ['sudo systemctl restart ZBProxy']
+        assert servers[0].system_control.systemctl() == []
+    finally:
+        release.set()
+        worker.join()
+    assert summaries == [{"action": 'restart', "saved": 1}]
+    assert servers[0].system_control.systemctl() == ['sudo systemctl restart ZBProxy']
@@ -0,0 +1,42 @@
+
+import pytest
+
+from main import Benchmark
+from fakes import STAND_IN_ZBPROXY
+
+
+@pytest.fixture
+def stand_in_binary(tmp_path):
+    """A zbproxy that execs the stand-in, serving ZBProxy.json from its working directory."""
+    path = tmp_path / 'zbproxy'
+    path.write_text(f"#!/bin/sh\nexec {' '.join(STAND_IN_ZBPROXY)}\n")
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_load_drives_clients_through_every_variant(stand_in_binary):
+    results = Benchmark().load(clients=40, concurrency=8, payload_kb=4, binary_path=stand_in_binary,
+                               variants=["transit", "transit,whitelist=off"])
+    assert set(results) == {"transit", "transit,whitelist=off"}
+    for result in results.values():
+        assert result["error_rate"] == 0
+        assert result["connections_per_second"] > 0
+        assert result["bytes_per_second"] > 0
+
+
+def test_load_needs_a_build(tmp_path):
+    assert Benchmark().load(binary_path=str(tmp_path / 'zbproxy')) == {"error": f"no ZBProxy build at {tmp_path / 'zbproxy'}"}
+
+
+def test_load_config_variants():
+    names = ["Player0", "Player1"]
+    transit = Benchmark.load_config("transit,flow=proxy,rewrite=off", 25565, 25566, names)
+    service = transit["Services"][0]
+    assert (service["TargetPort"], service["Listen"], service["Flow"]) == (25565, 25566, "proxy")
+    assert service["Minecraft"]["EnableHostnameRewrite"] is False
+    assert transit["Lists"] == {"LoadTest": names}
+
+    proxy = Benchmark.load_config("proxy,whitelist=on", 25565, 25566, names)
+    assert proxy["Services"][0]["Minecraft"]["NameAccess"] == {"Mode": "allow", "ListTags": ["LoadTest"]}
+    assert proxy["Lists"] == {"TransitServerIP": ["127.0.0.1"], "LoadTest": names}
+    assert Benchmark.load_config("transit,whitelist=off", 1, 2, names)["Services"][0]["Minecraft"]["NameAccess"] == {"Mode": ""}
@@ -0,0 +1,121 @@
+import gzip
+import os
+import time
+
+import pytest
+
+from main import LogIndex, MinecraftTransitService, ZBProxyLog
+
+SESSIONS, PLAYERS = 6000, 300
+NOW = int(time.time())
+SPAN = 14 * 86400
+
+
+def generate(first, count, expected):
+    """Syslog lines of count sessions spread over two weeks, counting what the queries must find into expected."""
+    lines = []
+    for i in range(first, first + count):
+        stamp = NOW - SPAN + SPAN * i // (SESSIONS + 1000)
+        at = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(stamp))
+        service = ("Survival", "Creative")[i % 2]
+        prefix = f"transit-1 zbproxy[812]: Service {service} : [10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:{20000 + i % 40000}]"
+        lines.append(f"{at} {prefix} New inbound connection")
+        if i % 10 == 9:
+            name = f"Intruder{i % 37 % (i % 7 + 1)}"
+            lines.append(f"{at} {prefix} Rejected by name access control: {name}")
+            # Only odd sessions are rejected, all on Creative; rejections are counted per day
+            if at[:10] >= time.strftime('%Y-%m-%d', time.gmtime(NOW - 7 * 86400)):
+                expected["rejected"][name] = expected["rejected"].get(name, 0) + 1
+        else:
+            lines.append(f"{at} {prefix} New Minecraft player logged in: Player{i % PLAYERS}")
+            if i % PLAYERS == 100 and service == "Survival" and stamp >= NOW - 7 * 86400:
+                expected["sessions"] += 1
+        lines.append(f"{at} transit-1 kernel: [UFW BLOCK] IN=eth0 SRC=192.0.2.{i % 255}")
+        lines.append(f"{time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(stamp + 60 + i % 3600))} {prefix} Connection closed")
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture
+def indexed(work_dir):
+    """Two weeks of syslog, rotated twice, indexed once."""
+    expected = {"sessions": 0, "rejected": {}}
+    third = SESSIONS // 3
+    with gzip.open('syslog.2.gz', 'wt') as file:
+        file.write(generate(0, third, expected))
+    with open('syslog.1', 'w') as file:
+        file.write(generate(third, third, expected))
+    with open('syslog', 'w') as file:
+        file.write(generate(2 * third, SESSIONS - 2 * third, expected))
+    index = LogIndex('index')
+    full = index.index('syslog*')
+    return index, full, expected
+
+
+def test_every_event_is_indexed_once(indexed):
+    index, full, expected = indexed
+    assert full["events"] == SESSIONS
+    assert index.index('syslog*')["events"] == 0
+
+    with open('syslog', 'a') as file:
+        file.write(generate(SESSIONS, 1000, expected))
+    assert index.index('syslog*')["events"] == 1000
+
+    # Rotate like logrotate with delaycompress: .2.gz -> .3.gz, .1 -> .2.gz, current -> .1
+    os.replace('syslog.2.gz', 'syslog.3.gz')
+    with open('syslog.1', 'rb') as source, gzip.open('syslog.2.gz', 'wb') as target:
+        target.write(source.read())
+    os.replace('syslog', 'syslog.1')
+    open('syslog', 'w').close()
+    assert index.index('syslog*')["events"] == 0
+
+
+def test_run_that_dies_before_saving_its_state_leaves_no_duplicates(indexed, monkeypatch):
+    index, _, expected = indexed
+    with open('syslog', 'a') as file:
+        file.write(generate(SESSIONS, 1000, expected))
+    before = index.sessions("Player100", service="Survival", days=30)
+
+    def crash(data):
+        raise RuntimeError("killed")
+    with monkeypatch.context() as patch:
+        patch.setattr(index.aggregates_file, 'write_json', crash)  # After events.bin, before state.json
+        with pytest.raises(RuntimeError):
+            index.index('syslog*')
+    assert os.path.getsize(index.events_path) == (SESSIONS + 1000) * LogIndex.RECORD.size
+
+    assert index.index('syslog*')["events"] == 1000
+    assert os.path.getsize(index.events_path) == (SESSIONS + 1000) * LogIndex.RECORD.size
+    added = [i for i in range(SESSIONS, SESSIONS + 1000) if i % PLAYERS == 100 and i % 2 == 0]  # Survival logins
+    assert len(index.sessions("Player100", service="Survival", days=30)) == len(before) + len(added)
+
+
+def test_sessions_match_a_full_rescan(indexed):
+    index, _, expected = indexed
+    sessions = index.sessions("Player100", service="Survival", days=7)
+    rescanned = 0
+    for path in LogIndex.sources('syslog*'):
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rt') as file:
+            for line in file:
+                event = ZBProxyLog.parse_syslog(line.rstrip('\n'))
+                if (event and event['event'] == 'login' and event['player'] == 'Player100'
+                        and event['service'] == 'Survival' and event['time'] >= NOW - 7 * 86400):
+                    rescanned += 1
+    assert len(sessions) == expected["sessions"] == rescanned > 0
+    assert all(session["duration_seconds"] is not None for session in sessions)
+
+
+def test_sessions_by_ip(indexed):
+    index, _, _ = indexed
+    sessions = index.sessions(ip="10.0.0.100", days=14)
+    assert len(sessions) == 1 and sessions[0]["player"] == "Player100"
+
+
+def test_top_rejected_and_stale(indexed):
+    index, _, expected = indexed
+    config = {"Services": [MinecraftTransitService("127.0.0.1", 25565, 25566, "Survival").service_dict,
+                           MinecraftTransitService("127.0.0.1", 25565, 25567, "Creative").service_dict],
+              "Lists": {"Survival": [f"Player{i}" for i in range(0, PLAYERS, 50)] + ["Retired1", "Retired2"], "Creative": []}}
+    top = sorted(expected["rejected"].items(), key=lambda item: -item[1])[:5]
+    assert [count for _, count in index.top_rejected(config, days=7, top=5)["Creative"]] == [count for _, count in top]
+    stale = {entry["name"] for entry in index.stale(config, days=1).get("Survival", [])}
+    assert {"Retired1", "Retired2"} <= stale
@@ -0,0 +1,104 @@
+import os
+import tracemalloc
+import urllib.request
+
+import pytest
+
+from main import MetricsExporter, MinecraftTransitService, ZBProxyLog, ZBProxyMetrics
+
+# Recorded ZBProxy syslog lines and what they must count to
+ZBPROXY_LOG = """\
+Oct 18 10:00:00 transit-1 systemd[1]: Started ZBProxy.service - ZBProxy service.
+Oct 18 10:00:01 transit-1 zbproxy[812]: Service Survival : [203.0.113.7:51234] New inbound connection
+Oct 18 10:00:01 transit-1 zbproxy[812]: Service Survival : [203.0.113.7:51234] New Minecraft player logged in: Steve
+Oct 18 10:00:02 transit-1 zbproxy[812]: Service Survival : [198.51.100.9:40000] New inbound connection
+Oct 18 10:00:02 transit-1 zbproxy[812]: Service Survival : [198.51.100.9:40000] Rejected by name access control: Griefer
+Oct 18 10:00:02 transit-1 zbproxy[812]: Service Survival : [198.51.100.9:40000] Connection closed
+Oct 18 10:04:01 transit-1 zbproxy[812]: Service Survival : [203.0.113.7:51234] Connection closed
+2026-10-18T10:05:00.123456+00:00 transit-1 zbproxy[812]: Service Creative : [[2001:db8::1]:50000] New inbound connection
+2026-10-18T10:05:00.200000+00:00 transit-1 zbproxy[812]: Service Creative : [[2001:db8::1]:50000] Error: dial tcp 10.0.0.5:25565: connect: connection refused
+Oct 18 10:06:00 transit-1 CRON[900]: (root) CMD (command -v debian-sa1 > /dev/null && debian-sa1 1 1)
+"""
+ZBPROXY_LOG_COUNTS = {
+    ('connection', 'Survival', 'Survival'): 2,
+    ('login', 'Survival', 'Survival'): 1,
+    ('rejected', 'Survival', 'Survival'): 1,
+    ('disconnect', 'Survival', 'Survival'): 2,
+    ('connection', 'Creative', ''): 1,
+    ('error', 'Creative', ''): 1,
+}
+
+
+@pytest.fixture
+def config():
+    config = {"Services": [MinecraftTransitService("127.0.0.1", 25565, 25566, "Survival").service_dict,
+                           MinecraftTransitService("127.0.0.1", 25565, 25567, "Creative").service_dict],
+              "Lists": {"Survival": [], "Creative": []}}
+    config["Services"][1]["Minecraft"]["NameAccess"] = {"Mode": ""}
+    return config
+
+
+def test_recorded_log_counts(work_dir, config):
+    with open('syslog', 'w') as file:
+        file.write(ZBPROXY_LOG)
+    exporter = MetricsExporter(ZBProxyMetrics(config), 'syslog', from_start=True)
+    exporter.poll()
+    assert dict(exporter.metrics.counters) == ZBPROXY_LOG_COUNTS
+    assert exporter.metrics.histograms['Survival'][-2] == 240  # Steve's session, login to close
+
+
+@pytest.mark.parametrize('line, event, player', [
+    ("Oct 18 10:00:01 h zbproxy[1]: Service A : [1.2.3.4:5] New Minecraft player logged in: Steve", 'login', 'Steve'),
+    ("Oct 18 10:00:01 h zbproxy[1]: Service A : [1.2.3.4:5] Rejected by name access control: Alex", 'rejected', 'Alex'),
+    ("Oct 18 10:00:01 h zbproxy[1]: Service A : [1.2.3.4:5] Connection closed", 'disconnect', ''),
+])
+def test_parse_syslog(line, event, player):
+    parsed = ZBProxyLog.parse_syslog(line)
+    assert (parsed['event'], parsed['service'], parsed['address'], parsed.get('player')) == (event, 'A', '1.2.3.4:5', player)
+
+
+def test_other_programs_are_skipped():
+    assert ZBProxyLog.parse_syslog("Oct 18 10:06:00 h CRON[900]: (root) CMD (Service A connection)") is None
+
+
+def test_follows_a_rotating_log_with_bounded_memory(work_dir, config):
+    with open('syslog', 'w') as file:
+        file.write(ZBPROXY_LOG)
+    exporter = MetricsExporter(ZBProxyMetrics(config), 'syslog')  # Starts at the end, like a fresh exporter
+    base_url = exporter.start_endpoint(port=0)
+    sessions, batch = 10000, 1000
+    expected = {"connection": 0, "login": 0, "disconnect": 0, "rejected": 0}
+    tracemalloc.start()
+    try:
+        for first in range(0, sessions, batch):
+            lines = []
+            for i in range(first, first + batch):
+                prefix = (f"Oct 18 11:{i // 60000 % 60:02d}:{i // 1000 % 60:02d} transit-1 zbproxy[812]: "
+                          f"Service {('Survival', 'Creative')[i % 2]} : [10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:{20000 + i}]")
+                lines.append(f"{prefix} New inbound connection")
+                if i % 10 == 9:
+                    lines.append(f"{prefix} Rejected by name access control: Player{i}")
+                    expected["rejected"] += 1
+                else:
+                    lines.append(f"{prefix} New Minecraft player logged in: Player{i}")
+                    expected["login"] += 1
+                lines.append(f"Oct 18 11:00:00 transit-1 kernel: [UFW BLOCK] IN=eth0 SRC=192.0.2.{i % 255}")
+                lines.append(f"{prefix} Connection closed")
+                expected["connection"] += 1
+                expected["disconnect"] += 1
+            with open('syslog', 'a') as file:
+                file.write('\n'.join(lines) + '\n')
+            if first == sessions // 2:  # Rotate like logrotate, the old file's tail is still unread
+                os.replace('syslog', 'syslog.1')
+                open('syslog', 'w').close()
+            exporter.poll()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    counted = {event: sum(value for (kind, _, _), value in exporter.metrics.counters.items() if kind == event) for event in expected}
+    assert counted == expected
+    assert exporter.metrics.sessions == {}
+    assert peak < 16 * 1024 * 1024
+    with urllib.request.urlopen(f"{base_url}/metrics") as response:
+        scraped = response.read().decode()
+    assert f'oproxy_zbproxy_session_duration_seconds_count{{service="Survival"}} {sessions // 2}' in scraped  # Every Survival player logs in
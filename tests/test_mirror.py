@@ -0,0 +1,147 @@
+import io
+import os
+import shlex
+import zipfile
+
+import pytest
+
+from main import BlueGreenUpdate, BuildCache, CpuFeatures, HttpClient, MetadataCache, ProgramControl
+from fakes import STAND_IN_ZBPROXY, LocalHttpServer, StandInServiceControl, counted_routes, github_routes, transit_service, write_config
+from test_cpu import CPUINFO_FIXTURES
+
+PADDING = os.urandom(256 * 1024)  # Compresses no better than a real binary
+
+
+def build(version):
+    # The shell never reads past exec, the padding only gives the build a real size
+    return f"#!/bin/sh\n# build {version}\nexec {shlex.join(STAND_IN_ZBPROXY)}\n".encode() + PADDING
+
+
+def archive(version):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(f'ZBProxy-linux-amd64-{version.split("-")[1]}', build(version))
+    return buffer.getvalue()
+
+
+def read_binary():
+    with open('zbproxy', 'rb') as file:
+        return file.read()
+
+
+@pytest.fixture
+def github(work_dir):
+    """A GitHub stand-in serving runs 42 and 43 of v1 and v3 builds; current["run"] is the latest."""
+    archives = {f'{run}-v{level}': archive(f'{run}-v{level}') for run in (42, 43) for level in (1, 3)}
+    current = {"run": 42}
+    base_url_holder, statuses = [], []
+
+    def zip_redirect(level):
+        def redirect(request):
+            return 302, {'Location': f'{base_url_holder[0]}/download/{current["run"]}-v{level}.zip', 'Content-Length': '0'}, b''
+        return redirect
+
+    def download(request):
+        data = archives[request.path.split('?')[0].rsplit('/', 1)[-1][:-len('.zip')]]
+        return LocalHttpServer.byte_range_response(request, len(data), lambda offset, length: data[offset:offset + length])
+
+    def routes():
+        routes = github_routes(base_url_holder, current["run"])
+        routes.update({'/repos/layou233/ZBProxy/actions/artifacts/1/zip': zip_redirect(1),
+                       '/repos/layou233/ZBProxy/actions/artifacts/3/zip': zip_redirect(3), '/download/': download})
+        return counted_routes(routes, statuses)
+
+    server = LocalHttpServer(routes())
+    with server as base_url:
+        base_url_holder.append(base_url)
+
+        def release(run):
+            current["run"] = run
+            server.routes.update(routes())
+        yield base_url, statuses, release
+
+
+def program_control(base_url, work_dir, name):
+    control = ProgramControl('test', HttpClient(backoff=0.01), base_url, MetadataCache(os.path.join(work_dir, f'{name}-metadata.json'), ttl=0))
+    control.build_cache = BuildCache(os.path.join(work_dir, f'{name}-builds'))
+    return control
+
+
+@pytest.fixture
+def mirror(github, work_dir):
+    base_url, _, _ = github
+    return program_control(base_url, work_dir, 'mirror')
+
+
+@pytest.fixture
+def client(github, work_dir):
+    base_url, _, _ = github
+    write_config('ZBProxy.json', [transit_service(BlueGreenUpdate.spare_port(), 'Mirror')])
+    client = program_control(base_url, work_dir, 'client')
+    client.INSTALLED_BUILD = os.path.join(work_dir, 'zbproxy_build.json')
+    machine, cpuinfo, _ = CPUINFO_FIXTURES["haswell"]
+    client.cpu = CpuFeatures(cpuinfo, machine)
+    client.system_control = StandInServiceControl(str(work_dir))
+    client.system_control.start()
+    yield client
+    client.system_control.stop()
+
+
+def test_mirror_fetches_each_build_once(mirror):
+    assert mirror.cache_latest_builds() == ['ZBProxy-linux-amd64-v1', 'ZBProxy-linux-amd64-v3']
+    assert mirror.cache_latest_builds() == []
+
+
+def test_update_and_rollback_through_the_mirror(github, mirror, client):
+    _, statuses, release = github
+    mirror.cache_latest_builds()
+    with LocalHttpServer(mirror.build_cache.routes()) as mirror_url:
+        client.MIRROR = mirror_url
+        statuses.clear()
+        client.update_zbproxy()
+        assert read_binary() == build('42-v3')
+        assert statuses == []  # Neither metadata nor the build came from GitHub
+
+        # A new workflow run reaches GitHub, the mirror picks it up on its next refresh
+        release(43)
+        assert len(mirror.cache_latest_builds()) == 2
+        client.update_zbproxy()
+        assert read_binary() == build('43-v3')
+
+    # Rolling back comes from the local cache, the mirror is stopped to prove it
+    statuses.clear()
+    client.update_zbproxy(run_id=42)
+    assert read_binary() == build('42-v3')
+    assert statuses == []
+    assert os.stat('zbproxy').st_ino == os.stat(client.build_cache.object_path(client.build_cache.find(42, client.cpu)["sha256"])).st_ino
+    assert client.system_control.restarts == 3
+
+
+def test_rollback_to_an_uncached_run_fails(mirror, client):
+    assert "41" in client.update_zbproxy(run_id=41)
+
+
+def test_mirror_down_falls_back_to_github(github, client):
+    _, statuses, _ = github
+    client.MIRROR = f'http://127.0.0.1:{BlueGreenUpdate.spare_port()}'
+    assert client.latest_zbproxy_run_id() == 42
+    assert statuses
+
+
+def test_eviction_keeps_the_pinned_build(work_dir):
+    cache = BuildCache(str(work_dir / 'builds'), int(len(build('40-v1')) * 2.5))
+    shas = {}
+    for run in (40, 41, 42, 43):
+        with open('candidate', 'wb') as file:
+            file.write(build(f'{run}-v1'))
+        shas[run] = cache.add(run, 'ZBProxy-linux-amd64-v1', 'candidate', keep={shas.get(40)} - {None})["sha256"]
+    assert sorted(entry["run_id"] for entry in cache.entries().values()) == [40, 43]
+    assert len(os.listdir(os.path.join(cache.directory, 'objects'))) == 2
+
+    # A damaged object is found by its hash and dropped, never installed
+    with open(cache.object_path(shas[43]), 'r+b') as file:
+        file.seek(40)
+        file.write(b'X')
+    cache.install(cache.entries()['43/ZBProxy-linux-amd64-v1'], 'restored')
+    assert '43/ZBProxy-linux-amd64-v1' not in cache.entries()
+    assert not os.path.exists('restored')
@@ -0,0 +1,50 @@
+import os
+
+from main import SystemControl
+from fakes import RecordingSystemControl
+
+DPKG_STATUS = """\
+Package: ufw
+Status: install ok installed
+Version: 0.36.1
+
+Package: unzip
+Status: deinstall ok config-files
+Version: 6.0
+
+Package: curl
+Status: install ok installed
+Version: 7.81.0
+"""
+
+
+def test_index_reads_installed_packages_only(tmp_path, monkeypatch):
+    status = tmp_path / 'status'
+    status.write_text(DPKG_STATUS)
+    monkeypatch.setattr(SystemControl, 'DPKG_STATUS', str(status))
+    monkeypatch.setattr(SystemControl, '_package_index', None)
+    assert SystemControl.installed_packages() == {'ufw', 'curl'}
+
+
+def test_index_is_reread_only_when_dpkg_changes(tmp_path, monkeypatch):
+    status = tmp_path / 'status'
+    status.write_text(DPKG_STATUS)
+    monkeypatch.setattr(SystemControl, 'DPKG_STATUS', str(status))
+    monkeypatch.setattr(SystemControl, '_package_index', None)
+    first = SystemControl.installed_packages()
+    assert SystemControl.installed_packages() is first
+    status.write_text(DPKG_STATUS + "\nPackage: unzip\nStatus: install ok installed\n")
+    os.utime(status, ns=(os.stat(status).st_atime_ns, os.stat(status).st_mtime_ns + 10 ** 9))
+    assert 'unzip' in SystemControl.installed_packages()
+
+
+def test_installed_packages_are_not_reinstalled():
+    system_control = RecordingSystemControl(installed=('ufw',))
+    system_control.install_package('ufw')
+    assert system_control.commands == []
+
+
+def test_missing_packages_are_installed_in_one_apt_call():
+    system_control = RecordingSystemControl(installed=('ufw',))
+    system_control.install_package('ufw', 'unzip', 'curl')
+    assert system_control.commands == ['sudo apt install --yes unzip curl']
@@ -0,0 +1,69 @@
+import contextlib
+import threading
+
+from main import BlueGreenUpdate, LatencyProbe, MinecraftTransitService
+from fakes import FakeMinecraftServer, LocalHttpServer
+
+
+def test_targets_are_ranked_by_latency():
+    latencies = {"slow": 0.03, "fast": 0.002, "medium": 0.012}
+    with contextlib.ExitStack() as stack:
+        ports = {name: stack.enter_context(FakeMinecraftServer(latency=latency)) for name, latency in latencies.items()}
+        http_url = stack.enter_context(LocalHttpServer({}))  # Answers TCP, but not the status protocol
+        config = {
+            "Services": [MinecraftTransitService("127.0.0.1", port, 0, name).service_dict for name, port in ports.items()],
+            "Lists": {"TransitServerIP": [http_url.removeprefix('http://'), f"127.0.0.1:{BlueGreenUpdate.spare_port()}"]},
+        }
+        ranked = LatencyProbe(count=5, interval=0.01, timeout=1).run(LatencyProbe.targets(config))
+    assert [result["target"] for result in ranked[:3]] == ["service fast", "service medium", "service slow"]
+    assert all(result["minecraft"] and result["loss"] == 0 for result in ranked[:3])
+    assert ranked[3]["target"].startswith("transit") and not ranked[3]["minecraft"]
+    assert ranked[3]["connect"]["p50_ms"] is not None
+    assert ranked[4]["loss"] == 1 and ranked[4]["errors"]
+    assert "(tcp only)" in LatencyProbe.table(ranked) and "(down)" in LatencyProbe.table(ranked)
+
+
+class DroppingMinecraftServer(FakeMinecraftServer):
+    """FakeMinecraftServer that accepts the connections numbered in drop, then closes them unanswered."""
+
+    def __init__(self, drop) -> None:
+        super().__init__()
+        self.drop = set(drop)
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def handle(self, sock):
+        with self.lock:
+            index, self.connections = self.connections, self.connections + 1
+        if index not in self.drop:
+            super().handle(sock)
+
+
+def test_dropped_status_pings_count_as_loss_of_a_minecraft_server():
+    for drop in ({1, 2}, {0, 5, 6}):  # Failures after an answer, and one before the first answer
+        with DroppingMinecraftServer(drop) as port:
+            result = LatencyProbe(count=10, interval=0.01, timeout=1).run([("service flaky", "127.0.0.1", port)])[0]
+        assert result["minecraft"]
+        assert result["loss"] == len(drop) / 10
+        assert len(result["errors"]) == 1 and result["errors"][0].startswith("status:")
+        assert result["ping"]["p50_ms"] is not None
+
+
+def test_tcp_only_target_is_measured_by_its_connects():
+    with LocalHttpServer({}) as url:
+        result = LatencyProbe(count=6, interval=0.01, timeout=0.3).run([("transit http", *LatencyProbe.parse_address(url.removeprefix('http://')))])[0]
+    assert not result["minecraft"] and result["loss"] == 0
+    assert result["connect"]["p50_ms"] is not None
+
+
+def test_parse_address():
+    assert LatencyProbe.parse_address('example.com') == ('example.com', 25565)
+    assert LatencyProbe.parse_address('example.com:25566') == ('example.com', 25566)
+    assert LatencyProbe.parse_address('[::1]:25566') == ('::1', 25566)
+    assert LatencyProbe.parse_address('::1') == ('::1', 25565)
+
+
+def test_percentile():
+    assert LatencyProbe.percentile([], 50) is None
+    assert LatencyProbe.percentile(list(range(1, 101)), 99) == 99
+    assert LatencyProbe.percentile([5, 1, 3], 50) == 3
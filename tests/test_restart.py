@@ -0,0 +1,84 @@
+import struct
+
+import pytest
+
+from main import Benchmark, BlueGreenUpdate, MinecraftProtocol, ProxyServer, TransitServer
+from fakes import StandInServiceControl, handshake_only, transit_service, wait_for, write_config
+
+
+def test_required_action():
+    service = transit_service(30000, 'test')
+    toggled = {**service, "Minecraft": {**service["Minecraft"], "NameAccess": {"Mode": ""}}}
+    moved = {**service, "Listen": 30001}
+    assert ProxyServer.required_action({"Services": [service]}, {"Services": [service]}) == 'none'
+    assert ProxyServer.required_action({"Services": [service]}, {"Services": [toggled]}) == 'none'
+    assert ProxyServer.required_action({"Services": [service], "Lists": {}}, {"Services": [service], "Lists": {"test": ["Steve"]}}) == 'none'
+    assert ProxyServer.required_action({"Services": [service]}, {"Services": [moved]}) == 'restart'
+    assert ProxyServer.required_action({"Services": [service]}, {"Services": []}) == 'restart'
+    assert ProxyServer.required_action(None, {"Services": [service]}) == 'restart'
+
+
+@pytest.fixture
+def stand_in(work_dir):
+    port = BlueGreenUpdate.spare_port()
+    service = transit_service(port, 'test')
+    service['Minecraft']['NameAccess']['Mode'] = ''
+    write_config('ZBProxy.json', [service], {"test": []})
+    control = StandInServiceControl(str(work_dir))
+    control.start()
+    try:
+        assert Benchmark.wait_for_status(port) is not None
+        yield TransitServer('test', control), control, port
+    finally:
+        control.stop()
+
+
+def live_connection_survives(port, change):
+    live = handshake_only(port)
+    try:
+        change()
+        live.sendall(MinecraftProtocol.packet(0x01, struct.pack('>q', 1)))
+        return MinecraftProtocol.read_packet(live)[0] == 0x01
+    except (OSError, ValueError):
+        return False
+    finally:
+        live.close()
+
+
+def test_whitelist_toggle_keeps_live_connections(stand_in):
+    transit_server, control, port = stand_in
+    assert live_connection_survives(port, lambda: transit_server.turn_on_whitelist('test'))
+    assert control.restarts == 0
+    assert control.systemctl() == []
+    assert wait_for(lambda: 'NameAccess=allow' in Benchmark.wait_for_status(port)['description']['text'])
+
+
+def test_restart_drops_live_connections(stand_in):
+    transit_server, control, port = stand_in
+    assert not live_connection_survives(port, lambda: transit_server.activate('restart'))
+    assert control.restarts == 1
+    assert Benchmark.wait_for_status(port) is not None
+
+
+def test_list_edit_restarts_nothing(stand_in):
+    transit_server, control, port = stand_in
+    transit_server.add_whitelist('Steve', 'test')
+    assert control.restarts == 0
+
+
+def test_listen_change_restarts_onto_the_new_config(stand_in):
+    transit_server, control, port = stand_in
+    new_port = BlueGreenUpdate.spare_port()
+    before = transit_server.zbproxy_config.read_json()
+    with transit_server.zbproxy_config.transaction() as config:
+        config["Services"][0]["Listen"] = new_port
+    assert transit_server.activate(transit_server.required_action(before, config)) == 'restart'
+    assert control.restarts == 1
+    assert Benchmark.wait_for_status(new_port) is not None
+
+
+def test_unchanged_config_restarts_nothing(stand_in):
+    transit_server, control, port = stand_in
+    transit_server.turn_off_whitelist('test')  # Already off
+    assert control.restarts == 0
+    assert control.systemctl() == []
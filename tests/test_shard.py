@@ -0,0 +1,104 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+from main import Benchmark, BlueGreenUpdate, MinecraftTransitService, TransitServer, ZBProxyShards
+from fakes import STAND_IN_ZBPROXY, FakeUfwSystemControl
+
+COUNT = 4
+LOADS = {f"Service{i}": 20000 // (i + 1) for i in range(24)}  # A few busy services, a long tail
+
+
+def imbalance(assignment):
+    """Busiest shard over the average, 1 is perfect."""
+    totals = [sum(load for name, load in LOADS.items() if assignment[name] == shard) for shard in range(COUNT)]
+    return max(totals) / (sum(totals) / COUNT)
+
+
+def test_partition_by_load_beats_by_count():
+    by_load = ZBProxyShards.partition(list(LOADS), COUNT, LOADS)
+    assert set(by_load) == set(LOADS) and set(by_load.values()) == set(range(COUNT))
+    assert imbalance(by_load) < imbalance(ZBProxyShards.partition(list(LOADS), COUNT))
+
+
+@pytest.fixture
+def sharded(work_dir):
+    config = {"Services": [MinecraftTransitService("127.0.0.1", 25565, BlueGreenUpdate.spare_port(), name).service_dict for name in LOADS],
+              "Lists": {name: [f"Player{i}" for i in range(5)] for name in LOADS}}
+    with open('ZBProxy.json', 'w') as file:
+        json.dump(config, file)
+    system_control = FakeUfwSystemControl()
+    shards = ZBProxyShards('ZBProxy.json', system_control, str(work_dir / 'systemd'))
+    layout = shards.setup(COUNT, cpus=list(range(2 * COUNT)), loads=LOADS)
+    return shards, layout, TransitServer(None, system_control)
+
+
+def snapshot(shards):
+    shard_configs = {}
+    for shard in range(COUNT):
+        with open(shards.shard_path(shard)) as file:
+            shard_configs[shard] = file.read()
+    return shard_configs
+
+
+def test_whitelist_change_touches_only_its_shard(sharded):
+    shards, _, transit = sharded
+    owner = shards.state()["assignment"]["Service7"]
+    before = snapshot(shards)
+    transit.add_whitelist("Newcomer", "Service7")
+    after = snapshot(shards)
+    assert [shard for shard in range(COUNT) if before[shard] != after[shard]] == [owner]
+
+
+def test_new_service_moves_no_other(sharded):
+    shards, _, transit = sharded
+    owner = shards.state()["assignment"]
+    before = snapshot(shards)
+    transit.add_service(MinecraftTransitService("127.0.0.1", 25565, BlueGreenUpdate.spare_port(), "Extra").service_dict)
+    after = snapshot(shards)
+    assert len([shard for shard in range(COUNT) if before[shard] != after[shard]]) == 1
+    assert all(shards.state()["assignment"][name] == shard for name, shard in owner.items())
+
+
+def test_toggle_is_left_to_the_owning_instance(sharded):
+    shards, _, transit = sharded
+    owner = shards.state()["assignment"]["Service3"]
+    before = snapshot(shards)
+    transit.system_control.commands.clear()
+    transit.turn_off_whitelist("Service3")
+    after = snapshot(shards)
+    assert [shard for shard in range(COUNT) if before[shard] != after[shard]] == [owner]
+    assert transit.system_control.systemctl() == []
+
+
+def test_switch_restarts_the_owning_unit_only(sharded):
+    shards, _, transit = sharded
+    owner = shards.state()["assignment"]["Service3"]
+    transit.system_control.commands.clear()
+    transit.switch_upstream("Service3", "127.0.0.1", 25566)
+    assert transit.system_control.systemctl() == [f'sudo systemctl restart {ZBProxyShards.UNIT}{owner}']
+
+
+def test_units(sharded, work_dir):
+    _, layout, _ = sharded
+    with open(work_dir / 'systemd' / f'{ZBProxyShards.UNIT}.service') as file:
+        assert any(line.startswith('WorkingDirectory=') for line in file.read().splitlines())
+    cpu_sets = [shard["CPUAffinity"].split() for shard in layout]
+    assert sorted(int(cpu) for cpus in cpu_sets for cpu in cpus) == list(range(2 * COUNT))
+    assert len(os.listdir(work_dir / 'systemd')) == 1 + COUNT  # The template and one drop-in directory per shard
+
+
+def test_every_service_is_served_by_one_shard(sharded):
+    shards, _, _ = sharded
+    processes = [subprocess.Popen(STAND_IN_ZBPROXY, cwd=os.path.dirname(shards.shard_path(shard)),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for shard in range(COUNT)]
+    try:
+        with open('ZBProxy.json') as file:
+            listens = [service["Listen"] for service in json.load(file)["Services"]]
+        assert all(Benchmark.wait_for_status(port) is not None for port in listens)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
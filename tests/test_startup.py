@@ -0,0 +1,60 @@
+import json
+import subprocess
+import sys
+
+from conftest import ROOT
+from main import Benchmark, Main, SystemControl, check_environment
+from fakes import RecordingSystemControl
+
+IN_PROCESS = """
+import sys
+sys.path[:0] = [{root!r}, {tests!r}]
+import main
+from fakes import RecordingSystemControl
+main.Main(load_config=False, system_control=RecordingSystemControl()).run(['OProxy'] + {args!r})
+print('requests imported:', 'requests' in sys.modules)
+"""
+
+
+def run_in_fresh_interpreter(work_dir, args):
+    script = IN_PROCESS.format(root=ROOT, tests=f'{ROOT}/tests', args=args)
+    return subprocess.run([sys.executable, '-c', script], cwd=work_dir, capture_output=True, text=True, check=True).stdout
+
+
+def test_config_edits_do_not_import_requests(work_dir):
+    for command in Benchmark.STARTUP_COMMANDS:
+        Benchmark.seed_work_dir(work_dir)
+        output = run_in_fresh_interpreter(work_dir, command)
+        assert 'requests imported: False' in output, command
+
+
+def test_subsystems_are_built_on_first_use(work_dir):
+    Benchmark.seed_work_dir(work_dir)
+    main = Main(load_config=False, system_control=RecordingSystemControl(installed=('ufw',)))
+    main.run(['OProxy', 'transit', 'whitelist', 'add', 'bench_player', 'bench_group'])
+    assert 'transit_server' in vars(main)
+    assert 'proxy_server' not in vars(main) and 'program_control' not in vars(main)
+    with open('ZBProxy.json') as file:
+        assert json.load(file)["Lists"]["bench_group"] == ['bench_player']
+
+
+def test_environment_is_checked_once(monkeypatch):
+    checks = []
+    monkeypatch.setattr('main.os.geteuid', lambda: checks.append(1) or 0)
+    monkeypatch.setattr('main.platform.version', lambda: '#1 SMP Ubuntu')
+    monkeypatch.setattr('main.platform.system', lambda: 'Linux')
+    check_environment.cache_clear()
+    try:
+        for _ in range(5):
+            SystemControl()
+    finally:
+        check_environment.cache_clear()
+    assert len(checks) == 1
+
+
+def test_parse_importtime():
+    stderr = ("import time: self [us] | cumulative | imported package\n"
+              "import time:       100 |        100 |   _io\n"
+              "import time:       500 |       2500 | json\n"
+              "import time:        50 |         50 | main\n")
+    assert Benchmark.parse_importtime(stderr) == [(2500, 'json'), (50, 'main')]
@@ -0,0 +1,99 @@
+import os
+import shlex
+import subprocess
+import time
+
+import pytest
+
+from main import BlueGreenUpdate
+from fakes import STAND_IN_ZBPROXY, transit_service, write_config
+
+
+def build(version):
+    return f"#!/bin/sh\n# build {version}\nexec {shlex.join(STAND_IN_ZBPROXY)}\n"
+
+
+def stage_with(content):
+    def stage(staged_path):
+        with open(staged_path, 'w') as file:
+            file.write(content)
+        os.chmod(staged_path, 0o755)
+        return f"{staged_path} downloaded successfully"
+    return stage
+
+
+class Service:
+    """Stands in for systemd running ./zbproxy: restart stops the old process and starts the binary on disk."""
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.process = None
+        self.broken = 0  # Restarts left that do not come up
+
+    def restart(self):
+        self.stop()
+        if self.broken:
+            self.broken -= 1
+            return
+        self.process = subprocess.Popen([os.path.join(self.work_dir, 'zbproxy')], cwd=self.work_dir,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+@pytest.fixture
+def deployment(work_dir):
+    # The upstream, port 25565 here, is not running: health is about the new process, not the network behind it
+    write_config('ZBProxy.json', [transit_service(BlueGreenUpdate.spare_port(), 'Swap')])
+    stage_with(build(1))('zbproxy')
+    service = Service(str(work_dir))
+    service.restart()
+    deployment = BlueGreenUpdate(service.restart, 'zbproxy', 'ZBProxy.json', health_timeout=3)
+    deployment.service = service
+    assert deployment.wait_healthy(time.monotonic()) is not None
+    yield deployment
+    service.stop()
+
+
+def installed(path='zbproxy'):
+    with open(path) as file:
+        return file.read()
+
+
+def test_good_build_is_swapped_in(deployment):
+    assert deployment.run(stage_with(build(2))) == "ZBProxy updated successfully."
+    assert installed() == build(2)
+    assert installed('zbproxy.previous') == build(1)
+    assert deployment.outage_seconds < 3
+
+
+def test_crashing_build_fails_the_smoke_test(deployment):
+    result = deployment.run(stage_with("#!/bin/sh\nexit 1\n"))
+    assert result == "Failed to update ZBProxy: the new build did not pass the smoke test."
+    assert installed() == build(1)
+    assert not os.path.exists(deployment.staged_path)
+    assert deployment.service.process.poll() is None  # Never restarted
+
+
+def test_unhealthy_build_is_rolled_back(deployment):
+    deployment.service.broken = 1
+    assert deployment.run(stage_with(build(2))) == "Failed to update ZBProxy: rolled back to the previous build."
+    assert installed() == build(1)
+    assert deployment.outage_seconds is not None
+
+
+def test_unhealthy_rollback_is_reported(deployment):
+    deployment.service.broken = 2
+    result = deployment.run(stage_with(build(2)))
+    assert result == "Failed to update ZBProxy: rolled back to the previous build, but it is not healthy either."
+    assert installed() == build(1)
+
+
+def test_inactive_unit_is_not_healthy(deployment):
+    deployment.is_active = lambda: False
+    deployment.health_timeout = 0.5
+    assert deployment.wait_healthy(time.monotonic()) is None
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from main import NetworkTuning
+
+STOCK_SYSCTLS = {  # A stock Ubuntu 22.04 kernel
+    "net.core.default_qdisc": "fq_codel",
+    "net.ipv4.tcp_congestion_control": "cubic",
+    "net.ipv4.tcp_available_congestion_control": "reno cubic",
+    "net.ipv4.tcp_fastopen": "1",
+    "net.core.somaxconn": "4096",
+    "net.ipv4.tcp_max_syn_backlog": "1024",
+    "net.core.netdev_max_backlog": "1000",
+    "net.core.rmem_max": "212992",
+    "net.core.wmem_max": "212992",
+    "net.ipv4.tcp_rmem": "4096\t131072\t6291456",
+    "net.ipv4.tcp_wmem": "4096\t16384\t4194304",
+    "net.ipv4.ip_local_port_range": "32768\t60999",
+}
+
+
+@pytest.fixture
+def tuning(tmp_path):
+    """NetworkTuning over a scratch root holding the stock /proc/sys values of a 2 GB host."""
+    for key, value in STOCK_SYSCTLS.items():
+        path = tmp_path / 'proc/sys' / key.replace('.', '/')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(value + '\n')
+    (tmp_path / 'proc/meminfo').write_text("MemTotal:        2000000 kB\n")
+    return NetworkTuning(str(tmp_path))
+
+
+def test_apply_sets_the_profile_live(tuning):
+    tuning.apply()
+    profile = tuning.profile()
+    assert all(tuning.read(key) == value for key, value in profile.items() if key in STOCK_SYSCTLS)
+    assert "net.ipv4.tcp_congestion_control" not in profile  # bbr is not available on this kernel
+    with open(tuning.drop_in) as file:
+        assert "\n-net.netfilter.nf_conntrack_max = " in file.read()  # Optional, the module may not be loaded
+
+
+def test_reapplying_keeps_the_stock_priors(tuning):
+    tuning.apply()
+    priors = tuning.priors()
+    assert priors == {key: ' '.join(value.split()) for key, value in STOCK_SYSCTLS.items() if key in tuning.profile()}
+    tuning.apply()
+    assert tuning.priors() == priors
+
+
+def test_revert_restores_stock(tuning):
+    tuning.apply()
+    tuning.revert()
+    assert all(tuning.read(key) == ' '.join(value.split()) for key, value in STOCK_SYSCTLS.items())
+    assert not os.path.exists(tuning.drop_in)
+
+
+def test_buffers_scale_with_memory(tuning, tmp_path):
+    small = int(tuning.profile()["net.core.rmem_max"])
+    (tmp_path / 'proc/meminfo').write_text("MemTotal:        64000000 kB\n")
+    assert int(NetworkTuning(str(tmp_path)).profile()["net.core.rmem_max"]) >= small
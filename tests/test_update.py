@@ -0,0 +1,124 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+import zlib
+
+import pytest
+
+from main import NetworkControl, ProgramControl, ZipMemberExtractor
+from fakes import LocalHttpServer, pattern_reader
+
+BINARY = pattern_reader()(0, 4 * 1024 * 1024)
+
+
+class Unseekable(io.RawIOBase):
+    """A write-only stream zipfile cannot seek back in, so it writes data descriptors like a streamed zip."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def archive(members: dict, streamed: bool = False):
+    buffer = Unseekable() if streamed else io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+    return bytes(buffer.data) if streamed else buffer.getvalue()
+
+
+def serve(data: bytes):
+    return LocalHttpServer({'/zbproxy.zip': lambda request: LocalHttpServer.byte_range_response(
+        request, len(data), lambda offset, length: data[offset:offset + length])})
+
+
+def watch_disk_use(directory, peak: list, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file()))
+        time.sleep(0.002)
+
+
+def timed_with_peak_disk(directory, update):
+    """Run update(), returning its wall time and the peak size of the files in directory meanwhile."""
+    peak, stop = [0], threading.Event()
+    watcher = threading.Thread(target=watch_disk_use, args=(directory, peak, stop))
+    watcher.start()
+    started = time.perf_counter()
+    try:
+        update()
+    finally:
+        elapsed = time.perf_counter() - started
+        stop.set()
+        watcher.join()
+    return elapsed, peak[0]
+
+
+@pytest.mark.parametrize('streamed', [False, True], ids=['sizes_in_header', 'data_descriptor'])
+def test_member_is_extracted_while_the_zip_streams_in(work_dir, streamed):
+    data = archive({'README.md': b'readme', 'ZBProxy-linux-amd64-v1': BINARY}, streamed)
+    peak, stop = [0], threading.Event()
+    watcher = threading.Thread(target=watch_disk_use, args=(work_dir, peak, stop))
+    watcher.start()
+    with serve(data) as base_url:
+        result = NetworkControl().download_zip_member(f'{base_url}/zbproxy.zip', ProgramControl.ZBPROXY_MEMBER, 'zbproxy')
+    stop.set()
+    watcher.join()
+    assert result == 'zbproxy downloaded successfully'
+    assert (work_dir / 'zbproxy').read_bytes() == BINARY
+    assert os.access('zbproxy', os.X_OK)
+    assert os.listdir(work_dir) == ['zbproxy']
+    assert peak[0] <= len(BINARY)  # The archive itself is never stored
+
+
+def test_missing_member_fails_without_leftovers(work_dir):
+    with serve(archive({'README.md': b'readme'})) as base_url:
+        result = NetworkControl().download_zip_member(f'{base_url}/zbproxy.zip', ProgramControl.ZBPROXY_MEMBER, 'zbproxy')
+    assert result.startswith('Failed to download zbproxy')
+    assert os.listdir(work_dir) == []
+
+
+def test_corrupted_member_is_refused(work_dir):
+    data = bytearray(archive({'ZBProxy-linux-amd64-v1': BINARY}))
+    data[len(data) // 2] ^= 0xFF
+    extractor = ZipMemberExtractor(ProgramControl.ZBPROXY_MEMBER, 'zbproxy')
+    with pytest.raises((zipfile.BadZipFile, zlib.error)):
+        for offset in range(0, len(data), 65536):
+            extractor.feed(bytes(data[offset:offset + 65536]))
+    extractor.abort()
+    assert not os.path.exists('zbproxy')
+
+
+def test_streaming_update_beats_the_shell_steps(work_dir):
+    """Against what update_zbproxy did before: download the zip, then unzip, rm, mv and chmod, one subprocess each."""
+    data = archive({'ZBProxy-linux-amd64-v1': BINARY})
+    unzip = 'unzip -o zbproxy.zip' if shutil.which('unzip') else f'{sys.executable} -m zipfile -e zbproxy.zip .'
+    shell_dir, streaming_dir = work_dir / 'shell_steps', work_dir / 'streaming'
+    shell_dir.mkdir()
+    streaming_dir.mkdir()
+    with serve(data) as base_url:
+        url = f'{base_url}/zbproxy.zip'
+
+        def shell_steps():
+            NetworkControl().download_file(url, str(shell_dir / 'zbproxy.zip'))
+            for command in (unzip, 'rm -rf zbproxy.zip', 'mv ZBProxy-linux-amd64-v1 zbproxy', 'chmod +x zbproxy'):
+                subprocess.run(command, shell=True, cwd=shell_dir, stdout=subprocess.DEVNULL, check=True)
+
+        def streaming():
+            NetworkControl().download_zip_member(url, ProgramControl.ZBPROXY_MEMBER, str(streaming_dir / 'zbproxy'))
+
+        shell_seconds, shell_peak = timed_with_peak_disk(shell_dir, shell_steps)
+        streaming_seconds, streaming_peak = timed_with_peak_disk(streaming_dir, streaming)
+    assert (shell_dir / 'zbproxy').read_bytes() == (streaming_dir / 'zbproxy').read_bytes() == BINARY
+    assert shell_peak > len(BINARY) >= streaming_peak  # The shell steps keep the archive on disk next to the binary
+    assert streaming_seconds < shell_seconds
@@ -0,0 +1,119 @@
+import asyncio
+import contextlib
+import time
+
+import pytest
+
+from main import HandleJsonFile, HealthWatchdog, MinecraftTransitService
+from fakes import FakeMinecraftServer, RecordingSystemControl, write_config
+
+SETTINGS = {"interval": 0.2, "timeout": 0.15, "window": 6, "degrade_after": 2, "restart_after": 4, "recover_after": 2,
+            "cooldown": 2, "concurrency": 32}
+
+
+async def until(condition, limit: float = 10):
+    deadline = time.monotonic() + limit
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.02)
+    return condition()
+
+
+@pytest.fixture
+def watched(work_dir):
+    """A watchdog over 6 stand-in listeners in front of 2 stand-in upstreams; a restart un-wedges the listeners."""
+    with contextlib.ExitStack() as stack:
+        upstreams = [FakeMinecraftServer() for _ in range(2)]
+        upstream_ports = [stack.enter_context(server) for server in upstreams]
+        listeners = [FakeMinecraftServer() for _ in range(6)]
+        listen_ports = [stack.enter_context(server) for server in listeners]
+        write_config('ZBProxy.json', [MinecraftTransitService('127.0.0.1', upstream_ports[i % 2], port, f'test{i}').service_dict
+                                      for i, port in enumerate(listen_ports)])
+        system_control = RecordingSystemControl()
+        run_command = system_control.run_command
+
+        def systemctl(command):
+            if 'systemctl restart ZBProxy' in command:
+                for server in listeners:
+                    server.hang = False
+            return run_command(command)
+        system_control.run_command = systemctl
+        settings = {**SETTINGS, "alert": f'echo "$OPROXY_TARGET $OPROXY_STATE" >> {work_dir / "alerts.log"}'}
+        watchdog = HealthWatchdog('ZBProxy.json', system_control, settings, str(work_dir / 'health.json'))
+        yield watchdog, listeners, upstreams, listen_ports, upstream_ports
+        for server in listeners + upstreams:
+            server.hang = False
+
+
+def run(watchdog, scenario):
+    async def main():
+        serving = asyncio.get_running_loop().create_task(watchdog.serve())
+        try:
+            assert await until(lambda: watchdog.targets)
+            await scenario()
+        finally:
+            watchdog.stopped.set()
+            await serving
+    asyncio.run(main())
+
+
+def test_healthy_targets_need_no_action(watched):
+    watchdog, *_ = watched
+
+    async def scenario():
+        await asyncio.sleep(SETTINGS["interval"] * 4)
+    run(watchdog, scenario)
+    assert len(watchdog.targets) == 8
+    assert {target["state"] for target in watchdog.targets.values()} == {'healthy'}
+    assert watchdog.system_control.commands == []
+    assert len(HandleJsonFile(watchdog.status_path).read_json()["targets"]) == 8
+
+
+def test_wedged_listener_is_degraded_then_restarted(watched):
+    watchdog, listeners, _, listen_ports, _ = watched
+    key = f"listen {listen_ports[0]}"
+
+    async def scenario():
+        await asyncio.sleep(SETTINGS["interval"] * 2)
+        listeners[0].hang = True  # Accepts, never answers
+        assert await until(lambda: watchdog.targets[key]["state"] == 'degraded')
+        assert watchdog.system_control.commands == []
+        assert await until(lambda: watchdog.system_control.systemctl('restart'))
+        assert await until(lambda: watchdog.targets[key]["state"] == 'healthy')
+    run(watchdog, scenario)
+    assert watchdog.system_control.systemctl() == ['sudo systemctl restart ZBProxy']
+
+
+def test_dead_upstream_only_alerts(watched, work_dir):
+    watchdog, _, upstreams, _, upstream_ports = watched
+    key = f"upstream 127.0.0.1:{upstream_ports[0]}"
+
+    async def scenario():
+        await asyncio.sleep(SETTINGS["interval"] * 2)
+        upstreams[0].stop()
+        assert await until(lambda: watchdog.targets[key]["state"] == 'down')
+        upstreams[0] = FakeMinecraftServer(port=upstream_ports[0])
+        upstreams[0].start()
+        assert await until(lambda: watchdog.targets[key]["state"] == 'healthy')
+        await asyncio.sleep(0.2)  # The alert commands run in the background
+    run(watchdog, scenario)
+    upstreams[0].stop()
+    assert watchdog.system_control.commands == []  # Restarting ZBProxy cannot bring an upstream back
+    assert watchdog.targets[key]["services"] == ['test0', 'test2', 'test4']
+    with open(work_dir / 'alerts.log') as file:
+        assert file.read().splitlines() == [f"{key} degraded", f"{key} down", f"{key} healthy"]
+
+
+def test_hung_upstream_does_not_hold_back_the_others(watched):
+    watchdog, _, upstreams, _, upstream_ports = watched
+    key = f"upstream 127.0.0.1:{upstream_ports[1]}"
+
+    async def scenario():
+        upstreams[1].hang = True
+        assert await until(lambda: watchdog.targets[key]["state"] == 'down')
+        await asyncio.sleep(SETTINGS["interval"] * 2)
+        started = time.perf_counter()
+        await asyncio.gather(*(watchdog.check(other) for other in list(watchdog.targets)))
+        assert time.perf_counter() - started < SETTINGS["timeout"] * 3  # One sweep, not one timeout per target
+    run(watchdog, scenario)
+    assert all(target["state"] == 'healthy' for other, target in watchdog.targets.items() if other != key)
+    assert watchdog.peak_in_flight > 1
@@ -0,0 +1,96 @@
+import io
+import json
+import os
+import random
+import time
+
+import pytest
+
+from main import TransitServer
+from fakes import RecordingSystemControl, count_writes, write_config
+
+
+@pytest.fixture
+def transit(work_dir):
+    write_config('ZBProxy.json', [], {"test": []})
+    server = TransitServer('test', RecordingSystemControl(installed=('ufw',)))
+    server.writes = count_writes(server.zbproxy_config)
+    return server
+
+
+def stored():
+    with open('ZBProxy.json') as file:
+        return json.load(file)["Lists"]["test"]
+
+
+@pytest.mark.parametrize('size', [1000, 10000, 100000])
+def test_import_dedups_and_sorts_in_one_write(transit, size):
+    names = [f"Player{i}" for i in range(size)]
+    random.Random(0).shuffle(names)
+    lines = [f"{name}\n" for name in names + names[:size // 10]] + ["# comment\n", "\n"]
+    assert transit.import_whitelist('test', iter(lines)) == f"Imported the test: {size} added, 0 removed"
+    assert stored() == sorted(names)
+    assert len(transit.writes) == 1
+
+
+def add_one_name_per_write(name, path='ZBProxy.json'):
+    """What `whitelist add` did before: a linear membership check and a full rewrite per name."""
+    with open(path) as file:
+        config = json.load(file)
+    if name not in config["Lists"]["test"]:
+        config["Lists"]["test"].append(name)
+    with open(path, 'w') as file:
+        file.write(json.dumps(config, indent=4))
+
+
+@pytest.mark.parametrize('size', [1000, 10000, 100000])
+def test_import_beats_one_write_per_name(transit, size):
+    sample = 20
+    names = [f"Player{i}" for i in range(size)]
+    random.Random(0).shuffle(names)
+    started = time.perf_counter()
+    transit.import_whitelist('test', iter(f"{name}\n" for name in names))
+    imported = time.perf_counter() - started
+    started = time.perf_counter()
+    for i in range(sample):  # Into a list of about the same size, as the last names of a one by one import would be
+        add_one_name_per_write(f"Late{i}")
+    one_by_one = (time.perf_counter() - started) / sample * size
+    print(f"{size} names: import {imported * 1000:.1f} ms, one write per name about {one_by_one:.1f} s")
+    assert imported * 10 < one_by_one
+
+
+def test_reimporting_the_same_names_writes_nothing(transit):
+    names = [f"Player{i}" for i in range(1000)]
+    transit.import_whitelist('test', iter(f"{name}\n" for name in names))
+    mtime = os.stat('ZBProxy.json').st_mtime_ns
+    transit.import_whitelist('test', iter(f"{name}\n" for name in reversed(names)))
+    assert len(transit.writes) == 1
+    assert os.stat('ZBProxy.json').st_mtime_ns == mtime
+
+
+def test_import_replaces_unless_merging(transit):
+    transit.import_whitelist('test', iter(["Alex\n", "Steve\n"]))
+    transit.import_whitelist('test', iter(["Herobrine\n"]), merge=True)
+    assert stored() == ["Alex", "Herobrine", "Steve"]
+    transit.import_whitelist('test', iter(["Steve\n"]))
+    assert stored() == ["Steve"]
+
+
+def test_export_round_trips(transit):
+    transit.import_whitelist('test', iter(["Steve\n", "Alex\n"]))
+    output = io.StringIO()
+    assert transit.export_whitelist('test', output) == "Exported 2 names from the test"
+    assert output.getvalue() == "Alex\nSteve\n"
+
+
+def test_single_adds_and_removes_keep_the_list_sorted(transit):
+    write_config('ZBProxy.json', [], {"test": ["Steve", "Alex"]})  # Unsorted, as an older OProxy left it
+    transit.add_whitelist("Bob", "test")
+    transit.add_whitelist("Bob", "test")
+    transit.remove_whitelist("Steve", "test")
+    assert stored() == ["Alex", "Bob"]
+
+
+def test_unknown_list_is_refused(transit):
+    assert transit.import_whitelist('missing', iter(["Steve\n"])) == "Failed to import the missing"
+    assert transit.writes == []